@@ -1,63 +1,318 @@
 """
 This module provides function to query data in an approachable way from FPL endpoints
 """
+from __future__ import annotations
 import os
+import json
+import time
 import yaml
-import requests
-import pandas as pd
+import hashlib
+import logging
+import threading
 from datetime import date
 from pathlib import Path
+from functools import lru_cache
+from typing import Iterable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from fantasy_football.lazy import lazy_import
+from fantasy_football.schema import PLAYER_SCHEMA, PLAYER_RENAMES, TEAM_SCHEMA, HISTORY_SCHEMA, conform, source_columns
+from fantasy_football.instrumentation import count, span
 
-STATIC_ENDPOINT = "https://fantasy.premierleague.com/api/bootstrap-static/"
-FIXTURES_ENDPOINT = "https://fantasy.premierleague.com/api/fixtures/"
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
+
+API_ROOT = "https://fantasy.premierleague.com/api/"
+STATIC_ENDPOINT = API_ROOT + "bootstrap-static/"
+FIXTURES_ENDPOINT = API_ROOT + "fixtures/"
+ELEMENT_SUMMARY_ENDPOINT = API_ROOT + "element-summary/{}/"
 CONFIG_PATH = Path(os.path.abspath(__file__)).parent / "config"
+CACHE_PATH = Path(os.path.abspath(__file__)).parent / "cache"
+
+# how long (in seconds) a downloaded payload is served from memory without asking the server again
+SNAPSHOT_TTL = float(os.environ.get("FPL_SNAPSHOT_TTL", 15 * 60))
+# upper bound for all payloads kept in CACHE_PATH, the least recently used ones are removed first
+MAX_DISK_CACHE_BYTES = 64 * 1024 ** 2
+
+# (connect, read) timeouts in seconds and retry policy of the shared HTTP session
+REQUEST_TIMEOUT = (5, 30)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 16
+# polite upper bound of requests started per second by bulk fetches
+MAX_REQUESTS_PER_SECOND = 10.0
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_SNAPSHOTS = {}
+_SNAPSHOTS_LOCK = threading.Lock()
+CACHE_STATS = {'hits': 0, 'misses': 0, 'revalidated': 0, 'bytes_downloaded': 0, 'bytes_saved': 0}
+
+# module attributes read from CONFIG_PATH on first use, see __getattr__
+CONFIG_NAMES = ('TEAM_DICT', 'POSITION_DICT', 'TEAM_NAMES', 'POSITIONS')
+
+
+@lru_cache(maxsize=1)
+def load_config() -> dict:
+    with open(CONFIG_PATH / "team_dict.yaml") as f:
+        team_dict = yaml.safe_load(f)
+    with open(CONFIG_PATH / "positions_dict.yaml") as f:
+        position_dict = yaml.safe_load(f)
+    # team and position names ordered by their FPL ids, the position in the list is used as a categorical code
+    return {'TEAM_DICT': team_dict,
+            'POSITION_DICT': position_dict,
+            'TEAM_NAMES': [team_dict[_id] for _id in sorted(team_dict)],
+            'POSITIONS': [position_dict[_id] for _id in sorted(position_dict)]}
+
+
+def __getattr__(name: str):
+    if name in CONFIG_NAMES:
+        return load_config()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_session() -> requests.Session:
+    """Returns the process-wide keep-alive session, with pooled connections and retries on 429/5xx
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=MAX_RETRIES, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES,
+                          allowed_methods=frozenset(['GET']), respect_retry_after_header=True)
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+        return _SESSION
+
+
+class _RateLimiter:
+    def __init__(self, max_per_second: float):
+        self.interval = 1 / max_per_second if max_per_second else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _disk_cache_paths(url: str):
+    key = hashlib.sha1(url.encode('utf8')).hexdigest()[:16]
+    return CACHE_PATH / f"{key}.json", CACHE_PATH / f"{key}.meta.json"
+
+
+def _read_disk_cache(url: str):
+    payload_path, meta_path = _disk_cache_paths(url)
+    if not (payload_path.exists() and meta_path.exists()):
+        return None, None
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        content = payload_path.read_bytes()
+    except (OSError, ValueError) as error:
+        logging.info(error)
+        return None, None
+    if meta.get('size') != len(content):
+        return None, None
+    return content, meta
+
+
+def _write_disk_cache(url: str, content: bytes, headers) -> None:
+    if len(content) > MAX_DISK_CACHE_BYTES:
+        return
+    payload_path, meta_path = _disk_cache_paths(url)
+    meta = {'url': url, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'), 'size': len(content)}
+    try:
+        CACHE_PATH.mkdir(parents=True, exist_ok=True)
+        payload_path.write_bytes(content)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    except OSError as error:
+        logging.info(error)
+        return
+    _evict_disk_cache()
+
 
-with open(CONFIG_PATH / "team_dict.yaml") as f:
-    TEAM_DICT = yaml.safe_load(f)
-    f.close()
-with open(CONFIG_PATH / "positions_dict.yaml") as f:
-    POSITION_DICT = yaml.safe_load(f)
-    f.close()
+def _evict_disk_cache() -> None:
+    payloads = [path for path in CACHE_PATH.glob("*.json") if not path.name.endswith(".meta.json")]
+    payloads.sort(key=lambda path: path.stat().st_mtime)
+    total_size = sum(path.stat().st_size for path in payloads)
+    while payloads and total_size > MAX_DISK_CACHE_BYTES:
+        oldest = payloads.pop(0)
+        total_size -= oldest.stat().st_size
+        oldest.unlink()
+        oldest.with_name(oldest.name[:-len(".json")] + ".meta.json").unlink(missing_ok=True)
+
+
+def _fetch_snapshot(url: str) -> Tuple[dict, int]:
+    cached_content, meta = _read_disk_cache(url)
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    with span('api.fetch', url=url) as current:
+        response = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        current.set(status=response.status_code, bytes=len(response.content))
+        count('api.requests')
+        if response.status_code == 304 and cached_content is not None:
+            CACHE_STATS['revalidated'] += 1
+            CACHE_STATS['bytes_saved'] += len(cached_content)
+            os.utime(_disk_cache_paths(url)[0])
+            with span('api.parse_json'):
+                return json.loads(cached_content), len(cached_content)
+        response.raise_for_status()
+        CACHE_STATS['misses'] += 1
+        CACHE_STATS['bytes_downloaded'] += len(response.content)
+        count('api.bytes_downloaded', len(response.content))
+        _write_disk_cache(url, response.content, response.headers)
+        with span('api.parse_json'):
+            return response.json(), len(response.content)
+
+
+def get_snapshot(url: str = STATIC_ENDPOINT, ttl: Optional[float] = None, force_refresh: bool = False) -> dict:
+    """Returns the parsed JSON payload of an FPL endpoint, shared between all callers
+
+    The payload is kept in memory for ``ttl`` seconds. Once it expires, the server is asked again
+    with the ETag/Last-Modified of the on-disk copy, so an unchanged payload is not downloaded twice.
+    The returned object is shared - callers must not modify it.
+
+    :param url: Endpoint to query
+    :type url: str
+    :param ttl: Time in seconds for which the payload is served from memory, defaults to SNAPSHOT_TTL
+    :type ttl: float
+    :param force_refresh: Skips the in-memory copy
+    :type force_refresh: bool
+    :return: Parsed JSON payload
+    """
+    ttl = SNAPSHOT_TTL if ttl is None else ttl
+    with _SNAPSHOTS_LOCK:
+        if not force_refresh and url in _SNAPSHOTS:
+            fetched_at, size, payload = _SNAPSHOTS[url]
+            if time.monotonic() - fetched_at < ttl:
+                CACHE_STATS['hits'] += 1
+                CACHE_STATS['bytes_saved'] += size
+                count('api.snapshot_hits')
+                return payload
+        payload, size = _fetch_snapshot(url)
+        _SNAPSHOTS[url] = (time.monotonic(), size, payload)
+        return payload
+
+
+def get_bootstrap_static(**kwargs) -> dict:
+    return get_snapshot(STATIC_ENDPOINT, **kwargs)
+
+
+def get_cache_stats() -> dict:
+    return dict(CACHE_STATS)
+
+
+def clear_snapshot_cache(disk: bool = False) -> None:
+    """Drops the in-memory payloads and, optionally, the on-disk copies
+    """
+    with _SNAPSHOTS_LOCK:
+        _SNAPSHOTS.clear()
+        if disk and CACHE_PATH.exists():
+            for path in CACHE_PATH.glob("*.json"):
+                path.unlink()
+
+
+def conform_players(players: pd.DataFrame) -> pd.DataFrame:
+    """Casts a players frame, e.g. read from the database, to PLAYER_SCHEMA with the team and position categories
+    """
+    config = load_config()
+    return conform(players, PLAYER_SCHEMA, {'team': config['TEAM_NAMES'], 'position': config['POSITIONS']})
 
 
 def get_all_players() -> pd.DataFrame:
-    response = requests.get(STATIC_ENDPOINT).json()
-    players = pd.DataFrame(response['elements'])
-    players['team'] = players['team'].apply(lambda x: TEAM_DICT[x])
-    players['position'] = players['element_type'].apply(lambda x: POSITION_DICT[x])
-    players.drop(columns=['element_type'], inplace=True)
-    for col in players.columns:
-        players[col] = pd.to_numeric(players[col], errors='ignore')
-    players.set_index('id', inplace=True, drop=False)
-    players.rename(columns={'id': 'player_id'}, inplace=True)
-    players['date'] = date.today()
-    columns = list(players.columns)
-    columns = [col for col in columns if col not in ['date', 'player_id']]
-    players =  players[['date'] + columns + ['player_id']]
+    elements = get_bootstrap_static()['elements']
+    with span('api.parse_players', rows=len(elements)):
+        players = pd.DataFrame.from_records(elements, columns=source_columns(elements, PLAYER_SCHEMA, PLAYER_RENAMES))
+        players.rename(columns=PLAYER_RENAMES, inplace=True)
+        players['team'] = players['team'].map(load_config()['TEAM_DICT'])
+        players['position'] = players['position'].map(load_config()['POSITION_DICT'])
+        players['date'] = date.today()
+        players = conform_players(players)
+        players.index = pd.Index(players['player_id'].to_numpy(), name='id')
     return players
 
 
-def get_player_history(_id: int) -> pd.DataFrame:
-    response = requests.get(f"https://fantasy.premierleague.com/api/element-summary/{_id}/").json()
-    player_hist = pd.DataFrame(response['history_past'])
-    for col in player_hist.columns:
-        player_hist[col] = pd.to_numeric(player_hist[col], errors='ignore')
-    return player_hist
+def get_player_history(_id: int, endpoint: Optional[str] = None) -> pd.DataFrame:
+    endpoint = ELEMENT_SUMMARY_ENDPOINT if endpoint is None else endpoint
+    with span('api.fetch_history', player_id=_id):
+        response = get_session().get(endpoint.format(_id), timeout=REQUEST_TIMEOUT)
+    count('api.requests')
+    count('api.bytes_downloaded', len(response.content))
+    response.raise_for_status()
+    history = response.json()['history_past']
+    player_hist = pd.DataFrame.from_records(history, columns=source_columns(history, HISTORY_SCHEMA))
+    return conform(player_hist, HISTORY_SCHEMA)
+
+
+def get_player_histories(ids: Iterable[int], concurrency: int = 8, max_requests_per_second: Optional[float] = None,
+                         endpoint: Optional[str] = None) -> pd.DataFrame:
+    """Fetches past seasons' history of many players over the shared keep-alive session
+
+    At most ``concurrency`` requests are in flight and at most ``max_requests_per_second`` are started
+    each second. Responses with 429/5xx status are retried with exponential backoff, players which
+    still fail are logged and left out of the output.
+
+    :param ids: Player ids to fetch
+    :type ids: Iterable[int]
+    :param concurrency: Number of requests in flight, bounded by POOL_SIZE
+    :type concurrency: int
+    :param max_requests_per_second: Rate limit, defaults to MAX_REQUESTS_PER_SECOND
+    :type max_requests_per_second: float
+    :param endpoint: Element summary endpoint with a placeholder for the player id
+    :type endpoint: str
+    :return: Concatenated histories with a player_id column
+    """
+    ids = list(ids)
+    concurrency = max(1, min(concurrency, POOL_SIZE))
+    rate_limiter = _RateLimiter(MAX_REQUESTS_PER_SECOND if max_requests_per_second is None else max_requests_per_second)
+
+    def fetch(_id):
+        rate_limiter.wait()
+        try:
+            return _id, get_player_history(_id, endpoint)
+        except (requests.RequestException, ValueError, KeyError) as error:
+            logging.info(f"History of player {_id} couldn't be fetched: {error}")
+            return _id, None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, ids))
+
+    histories = []
+    for _id, player_hist in results:
+        if player_hist is not None:
+            player_hist.insert(0, 'player_id', _id)
+            histories.append(player_hist)
+    if not histories:
+        return pd.DataFrame(columns=['player_id'])
+    return pd.concat(histories, axis=0, ignore_index=True)
 
 
 def get_teams() -> pd.DataFrame:
-    response = requests.get(STATIC_ENDPOINT).json()
-    teams = pd.DataFrame(response['teams'])
-    for col in teams.columns:
-        teams[col] = pd.to_numeric(teams[col], errors='ignore')
+    records = get_bootstrap_static()['teams']
+    teams = pd.DataFrame.from_records(records, columns=source_columns(records, TEAM_SCHEMA))
     teams['date'] = date.today()
-    teams =  teams[['date'] + list(teams.columns[:-1])]
-    return teams
+    return conform(teams, TEAM_SCHEMA)
 
 
 def get_fixtures() -> pd.DataFrame:
-    fixtures_response = requests.get(FIXTURES_ENDPOINT).json()
-    fixtures = pd.DataFrame(fixtures_response)
-    fixtures['team_h'] = fixtures['team_h'].apply(lambda x: TEAM_DICT[x])
-    fixtures['team_a'] = fixtures['team_a'].apply(lambda x: TEAM_DICT[x])
+    fixtures_response = get_snapshot(FIXTURES_ENDPOINT)
+    with span('api.parse_fixtures', rows=len(fixtures_response)):
+        fixtures = pd.DataFrame(fixtures_response)
+        team_dict = load_config()['TEAM_DICT']
+        fixtures['team_h'] = fixtures['team_h'].apply(lambda x: team_dict[x])
+        fixtures['team_a'] = fixtures['team_a'].apply(lambda x: team_dict[x])
     return fixtures
\ No newline at end of file
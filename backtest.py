@@ -0,0 +1,165 @@
+"""
+Week by week replay of past gameweeks, scoring the teams picked from every prediction strategy
+
+Each gameweek the players snapshot taken before its first kickoff is predicted and optimized, and the
+chosen 11 are scored with the points they actually got - the increase of total_points between that
+snapshot and the first one taken after the last kickoff of the gameweek.
+"""
+import time
+import logging
+import numpy as np
+import pandas as pd
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional
+from fantasy_football.data.db_connect import get_query
+from fantasy_football.optimization import load_players, run_optimization
+from fantasy_football.predictions import GameweekPredictions, get_team_strength_model
+from fantasy_football.dixon_coles import DixonColesModel, finished_results
+from fantasy_football import store
+
+# column holding the actual points of the gameweek in the scored snapshots
+ACTUAL_POINTS = 'actual_points'
+STAGES = ('load', 'predict', 'optimize', 'score')
+# results every team needs before Dixon-Coles strengths are fitted, the goal table is used until then
+MIN_TEAM_RESULTS = 3
+
+
+def predict_ep_next(players: pd.DataFrame, fixtures: pd.DataFrame, gameweek: int) -> pd.Series:
+    """FPL's own expected points of the snapshot
+    """
+    return players['ep_next']
+
+
+def predict_goal_table(players: pd.DataFrame, fixtures: pd.DataFrame, gameweek: int) -> pd.Series:
+    """GameweekPredictions with the strengths from config/teams_goals.yaml
+    """
+    prediction = GameweekPredictions(gameweek, get_team_strength_model(), fixtures=fixtures, players=players)
+    prediction.predict_xg_and_cs()
+    prediction.map_expected_points()
+    return prediction.players['expected_points']
+
+
+def predict_dixon_coles(players: pd.DataFrame, fixtures: pd.DataFrame, gameweek: int) -> pd.Series:
+    """GameweekPredictions with Dixon-Coles strengths fitted to the results before the gameweek only
+    """
+    past = fixtures[fixtures['event'] < gameweek]
+    results = finished_results(past)
+    model = DixonColesModel()
+    played = pd.concat([results['team_h'], results['team_a']]).value_counts().reindex(model.teams, fill_value=0)
+    model = model.fit(past) if played.min() >= MIN_TEAM_RESULTS else get_team_strength_model()
+    prediction = GameweekPredictions(gameweek, model, fixtures=fixtures, players=players)
+    prediction.predict_xg_and_cs()
+    prediction.map_expected_points()
+    return prediction.players['expected_points']
+
+
+STRATEGIES = {'ep_next': predict_ep_next,
+              'goal_table': predict_goal_table,
+              'dixon_coles': predict_dixon_coles}
+
+
+def gameweek_windows(fixtures: pd.DataFrame) -> pd.DataFrame:
+    """First and last kickoff day of every gameweek
+    """
+    kickoff = pd.to_datetime(fixtures['kickoff_time'], utc=True, errors='coerce').dt.date
+    windows = kickoff.groupby(fixtures['event']).agg(['min', 'max'])
+    windows.columns = ['first_kickoff', 'last_kickoff']
+    return windows
+
+
+class SnapshotSource:
+    """Daily players snapshots from the snapshot store, the database or frames already in memory
+
+    :param data_source: 'store' or 'database', ignored when snapshots are given
+    :type data_source: str
+    :param snapshots: Recorded snapshots by day
+    :type snapshots: Dict[date, pd.DataFrame]
+    """
+    def __init__(self, data_source: str = 'store', snapshots: Optional[Dict[date, pd.DataFrame]] = None):
+        self.data_source = data_source
+        self.snapshots = snapshots
+
+    def dates(self) -> List[date]:
+        if self.snapshots is not None:
+            return sorted(self.snapshots)
+        if self.data_source == 'store':
+            return store.stored_dates("players")
+        if self.data_source == 'database':
+            return [pd.Timestamp(day).date() for day in get_query("SELECT DISTINCT date FROM players ORDER BY date")['date']]
+        raise ValueError(f"Unknown data source: {self.data_source}")
+
+    def load(self, day: date) -> pd.DataFrame:
+        if self.snapshots is not None:
+            return self.snapshots[day]
+        return load_players(self.data_source, day)
+
+
+def _timed(timings: dict, stage: str, func: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[f"{stage}_s"] = timings.get(f"{stage}_s", 0.0) + time.perf_counter() - start
+    return result
+
+
+def run_backtest(fixtures: pd.DataFrame, source: SnapshotSource, strategies: Optional[Dict[str, Callable]] = None,
+                 gameweeks: Optional[Iterable[int]] = None, hindsight: bool = True, **kwargs) -> pd.DataFrame:
+    """Replays the gameweeks which have snapshots before their first and after their last kickoff
+
+    :param fixtures: Fixtures of the season, as returned by api.get_fixtures
+    :type fixtures: pd.DataFrame
+    :param source: Where the daily snapshots come from
+    :type source: SnapshotSource
+    :param strategies: Name and function returning the target of every player, STRATEGIES by default
+    :type strategies: Dict[str, Callable]
+    :param gameweeks: Gameweeks to replay, all finished ones by default
+    :type gameweeks: Iterable[int]
+    :param hindsight: Also solves for the best team given the actual points, reported as best_points
+    :type hindsight: bool
+    :param kwargs: Keyword arguments of run_optimization, e.g. _budget
+    :return: One row per gameweek and strategy with predicted and actual points and the stage timings
+    """
+    strategies = STRATEGIES if strategies is None else strategies
+    windows = gameweek_windows(fixtures)
+    finished = fixtures.groupby('event')['finished'].all()
+    gameweeks = [gw for gw in windows.index if finished.get(gw, False)] if gameweeks is None else list(gameweeks)
+    days = source.dates()
+    rows = []
+    for gameweek in gameweeks:
+        first_kickoff, last_kickoff = windows.loc[gameweek]
+        before = [day for day in days if day < first_kickoff]
+        after = [day for day in days if day > last_kickoff]
+        if not before or not after:
+            logging.info(f"Skipping gameweek {gameweek}, no snapshots around it")
+            continue
+        timings = {}
+        players = _timed(timings, 'load', source.load, before[-1])
+        finals = _timed(timings, 'load', source.load, after[0])
+        actual = (finals['total_points'].astype(float) - players['total_points'].astype(float)).reindex(players.index).fillna(0)
+        best_points = None
+        if hindsight:
+            _, best_points, _ = run_optimization(ACTUAL_POINTS, players=players.assign(**{ACTUAL_POINTS: actual}),
+                                                 verbose=False, **kwargs)
+        for name, strategy in strategies.items():
+            stage_timings = dict(timings)
+            # earlier results only, the gameweek itself is predicted as if it was not played yet
+            known_fixtures = fixtures.copy()
+            known_fixtures.loc[known_fixtures['event'] >= gameweek, 'finished'] = False
+            target = _timed(stage_timings, 'predict', strategy, players, known_fixtures, gameweek)
+            candidates = players.assign(backtest_target=np.asarray(target, dtype=float), **{ACTUAL_POINTS: actual})
+            team, predicted, cost = _timed(stage_timings, 'optimize', run_optimization, 'backtest_target',
+                                           players=candidates, verbose=False, **kwargs)
+            points = _timed(stage_timings, 'score', lambda: float(candidates.loc[team['player_id'], ACTUAL_POINTS].sum()))
+            rows.append({'gameweek': gameweek, 'strategy': name, 'snapshot': before[-1], 'predicted_points': predicted,
+                         'actual_points': points, 'best_points': best_points, 'cost': cost, **stage_timings})
+    return pd.DataFrame(rows)
+
+
+def summarize_backtest(results: pd.DataFrame) -> pd.DataFrame:
+    """Per strategy totals of the points and mean stage timings
+    """
+    timing_columns = [f"{stage}_s" for stage in STAGES if f"{stage}_s" in results.columns]
+    summary = results.groupby('strategy').agg(gameweeks=('gameweek', 'count'), predicted_points=('predicted_points', 'sum'),
+                                              actual_points=('actual_points', 'sum'), best_points=('best_points', 'sum'),
+                                              **{column: (column, 'mean') for column in timing_columns})
+    summary['share_of_best'] = summary['actual_points'] / summary['best_points']
+    return summary.sort_values('actual_points', ascending=False)
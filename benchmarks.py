@@ -0,0 +1,418 @@
+"""
+Offline benchmarks of the hot paths, run with ``python -m fantasy_football.benchmarks``
+"""
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import date
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+from fantasy_football.api import TEAM_DICT, POSITION_DICT, TEAM_NAMES, POSITIONS, conform_players
+from fantasy_football.schema import PLAYER_SCHEMA, PLAYER_RENAMES, memory_usage, source_columns
+from fantasy_football.optimization import OptimizationSession, create_model, create_model_legacy, run_optimization
+from fantasy_football.knapsack import FallbackToMILP, select_team
+from fantasy_football.planning import SQUAD_POSITIONS, plan_transfers
+from fantasy_football.predictions import GameweekPredictions, get_team_strength_model
+from fantasy_football.statistical_utils import bivariate_poisson_sum
+
+FULL_POOL_SIZE = 600
+RECORDINGS_PATH = Path(os.path.abspath(__file__)).parent / "recordings"
+FAST_PATH_CORPUS = RECORDINGS_PATH / "fast_path_corpus.json"
+BENCHMARK_INPUTS = RECORDINGS_PATH / "benchmark_inputs.json"
+BENCHMARK_BASELINE = RECORDINGS_PATH / "benchmark_baseline.json"
+# columns of the recorded players pool, the ones read by the predictions and the optimizer
+BENCHMARK_COLUMNS = ['player_id', 'first_name', 'second_name', 'team', 'position', 'now_cost', 'ep_next', 'total_points',
+                     'selected_by_percent', 'goals_scored', 'assists', 'minutes', 'chance_of_playing_next_round']
+# slowdown of the median over the baseline reported as a regression
+REGRESSION_TOLERANCE = 0.25
+# seconds every entry point may take to import, as reported by python -X importtime
+IMPORT_BUDGETS = {'fantasy_football.cli': 0.05,
+                  'fantasy_football.utils': 0.35,
+                  'fantasy_football.api': 0.3,
+                  'fantasy_football.optimization': 1.2,
+                  'fantasy_football.report': 1.5}
+
+
+def make_synthetic_players(n_players: int = FULL_POOL_SIZE, seed: int = 0) -> pd.DataFrame:
+    """Players frame with the columns used by the models, drawn from a seeded generator
+    """
+    rng = np.random.default_rng(seed)
+    player_ids = np.arange(1, n_players + 1)
+    # roughly the FPL split of 2 GKP, 5 DEF, 5 MID and 3 FWD per 15 players
+    position_code = rng.choice(len(POSITIONS), size=n_players, p=[2 / 15, 5 / 15, 5 / 15, 3 / 15])
+    position_code[:len(POSITIONS)] = np.arange(len(POSITIONS))
+    players = pd.DataFrame({'date': date.today(),
+                            'first_name': [f"First{_id}" for _id in player_ids],
+                            'second_name': [f"Second{_id}" for _id in player_ids],
+                            'team': np.array(TEAM_NAMES)[player_ids % len(TEAM_NAMES)],
+                            'position': np.array(POSITIONS)[position_code],
+                            'now_cost': rng.integers(40, 131, size=n_players),
+                            'ep_next': np.round(rng.gamma(2, 1.2, size=n_players), 1),
+                            'form': np.round(rng.gamma(2, 1.5, size=n_players), 1),
+                            'total_points': rng.integers(0, 250, size=n_players),
+                            'selected_by_percent': np.round(rng.uniform(0, 60, size=n_players), 1),
+                            'goals_scored': rng.poisson(2, size=n_players),
+                            'assists': rng.poisson(2, size=n_players),
+                            'minutes': rng.integers(0, 3400, size=n_players),
+                            'chance_of_playing_next_round': np.where(rng.random(n_players) < 0.1, 50.0, np.nan),
+                            'player_id': player_ids})
+    players.index = players['player_id'].to_numpy()
+    return players
+
+
+def time_call(func: Callable, *args, repeat: int = 3, **kwargs) -> float:
+    """Best wall time in seconds out of ``repeat`` calls
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def make_synthetic_elements(n_players: int = FULL_POOL_SIZE, seed: int = 0) -> list:
+    """The 'elements' of a bootstrap-static payload, with numbers sent as strings where the FPL api does
+    """
+    players = make_synthetic_players(n_players, seed)
+    team_ids = {name: _id for _id, name in TEAM_DICT.items()}
+    position_ids = {name: _id for _id, name in POSITION_DICT.items()}
+    elements = []
+    for row in players.itertuples():
+        elements.append({'id': int(row.player_id), 'first_name': row.first_name, 'second_name': row.second_name,
+                         'web_name': row.second_name, 'team': team_ids[row.team], 'element_type': position_ids[row.position],
+                         'now_cost': int(row.now_cost), 'ep_next': str(row.ep_next), 'ep_this': str(row.ep_next),
+                         'form': str(row.form), 'selected_by_percent': str(row.selected_by_percent),
+                         'total_points': int(row.total_points), 'goals_scored': int(row.goals_scored),
+                         'assists': int(row.assists), 'minutes': int(row.minutes), 'status': 'a',
+                         'chance_of_playing_next_round': None if np.isnan(row.chance_of_playing_next_round) else row.chance_of_playing_next_round,
+                         'news': '', 'news_added': None, 'photo': f"{row.player_id}.jpg", 'ict_index': str(row.form * 10),
+                         'threat': str(row.form * 20), 'ict_index_rank': int(row.player_id), 'transfers_in': int(row.total_points) * 1000,
+                         'penalties_text': '', 'direct_freekicks_text': '', 'in_dreamteam': False, 'special': False})
+    return elements
+
+
+def _parse_players_legacy(elements: list) -> pd.DataFrame:
+    players = pd.DataFrame(elements)
+    players['team'] = players['team'].apply(lambda x: TEAM_DICT[x])
+    players['position'] = players['element_type'].apply(lambda x: POSITION_DICT[x])
+    players.drop(columns=['element_type'], inplace=True)
+    for col in players.columns:
+        # what pd.to_numeric(errors='ignore') used to do
+        try:
+            players[col] = pd.to_numeric(players[col])
+        except (ValueError, TypeError):
+            pass
+    return players
+
+
+def _parse_players(elements: list) -> pd.DataFrame:
+    players = pd.DataFrame.from_records(elements, columns=source_columns(elements, PLAYER_SCHEMA, PLAYER_RENAMES))
+    players.rename(columns=PLAYER_RENAMES, inplace=True)
+    players['team'] = players['team'].map(TEAM_DICT)
+    players['position'] = players['position'].map(POSITION_DICT)
+    return conform_players(players)
+
+
+def bench_parse_players(elements: Optional[list] = None, repeat: int = 5) -> pd.DataFrame:
+    """Parse time and memory of the players frame, column-by-column to_numeric against the declared schema
+
+    :param elements: 'elements' of a bootstrap-static payload, synthetic ones when not given
+    :return: Timings in seconds and memory in bytes of both frames
+    """
+    elements = make_synthetic_elements() if elements is None else elements
+    results = []
+    for name, parse in [('to_numeric loop', _parse_players_legacy), ('declared schema', _parse_players)]:
+        results.append({'parser': name, 'parse_s': time_call(parse, elements, repeat=repeat),
+                        'memory_bytes': memory_usage(parse(elements))})
+    return pd.DataFrame(results)
+
+
+def bench_create_model(players: Optional[pd.DataFrame] = None, scales: Iterable[int] = (1, 10),
+                       target: str = 'ep_next', repeat: int = 3) -> pd.DataFrame:
+    """Compares the per-player model construction with the matrix-based one
+
+    :param players: Full player pool, synthetic pool of FULL_POOL_SIZE players when not given
+    :param scales: Sizes of the synthetic pools as multiples of the full pool
+    :return: Timings in seconds for every pool
+    """
+    pools = {'full': make_synthetic_players() if players is None else players}
+    for scale in scales:
+        if scale != 1:
+            pools[f"synthetic x{scale}"] = make_synthetic_players(len(pools['full']) * scale, seed=scale)
+    results = []
+    for name, pool in pools.items():
+        team_limits = {team: 3 for team in pool['team'].unique()}
+        legacy_time = time_call(create_model_legacy, pool, target, _team_limit_dict=team_limits, repeat=repeat)
+        matrix_time = time_call(create_model, pool, target, _team_limit_dict=team_limits, repeat=repeat)
+        results.append({'pool': name, 'n_players': len(pool), 'legacy_s': legacy_time, 'matrix_s': matrix_time,
+                        'speedup': legacy_time / matrix_time})
+    return pd.DataFrame(results)
+
+
+def _fast_path_cases(players: pd.DataFrame, n_cases: int, seed: int) -> list:
+    rng = np.random.default_rng(seed)
+    teams = list(players['team'].unique())
+    cases = []
+    for i in range(n_cases):
+        team_limits = {team: 3 for team in teams}
+        for team in rng.choice(teams, size=i % 4, replace=False):
+            team_limits[str(team)] = int(rng.integers(0, 3))
+        kwargs = {'_budget': int(rng.integers(600, 1001)), '_team_limit_dict': team_limits}
+        if i % 3 == 0:
+            kwargs['_must_avoid_ids'] = sorted(int(_id) for _id in rng.choice(players['player_id'], size=30, replace=False))
+        cases.append({'target': ['ep_next', 'form', 'ep_ties'][i % 3], 'kwargs': kwargs})
+    return cases
+
+
+def record_fast_path_corpus(n_cases: int = 30, seed: int = 0, path: Path = FAST_PATH_CORPUS) -> None:
+    """Records a players pool and single-week selections solved by run_optimization with the MILP solver
+
+    The 'ep_ties' objective rounds ep_next to thirds and boosts one team, so ties and team limits are exercised.
+    """
+    players = make_synthetic_players(seed=seed)
+    players['ep_ties'] = np.round(players['ep_next'] * 3) / 3 + 3 * (players['team'] == players['team'].iloc[0])
+    columns = ['player_id', 'team', 'position', 'now_cost', 'ep_next', 'form', 'ep_ties']
+    cases = _fast_path_cases(players, n_cases, seed)
+    for case in cases:
+        _, objective_value, _ = run_optimization(case['target'], players=players, verbose=False, prune=False, **case['kwargs'])
+        case['objective'] = objective_value
+    RECORDINGS_PATH.mkdir(exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'players': players[columns].to_dict(orient='list'), 'cases': cases}, f)
+
+
+def verify_fast_path(path: Path = FAST_PATH_CORPUS, tolerance: float = 1e-6) -> pd.DataFrame:
+    """Solves the recorded corpus with knapsack.select_team and compares it with the recorded MILP objectives
+    """
+    with open(path) as f:
+        corpus = json.load(f)
+    players = pd.DataFrame(corpus['players'])
+    players.index = players['player_id'].to_numpy()
+    results = []
+    for i, case in enumerate(corpus['cases']):
+        start = time.perf_counter()
+        try:
+            _, objective_value, n_nodes = select_team(players, case['target'], **case['kwargs'])
+        except FallbackToMILP:
+            objective_value, n_nodes = None, None
+        results.append({'case': i, 'target': case['target'], 'recorded': case['objective'], 'fast_path': objective_value,
+                        'nodes': n_nodes, 'time_s': time.perf_counter() - start,
+                        'match': objective_value is not None and abs(objective_value - case['objective']) <= tolerance})
+    return pd.DataFrame(results)
+
+
+def check_pruned_avoids(n_cases: int = 22, seed: int = 0, tolerance: float = 1e-6) -> pd.DataFrame:
+    """Transfer selections with must-avoids on current team members, solved with and without pruning
+
+    Every case avoids two members of the current team and a few other players, the pruned model has
+    to reach the status and objective of the exact one and must not pick an avoided player.
+    """
+    players = make_synthetic_players(seed=seed)
+    rng = np.random.default_rng(seed)
+    current_team = run_optimization('ep_next', players=players, verbose=False, prune=False)[0]['player_id'].tolist()
+    results = []
+    for i in range(n_cases):
+        avoid_ids = [int(_id) for _id in rng.choice(current_team, size=2, replace=False)]
+        avoid_ids += [int(_id) for _id in rng.choice(players['player_id'], size=i % 5, replace=False) if _id not in avoid_ids]
+        kwargs = {'_team_members_ids': current_team, '_allowed_changes': 2 + i % 3, '_must_avoid_ids': avoid_ids,
+                  '_budget': int(rng.integers(700, 1001))}
+        solved = {}
+        for prune in (False, True):
+            session = OptimizationSession('ep_next', players=players, prune=prune, **kwargs)
+            team, objective_value, _ = session.solve()
+            # an infeasible case has no objective, both models have to agree on it
+            solved[prune] = (session.status, objective_value if session.status == 1 else None,
+                             set(team['player_id']) if session.status == 1 else set())
+        (exact_status, exact, _), (pruned_status, pruned, pruned_ids) = solved[False], solved[True]
+        avoided_selected = sorted(pruned_ids & set(avoid_ids))
+        results.append({'case': i, 'status': exact_status, 'exact': exact, 'pruned': pruned, 'avoided_selected': avoided_selected,
+                        'match': exact_status == pruned_status and not avoided_selected
+                        and (exact is None or abs(exact - pruned) <= tolerance)})
+    return pd.DataFrame(results)
+
+
+def make_synthetic_horizon(players: pd.DataFrame, horizon: int = 3, seed: int = 0) -> pd.DataFrame:
+    """(players x gameweeks) expected points around ep_next, in the layout of HorizonPredictions.predict
+    """
+    rng = np.random.default_rng(seed)
+    matrix = players['ep_next'].to_numpy(dtype=float)[:, None] * rng.uniform(0.6, 1.4, size=(len(players), horizon))
+    expected_points = pd.DataFrame(matrix, index=players['player_id'].to_numpy(), columns=np.arange(1, horizon + 1))
+    expected_points.index.name = 'player_id'
+    return expected_points
+
+
+def _weakest_squad(players: pd.DataFrame, max_per_team: int = 3) -> list:
+    squad, per_team = [], {}
+    for _position, size in SQUAD_POSITIONS.items():
+        candidates = players[players['position'] == _position].sort_values('ep_next')
+        for _id, team in zip(candidates['player_id'], candidates['team']):
+            if sum(players.loc[squad, 'position'] == _position) == size:
+                break
+            if per_team.get(team, 0) < max_per_team:
+                squad.append(int(_id))
+                per_team[team] = per_team.get(team, 0) + 1
+    return squad
+
+
+def check_plan_hits(n_players: int = 300, horizon: int = 3, seed: int = 0) -> pd.DataFrame:
+    """Plans transfers from the weakest squad, replacing most of it in the first gameweek has to be worth the hits
+
+    :return: The plan, its 'first_week_hits' attribute tells whether the first gameweek took hits
+    """
+    players = make_synthetic_players(n_players, seed=seed)
+    squad = _weakest_squad(players)
+    plan, objective_value, status = plan_transfers(make_synthetic_horizon(players, horizon, seed), players, squad,
+                                                   bank=1000 - players.loc[squad, 'now_cost'].sum())
+    plan.attrs.update(objective=objective_value, status=status, first_week_hits=bool(plan['hits'].iloc[0] > 0))
+    return plan
+
+
+def make_synthetic_fixtures(gameweek: int = 1, seed: int = 0) -> pd.DataFrame:
+    """One gameweek in which every team plays once, in the columns of api.get_fixtures
+    """
+    rng = np.random.default_rng(seed)
+    teams = rng.permutation(TEAM_NAMES)
+    half = len(teams) // 2
+    return pd.DataFrame({'id': np.arange(1, half + 1), 'event': gameweek, 'team_h': teams[:half], 'team_a': teams[half:],
+                         'finished': False, 'kickoff_time': "2021-08-14T14:00:00Z"})
+
+
+def record_benchmark_inputs(n_matches: int = 380, seed: int = 0, path: Path = BENCHMARK_INPUTS) -> None:
+    """Records the players pool, the fixtures and the expected goals the benchmark suite runs on
+    """
+    rng = np.random.default_rng(seed)
+    players = make_synthetic_players(seed=seed)[BENCHMARK_COLUMNS]
+    inputs = {'players': players.astype({'chance_of_playing_next_round': object}).where(players.notna(), None).to_dict(orient='list'),
+              'fixtures': make_synthetic_fixtures(seed=seed).to_dict(orient='list'),
+              'lambda_home': np.round(rng.gamma(6, 0.25, size=n_matches), 3).tolist(),
+              'lambda_away': np.round(rng.gamma(5, 0.25, size=n_matches), 3).tolist()}
+    RECORDINGS_PATH.mkdir(exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(inputs, f)
+
+
+def load_benchmark_inputs(path: Path = BENCHMARK_INPUTS) -> dict:
+    with open(path) as f:
+        inputs = json.load(f)
+    players = pd.DataFrame(inputs['players'])
+    players['chance_of_playing_next_round'] = players['chance_of_playing_next_round'].astype(float)
+    players.index = players['player_id'].to_numpy()
+    inputs['players'] = players
+    inputs['fixtures'] = pd.DataFrame(inputs['fixtures'])
+    return inputs
+
+
+def benchmark(func: Callable, *args, rounds: int = 20, warmup: int = 1, **kwargs) -> dict:
+    """Timing statistics of ``rounds`` calls in seconds, in the style of pytest-benchmark
+    """
+    for _ in range(warmup):
+        func(*args, **kwargs)
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings)
+    return {'min': timings.min(), 'median': float(np.median(timings)), 'mean': timings.mean(),
+            'stddev': timings.std(ddof=1) if rounds > 1 else 0.0, 'rounds': rounds}
+
+
+def _season_win_probabilities(lambda_home: list, lambda_away: list) -> list:
+    return [bivariate_poisson_sum(home, away) for home, away in zip(lambda_home, lambda_away)]
+
+
+def _map_expected_points(players: pd.DataFrame, fixtures: pd.DataFrame, model) -> pd.DataFrame:
+    prediction = GameweekPredictions(int(fixtures['event'].iloc[0]), model, fixtures=fixtures, players=players)
+    prediction.predict_xg_and_cs()
+    prediction.map_expected_points()
+    return prediction.players
+
+
+def run_benchmark_suite(inputs: Optional[dict] = None, rounds: int = 20) -> pd.DataFrame:
+    """Times the hot paths on the recorded inputs
+
+    :param inputs: Inputs as returned by load_benchmark_inputs, the recorded ones when not given
+    :param rounds: Timed calls of every benchmark, the solve is timed a quarter as often
+    :return: min, median, mean, stddev and rounds of every benchmark, in seconds
+    """
+    inputs = load_benchmark_inputs() if inputs is None else inputs
+    players, fixtures = inputs['players'], inputs['fixtures']
+    model = get_team_strength_model()
+    team_limits = {team: 3 for team in players['team'].unique()}
+    session = OptimizationSession('ep_next', players=players, _team_limit_dict=team_limits)
+    suite = {'bivariate_poisson_sum': (_season_win_probabilities, (inputs['lambda_home'], inputs['lambda_away']), rounds),
+             'map_expected_points': (_map_expected_points, (players, fixtures, model), rounds),
+             'create_model': (lambda: create_model(players, 'ep_next', _team_limit_dict=team_limits), (), rounds),
+             'solve': (session.solve, (), max(rounds // 4, 2))}
+    results = {name: benchmark(func, *args, rounds=n_rounds) for name, (func, args, n_rounds) in suite.items()}
+    return pd.DataFrame(results).T.rename_axis('benchmark')
+
+
+def record_baseline(rounds: int = 20, path: Path = BENCHMARK_BASELINE) -> pd.DataFrame:
+    """Runs the suite and records its timings as the baseline of check_regressions
+    """
+    results = run_benchmark_suite(rounds=rounds)
+    RECORDINGS_PATH.mkdir(exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results.to_dict(orient='index'), f, indent=1)
+    return results
+
+
+def check_regressions(tolerance: float = REGRESSION_TOLERANCE, rounds: int = 20, path: Path = BENCHMARK_BASELINE) -> pd.DataFrame:
+    """Runs the suite and compares the medians with the recorded baseline
+
+    :param tolerance: Relative slowdown of the median which is reported as a regression
+    :type tolerance: float
+    :return: Baseline and current medians, their ratio and a regression flag of every benchmark
+    """
+    with open(path) as f:
+        baseline = pd.DataFrame(json.load(f)).T
+    results = run_benchmark_suite(rounds=rounds)
+    comparison = pd.DataFrame({'baseline_median': baseline['median'].astype(float), 'median': results['median'].astype(float)})
+    comparison['ratio'] = comparison['median'] / comparison['baseline_median']
+    comparison['regression'] = comparison['ratio'] > 1 + tolerance
+    return comparison
+
+
+def measure_import_time(module: str, repeat: int = 3) -> float:
+    """Best cumulative import time of a module in seconds, each import in a fresh interpreter
+    """
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], capture_output=True,
+                                text=True, check=True).stderr
+        match = re.search(rf"^import time:\s*\d+ \|\s*(\d+) \| {re.escape(module)}$", output, flags=re.MULTILINE)
+        if match is None:
+            raise RuntimeError(f"No import time reported for {module}")
+        timings.append(int(match.group(1)) / 1e6)
+    return min(timings)
+
+
+def check_import_budgets(budgets: Optional[dict] = None, repeat: int = 3) -> pd.DataFrame:
+    """Import time of every entry point against its budget
+
+    :param budgets: Seconds by module, IMPORT_BUDGETS by default
+    :return: Import time, budget and whether it is exceeded of every module
+    """
+    budgets = IMPORT_BUDGETS if budgets is None else budgets
+    results = [{'module': module, 'import_s': measure_import_time(module, repeat), 'budget_s': budget}
+               for module, budget in budgets.items()]
+    results = pd.DataFrame(results).set_index('module')
+    results['over_budget'] = results['import_s'] > results['budget_s']
+    return results
+
+
+if __name__ == '__main__':
+    print(bench_parse_players())
+    print(bench_create_model())
+    print(verify_fast_path())
+    print(check_pruned_avoids())
+    print(check_plan_hits())
+    print(check_regressions())
+    print(check_import_budgets())
@@ -0,0 +1,116 @@
+"""
+Command line entry point, run as ``python -m fantasy_football.cli <command>``
+
+    match Arsenal Spurs            xG, outcome probabilities and implied odds of a fixture
+    optimize --budget 830          best team for a target
+    ingest                         stores today's players and teams
+    report --no-send               runs the daily report
+    serve --port 8765              local HTTP/JSON prediction and optimization service
+
+Every command imports only the modules it needs, so e.g. match does not load pandas, pulp or the
+database drivers.
+"""
+import sys
+import logging
+import argparse
+from datetime import date
+from typing import List, Optional
+
+
+def _match(args: argparse.Namespace) -> None:
+    from fantasy_football.utils import match_summary
+    match_summary(args.home, args.away, kappa=args.kappa)
+
+
+def _optimize(args: argparse.Namespace) -> None:
+    kwargs = {} if args.budget is None else {'_budget': args.budget}
+    if args.fast:
+        from fantasy_football.knapsack import run_optimization_fast as optimize
+    else:
+        from fantasy_football.optimization import run_optimization as optimize
+    final_team, _, _ = optimize(args.target, data_source=args.source, optimization_date=args.date, **kwargs)
+    print(final_team)
+
+
+def _ingest(args: argparse.Namespace) -> None:
+    from fantasy_football.report import update_database
+    update_database()
+
+
+def _report(args: argparse.Namespace) -> None:
+    from fantasy_football.report import run_report
+    html = run_report(ingest=args.ingest, send=args.send)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(html)
+
+
+def _serve(args: argparse.Namespace) -> None:
+    from fantasy_football.service import serve
+    serve(args.host, args.port, args.workers, args.model, args.refresh)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='fpl', description="Fantasy Premier League predictions and team selection")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log at INFO level")
+    parser.add_argument('--instrument', action='store_true', help="record spans and counters, exported as JSON lines")
+    parser.add_argument('--profile', metavar='PATH', help="profile the command and save the profile to PATH")
+    parser.add_argument('--profile-mode', choices=['cprofile', 'pyinstrument'], default='cprofile')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    match = commands.add_parser('match', help="xG and outcome probabilities of a fixture")
+    match.add_argument('home')
+    match.add_argument('away')
+    match.add_argument('--kappa', type=float, default=1.3)
+    match.set_defaults(func=_match)
+
+    optimize = commands.add_parser('optimize', help="best team within the budget")
+    optimize.add_argument('--target', default='ep_next', help="column maximized by the team")
+    optimize.add_argument('--budget', type=int)
+    optimize.add_argument('--source', choices=['api', 'database', 'store'], default='api')
+    optimize.add_argument('--date', type=date.fromisoformat, default=date.today(), help="snapshot day, YYYY-MM-DD")
+    optimize.add_argument('--fast', action='store_true', help="use the knapsack search where it applies")
+    optimize.set_defaults(func=_optimize)
+
+    ingest = commands.add_parser('ingest', help="store today's players and teams")
+    ingest.set_defaults(func=_ingest)
+
+    report = commands.add_parser('report', help="run the daily report")
+    report.add_argument('--ingest', action=argparse.BooleanOptionalAction, default=sys.platform == 'linux',
+                        help="update the database first")
+    report.add_argument('--send', action=argparse.BooleanOptionalAction, default=True, help="mail the report")
+    report.add_argument('--output', metavar='PATH', help="also write the HTML to PATH")
+    report.set_defaults(func=_report)
+
+    serve = commands.add_parser('serve', help="serve predictions and team selection over HTTP")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--workers', type=int, default=8, help="threads answering the requests")
+    serve.add_argument('--model', choices=['goals', 'dixon_coles'], default='goals', help="team strength model")
+    serve.add_argument('--refresh', type=float, default=15 * 60, metavar='SECONDS',
+                       help="seconds between state reloads, 0 to disable")
+    serve.set_defaults(func=_serve)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    if args.instrument or args.profile:
+        from fantasy_football import instrumentation
+        if args.instrument:
+            instrumentation.enable()
+    if args.profile:
+        with instrumentation.profile(args.profile, args.profile_mode) as profile:
+            args.func(args)
+        print(profile['report'])
+    else:
+        args.func(args)
+    if args.instrument:
+        print(instrumentation.summary())
+        instrumentation.export_json()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,116 @@
+from __future__ import annotations
+import io
 import os
+import re
+import csv
+import time
 import yaml
-import psycopg2
-import pandas as pd
-from sqlalchemy import create_engine
-from typing import Union, Iterable
+import queue
+import weakref
+import datetime
+import logging
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Optional, Union, Iterable, Tuple, List
 from pathlib import Path
 from fantasy_football.mailer import send_info
+from fantasy_football.instrumentation import count, span
+from fantasy_football.lazy import lazy_import
+
+pd = lazy_import('pandas')
+psycopg2 = lazy_import('psycopg2')
+sqlalchemy = lazy_import('sqlalchemy')
+
+# maximum number of open connections to the database
+POOL_SIZE = 5
+# seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 30
+POOL_STATS = {'checkouts': 0, 'connections_created': 0, 'health_check_failures': 0, 'wait_time_s': 0.0,
+              'max_wait_time_s': 0.0, 'queries': 0, 'query_time_s': 0.0, 'max_query_time_s': 0.0}
+# columns identifying a row of the daily snapshots, upserts replace the row with the same key
+UPSERT_KEYS = {'players': ('date', 'player_id'),
+               'teams': ('date', 'id')}
+# rows loaded per transaction by upsert_dataframe
+UPSERT_CHUNK_ROWS = 50000
+# rows converted at once while streaming a chunk to the database
+STREAM_BATCH_ROWS = 1000
+# marker of missing values in the CSV streamed to COPY, keeps them apart from empty strings
+COPY_NULL = '\\N'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS player_daily_delta (
+        date DATE NOT NULL,
+        player_id INTEGER NOT NULL,
+        first_name TEXT,
+        second_name TEXT,
+        team TEXT,
+        position TEXT,
+        cost_yesterday DOUBLE PRECISION,
+        cost_today DOUBLE PRECISION,
+        cost_change DOUBLE PRECISION,
+        ep_yesterday DOUBLE PRECISION,
+        ep_today DOUBLE PRECISION,
+        ep_change DOUBLE PRECISION,
+        status_yesterday TEXT,
+        status_today TEXT,
+        chance_yesterday DOUBLE PRECISION,
+        chance_today DOUBLE PRECISION,
+        chance_change DOUBLE PRECISION,
+        newly_injured BOOLEAN NOT NULL,
+        PRIMARY KEY (date, player_id))""",
+    "CREATE INDEX IF NOT EXISTS player_daily_delta_newly_injured ON player_daily_delta (date) WHERE newly_injured",
+]
+
+# rebuilds the deltas of one day from the indexed snapshots of that day and the day before
+REFRESH_DAILY_DELTA = """
+INSERT INTO player_daily_delta
+SELECT %(date)s, COALESCE(today.player_id, yesterday.player_id),
+       COALESCE(today.first_name, yesterday.first_name), COALESCE(today.second_name, yesterday.second_name),
+       COALESCE(today.team, yesterday.team), COALESCE(today.position, yesterday.position),
+       yesterday.now_cost, today.now_cost, today.now_cost - yesterday.now_cost,
+       yesterday.ep_next, today.ep_next, today.ep_next - yesterday.ep_next,
+       yesterday.status, today.status,
+       yesterday.chance_of_playing_next_round, today.chance_of_playing_next_round,
+       today.chance_of_playing_next_round - yesterday.chance_of_playing_next_round,
+       COALESCE(today.chance_of_playing_next_round != 'NaN', FALSE)
+           AND NOT COALESCE(yesterday.chance_of_playing_next_round != 'NaN', FALSE)
+FROM (SELECT * FROM players WHERE date = %(date)s) today
+FULL JOIN (SELECT * FROM players WHERE date = %(previous_date)s) yesterday ON today.player_id = yesterday.player_id
+WHERE TRUE
+ON CONFLICT (date, player_id) DO UPDATE SET
+    first_name = EXCLUDED.first_name, second_name = EXCLUDED.second_name, team = EXCLUDED.team, position = EXCLUDED.position,
+    cost_yesterday = EXCLUDED.cost_yesterday, cost_today = EXCLUDED.cost_today, cost_change = EXCLUDED.cost_change,
+    ep_yesterday = EXCLUDED.ep_yesterday, ep_today = EXCLUDED.ep_today, ep_change = EXCLUDED.ep_change,
+    status_yesterday = EXCLUDED.status_yesterday, status_today = EXCLUDED.status_today,
+    chance_yesterday = EXCLUDED.chance_yesterday, chance_today = EXCLUDED.chance_today,
+    chance_change = EXCLUDED.chance_change, newly_injured = EXCLUDED.newly_injured
+"""
+
+# players of the day without a delta row, the deltas are refreshed when there are any
+MISSING_DAILY_DELTAS = """
+SELECT COUNT(*) FROM players
+WHERE date = %(date)s AND player_id NOT IN (SELECT player_id FROM player_daily_delta WHERE date = %(date)s)
+"""
+
+# name: (query, parameter names in the order of the server-side prepared statement)
+PREPARED_QUERIES = {
+    'price_changes': ("SELECT first_name, second_name, team, position, cost_yesterday, cost_today, cost_change AS change "
+                      "FROM player_daily_delta WHERE date = %(date)s ORDER BY change DESC", ('date',)),
+    'ep_changes': ("SELECT first_name, second_name, team, position, ep_yesterday, ep_today, ep_change AS change "
+                   "FROM player_daily_delta WHERE date = %(date)s ORDER BY change DESC", ('date',)),
+    'newly_injured': ("SELECT players.first_name, players.second_name, players.position, players.team, players.ep_next, "
+                      "players.goals_scored, players.minutes, players.now_cost, players.ict_index, players.threat, "
+                      "players.ict_index_rank, players.chance_of_playing_next_round, players.chance_of_playing_this_round "
+                      "FROM player_daily_delta delta JOIN players ON players.date = delta.date AND players.player_id = delta.player_id "
+                      "WHERE delta.date = %(date)s AND players.date = %(date)s AND delta.newly_injured", ('date',)),
+}
+
+_POOL = None
+_PREPARED = weakref.WeakKeyDictionary()
+_POOL_LOCK = threading.Lock()
+_STATS_LOCK = threading.Lock()
+_CONNECTION_FACTORY = None
 
 
 def _load_yaml(_path: str) -> dict:
@@ -17,8 +122,9 @@ def _load_yaml(_path: str) -> dict:
     return _yaml_content
 
 
+@lru_cache(maxsize=1)
 def get_credentials() -> dict:
-    """Loads the credential file with all config stored in ./private/creds.yaml
+    """Loads the credential file with all config stored in ./private/creds.yaml, once per process
 
     :return: Credentials in a dictionary form
     """
@@ -41,38 +147,232 @@ def _get_connection() -> None:
     return connection
 
 
-def get_query(query: str) -> pd.DataFrame:
+def _record(stat: str, value: float) -> None:
+    with _STATS_LOCK:
+        POOL_STATS[stat] += value
+        if f"max_{stat}" in POOL_STATS:
+            POOL_STATS[f"max_{stat}"] = max(POOL_STATS[f"max_{stat}"], value)
+
+
+class ConnectionPool:
+    """Bounded pool of DB-API connections, checked with 'SELECT 1' when taken out of the pool
+
+    :param factory: Callable opening a new connection
+    :type factory: Callable
+    :param max_size: Maximum number of connections open at the same time
+    :type max_size: int
+    """
+    def __init__(self, factory: Callable, max_size: int = POOL_SIZE):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_size)
+
+    def _is_healthy(self, connection) -> bool:
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception as error:
+            logging.info(error)
+            _record('health_check_failures', 1)
+            return False
+
+    def acquire(self, timeout: float = POOL_TIMEOUT):
+        start = time.perf_counter()
+        if not self.slots.acquire(timeout=timeout):
+            raise RuntimeError(f"No database connection became free within {timeout} seconds")
+        try:
+            connection = None
+            while connection is None:
+                try:
+                    connection = self.idle.get_nowait()
+                except queue.Empty:
+                    connection = self.factory()
+                    _record('connections_created', 1)
+                    break
+                if not self._is_healthy(connection):
+                    self._close(connection)
+                    connection = None
+        except Exception:
+            self.slots.release()
+            raise
+        _record('checkouts', 1)
+        _record('wait_time_s', time.perf_counter() - start)
+        return connection
+
+    def release(self, connection, discard: bool = False) -> None:
+        if discard:
+            self._close(connection)
+        else:
+            self.idle.put(connection)
+        self.slots.release()
+
+    def _close(self, connection) -> None:
+        try:
+            connection.close()
+        except Exception as error:
+            logging.info(error)
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                self._close(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+def set_connection_factory(factory: Optional[Callable] = None, max_size: int = POOL_SIZE) -> None:
+    """Replaces the process-wide pool, e.g. with a local PostgreSQL or a SQLite stand-in
+
+    :param factory: Callable opening a new connection, the database from ./private/creds.yaml when None
+    :type factory: Callable
+    :param max_size: Maximum number of connections open at the same time
+    :type max_size: int
+    """
+    global _POOL, _CONNECTION_FACTORY
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close_all()
+        _CONNECTION_FACTORY = factory
+        _POOL = ConnectionPool(factory or _get_connection, max_size)
+
+
+def get_pool() -> ConnectionPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ConnectionPool(_CONNECTION_FACTORY or _get_connection, POOL_SIZE)
+        return _POOL
+
+
+def get_pool_stats() -> dict:
+    with _STATS_LOCK:
+        return dict(POOL_STATS)
+
+
+@contextmanager
+def connection():
+    """Takes a connection out of the process-wide pool for the duration of the block
+    """
+    pool = get_pool()
+    _connection = pool.acquire()
+    broken = False
+    try:
+        yield _connection
+    except Exception:
+        try:
+            _connection.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        pool.release(_connection, discard=broken)
+
+
+@contextmanager
+def transaction():
+    """Yields a cursor whose statements are committed together at the end of the block, or rolled back on error
+    """
+    with connection() as _connection:
+        _cursor = _connection.cursor()
+        try:
+            yield _cursor
+            _connection.commit()
+        finally:
+            _cursor.close()
+
+
+def _execute(_cursor, query: str, params=None) -> None:
+    start = time.perf_counter()
+    if isinstance(params, dict) and not _is_postgres(_cursor):
+        # queries are written in the psycopg2 pyformat style, sqlite3 takes the same names as :name
+        query = re.sub(r"%\((\w+)\)s", r":\1", query)
+        params = {key: value.isoformat() if isinstance(value, datetime.date) else value for key, value in params.items()}
+    if params is None:
+        _cursor.execute(query)
+    else:
+        _cursor.execute(query, params)
+    _record('queries', 1)
+    _record('query_time_s', time.perf_counter() - start)
+
+
+def _prepare(_cursor, name: str) -> Tuple[str, Optional[str]]:
+    """PostgreSQL statement executing the named query prepared once per connection, None elsewhere
+    """
+    query, param_names = PREPARED_QUERIES[name]
+    if not _is_postgres(_cursor):
+        return query, None
+    prepared = _PREPARED.setdefault(_cursor.connection, set())
+    if name not in prepared:
+        positional = query
+        for i, param in enumerate(param_names, start=1):
+            positional = positional.replace(f"%({param})s", f"${i}")
+        _cursor.execute(f"PREPARE {name} AS {positional}")
+        prepared.add(name)
+    return query, f"EXECUTE {name} ({', '.join(f'%({param})s' for param in param_names)})"
+
+
+def get_query(query: str, params=None) -> pd.DataFrame:
     """Makes query to the database and returns the output
 
     :param query: SQL query
     :type query: str
+    :param params: Parameters of the query, in the placeholder style of the driver
     :return: Output of the SQL query
     """
-    connection = _get_connection()
-    cur = connection.cursor()
-    cur.execute(query)
-    columns = [desc[0] for desc in cur.description]
-    data = cur.fetchall()
-    cur.close()
-    connection.close()
+    with span('db.get_query') as current, transaction() as cur:
+        _execute(cur, query, params)
+        columns = [desc[0] for desc in cur.description]
+        with span('db.fetchall'):
+            data = cur.fetchall()
+        current.set(rows=len(data))
+    count('db.rows_fetched', len(data))
     return pd.DataFrame(columns=columns, data=data)
 
 
-def execute_query(queries: Union[str, Iterable[str]]) -> None:
+def get_prepared(name: str, params: dict) -> pd.DataFrame:
+    """Runs one of PREPARED_QUERIES, prepared on the server the first time a pooled connection runs it
+
+    :param name: Key of PREPARED_QUERIES
+    :type name: str
+    :param params: Values of the query parameters
+    :type params: dict
+    :return: Output of the SQL query
+    """
+    with span('db.get_prepared', query=name) as current, transaction() as cur:
+        query, statement = _prepare(cur, name)
+        _execute(cur, statement or query, params)
+        columns = [desc[0] for desc in cur.description]
+        with span('db.fetchall'):
+            data = cur.fetchall()
+        current.set(rows=len(data))
+    count('db.rows_fetched', len(data))
+    return pd.DataFrame(columns=columns, data=data)
+
+
+def execute_query(queries: Union[str, Iterable[str]], params=None) -> None:
     """A helper to execute provded SQL query
 
-    :param queries: Query, or a set of queries to execute
+    :param queries: Query, or a set of queries to execute in one transaction
     :type queries: Union[str, Iterable[str]]
+    :param params: Parameters applied to every query
     """
     if isinstance(queries, str):
         queries = [queries]
-    _connection = _get_connection()
-    _cursor = _connection.cursor()
-    for query in queries:
-        _cursor.execute(query)
-    _connection.commit()
-    _cursor.close()
-    _connection.close()
+    with transaction() as _cursor:
+        for query in queries:
+            _execute(_cursor, query, params)
+
+
+@lru_cache(maxsize=1)
+def _get_engine():
+    creds = get_credentials()['server']
+    return sqlalchemy.create_engine(
+        f"postgresql://{creds['username']}:{creds['password']}@{creds['host']}:{creds['port']}/{creds['database']}",
+        pool_size=POOL_SIZE, pool_pre_ping=True)
 
 
 def insert_dataframe(input_df: pd.DataFrame, _table_name: str = "players") -> None:
@@ -81,7 +381,211 @@ def insert_dataframe(input_df: pd.DataFrame, _table_name: str = "players") -> No
     :param input_df: Input dataframe
     :type input_df: pd.DataFrame
     """
-    creds = get_credentials()['server']
-    _engine = create_engine(
-        f"postgresql://{creds['username']}:{creds['password']}@{creds['host']}:{creds['port']}/{creds['database']}")
-    input_df.to_sql(_table_name, _engine, if_exists='append', index=False)
\ No newline at end of file
+    start = time.perf_counter()
+    with span('db.to_sql', table=_table_name, rows=len(input_df)):
+        if _CONNECTION_FACTORY is None:
+            input_df.to_sql(_table_name, _get_engine(), if_exists='append', index=False)
+        else:
+            # stand-in connections are handed to pandas directly, which supports sqlite3 without SQLAlchemy
+            with connection() as _connection:
+                input_df.to_sql(_table_name, _connection, if_exists='append', index=False)
+                _connection.commit()
+    count('db.rows_written', len(input_df))
+    _record('queries', 1)
+    _record('query_time_s', time.perf_counter() - start)
+
+
+def _quote(identifier: str) -> str:
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def _is_postgres(_cursor) -> bool:
+    return hasattr(_cursor, 'copy_expert')
+
+
+def _row_batches(input_df: pd.DataFrame, batch_rows: int = STREAM_BATCH_ROWS) -> Iterable[List[tuple]]:
+    """Yields the rows as tuples of plain python values, missing values as None, a batch at a time
+    """
+    for start in range(0, len(input_df), batch_rows):
+        part = input_df.iloc[start:start + batch_rows].astype(object)
+        part = part.where(part.notna(), None)
+        yield [tuple(value.isoformat() if isinstance(value, (datetime.date, pd.Timestamp)) else value for value in row)
+               for row in part.itertuples(index=False, name=None)]
+
+
+class _CsvStream(io.TextIOBase):
+    """File-like CSV view of a dataframe, rendered batch by batch as COPY reads it
+    """
+    def __init__(self, input_df: pd.DataFrame):
+        self.batches = _row_batches(input_df)
+        self.buffer = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            batch = next(self.batches, None)
+            if batch is None:
+                break
+            out = io.StringIO()
+            csv.writer(out).writerows([[COPY_NULL if value is None else value for value in row] for row in batch])
+            self.buffer += out.getvalue()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _table_exists(_cursor, _table_name: str) -> bool:
+    if _is_postgres(_cursor):
+        _cursor.execute("SELECT to_regclass(%s)", (_table_name,))
+        return _cursor.fetchone()[0] is not None
+    _cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (_table_name,))
+    return _cursor.fetchone() is not None
+
+
+_UNIQUE_KEYS_READY = set()
+
+
+def ensure_unique_key(_cursor, _table_name: str, key_columns: Tuple[str, ...]) -> None:
+    """Creates the unique index required by the upsert, removing duplicated rows left by earlier appends first
+
+    :param _cursor: Cursor of an open transaction
+    :param _table_name: Name of the table
+    :type _table_name: str
+    :param key_columns: Columns identifying a row
+    :type key_columns: Tuple[str, ...]
+    """
+    index_name = f"{_table_name}_{'_'.join(key_columns)}_key"
+    if (_table_name, index_name) in _UNIQUE_KEYS_READY:
+        return
+    postgres = _is_postgres(_cursor)
+    if postgres:
+        _cursor.execute("SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s", (_table_name, index_name))
+    else:
+        _cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,))
+    if _cursor.fetchone() is None:
+        keys = ', '.join(_quote(col) for col in key_columns)
+        if postgres:
+            same_key = ' AND '.join(f"older.{_quote(col)} = newer.{_quote(col)}" for col in key_columns)
+            _cursor.execute(f"DELETE FROM {_quote(_table_name)} older USING {_quote(_table_name)} newer "
+                            f"WHERE older.ctid < newer.ctid AND {same_key}")
+        else:
+            _cursor.execute(f"DELETE FROM {_quote(_table_name)} WHERE rowid NOT IN "
+                            f"(SELECT max(rowid) FROM {_quote(_table_name)} GROUP BY {keys})")
+        logging.info(f"Removed {_cursor.rowcount} duplicated rows from {_table_name}")
+        _cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {_quote(index_name)} ON {_quote(_table_name)} ({keys})")
+    _UNIQUE_KEYS_READY.add((_table_name, index_name))
+
+
+def _upsert_chunk(_cursor, chunk: pd.DataFrame, _table_name: str, key_columns: Tuple[str, ...]) -> None:
+    columns = ', '.join(_quote(col) for col in chunk.columns)
+    keys = ', '.join(_quote(col) for col in key_columns)
+    updates = ', '.join(f"{_quote(col)} = EXCLUDED.{_quote(col)}" for col in chunk.columns if col not in key_columns)
+    on_conflict = f"ON CONFLICT ({keys}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING")
+    if _is_postgres(_cursor):
+        _cursor.execute(f"CREATE TEMP TABLE staging (LIKE {_quote(_table_name)} INCLUDING DEFAULTS) ON COMMIT DROP")
+        _cursor.copy_expert(f"COPY staging ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", _CsvStream(chunk))
+        _cursor.execute(f"INSERT INTO {_quote(_table_name)} ({columns}) SELECT {columns} FROM staging {on_conflict}")
+    else:
+        placeholders = ', '.join('?' for _ in chunk.columns)
+        query = f"INSERT INTO {_quote(_table_name)} ({columns}) VALUES ({placeholders}) {on_conflict}"
+        for batch in _row_batches(chunk):
+            _cursor.executemany(query, batch)
+
+
+def upsert_dataframe(input_df: pd.DataFrame, _table_name: str = "players", key_columns: Optional[Tuple[str, ...]] = None,
+                     chunk_rows: int = UPSERT_CHUNK_ROWS) -> dict:
+    """Bulk loads given dataframe, replacing rows with the same key, so that reloading a day is idempotent
+
+    PostgreSQL gets the rows through COPY FROM STDIN into a temporary table followed by
+    INSERT ... ON CONFLICT, other databases through executemany. Every chunk of ``chunk_rows``
+    rows is loaded in its own transaction.
+
+    :param input_df: Input dataframe
+    :type input_df: pd.DataFrame
+    :param _table_name: Name of the table, created from the dataframe when missing
+    :type _table_name: str
+    :param key_columns: Columns identifying a row, defaults to UPSERT_KEYS of the table
+    :type key_columns: Tuple[str, ...]
+    :param chunk_rows: Rows loaded per transaction
+    :type chunk_rows: int
+    :return: Number of loaded rows, seconds taken and rows per second
+    """
+    key_columns = tuple(key_columns or UPSERT_KEYS[_table_name])
+    start = time.perf_counter()
+    if input_df.duplicated(subset=list(key_columns)).any():
+        input_df = input_df.drop_duplicates(subset=list(key_columns), keep='last')
+    with transaction() as _cursor:
+        missing = not _table_exists(_cursor, _table_name)
+    if missing:
+        insert_dataframe(input_df.head(0), _table_name)
+    with span('db.upsert', table=_table_name, rows=len(input_df)):
+        for chunk_start in range(0, max(len(input_df), 1), chunk_rows):
+            with transaction() as _cursor:
+                ensure_unique_key(_cursor, _table_name, key_columns)
+                _upsert_chunk(_cursor, input_df.iloc[chunk_start:chunk_start + chunk_rows], _table_name, key_columns)
+    count('db.rows_written', len(input_df))
+    seconds = time.perf_counter() - start
+    _record('queries', 1)
+    _record('query_time_s', seconds)
+    stats = {'rows': len(input_df), 'seconds': seconds, 'rows_per_second': len(input_df) / seconds if seconds > 0 else float('inf')}
+    logging.info(f"Upserted {stats['rows']} rows into {_table_name} in {seconds:.2f}s ({stats['rows_per_second']:.0f} rows/s)")
+    return stats
+
+
+def backfill(frames: Iterable[pd.DataFrame], _table_name: str = "players", chunk_rows: int = UPSERT_CHUNK_ROWS) -> dict:
+    """Upserts a sequence of dataframes, e.g. one per past season, without holding them all in memory
+
+    :param frames: Dataframes to load
+    :type frames: Iterable[pd.DataFrame]
+    :param _table_name: Name of the table
+    :type _table_name: str
+    :return: Number of loaded rows, seconds taken and rows per second
+    """
+    rows, seconds = 0, 0.0
+    for frame in frames:
+        stats = upsert_dataframe(frame, _table_name, chunk_rows=chunk_rows)
+        rows += stats['rows']
+        seconds += stats['seconds']
+    return {'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds > 0 else float('inf')}
+
+
+def ensure_schema() -> None:
+    """Creates the tables and indexes of SCHEMA and the unique keys of the snapshot tables which already exist
+    """
+    with transaction() as _cursor:
+        for statement in SCHEMA:
+            _execute(_cursor, statement)
+        for _table_name, key_columns in UPSERT_KEYS.items():
+            if _table_exists(_cursor, _table_name):
+                ensure_unique_key(_cursor, _table_name, key_columns)
+
+
+def refresh_daily_delta(for_date: datetime.date) -> None:
+    """Fills player_daily_delta for a day from the players snapshots of that day and the day before
+
+    :param for_date: Day of the deltas, rerunning a day replaces its rows
+    :type for_date: datetime.date
+    """
+    ensure_schema()
+    with transaction() as _cursor:
+        _execute(_cursor, REFRESH_DAILY_DELTA, {'date': for_date, 'previous_date': for_date - datetime.timedelta(days=1)})
+        logging.info(f"Refreshed {_cursor.rowcount} daily deltas of {for_date}")
+
+
+def refresh_daily_delta_if_stale(for_date: datetime.date) -> bool:
+    """Refreshes player_daily_delta for a day when a player of that day's snapshot has no delta row yet
+
+    :param for_date: Day of the deltas
+    :type for_date: datetime.date
+    :return: Whether the deltas were refreshed
+    """
+    ensure_schema()
+    with transaction() as _cursor:
+        _execute(_cursor, MISSING_DAILY_DELTAS, {'date': for_date})
+        missing = _cursor.fetchone()[0]
+    if missing:
+        refresh_daily_delta(for_date)
+    return bool(missing)
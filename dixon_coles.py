@@ -0,0 +1,244 @@
+"""
+Dixon-Coles team strengths fitted by weighted maximum likelihood on finished fixtures
+
+log(home xG) = intercept + home advantage + attack(home) + defence(away)
+log(away xG) = intercept + attack(away) + defence(home)
+
+Low scores (0-0, 1-0, 0-1, 1-1) are corrected by the Dixon-Coles rho term, older results are
+down-weighted with exp(-xi * age in days), and attacks and defences are tied to zero sums by a penalty.
+"""
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+from scipy.optimize import minimize
+from fantasy_football.api import CACHE_PATH, TEAM_NAMES, get_fixtures
+from fantasy_football.statistical_utils import POISSON_TOLERANCE, poisson_depth, poisson_pmf_matrix
+from fantasy_football.predictions import StrengthPrediction, team_codes
+from fantasy_football.fixture_cache import parameters_hash
+
+# time decay per day, a result half a year old counts about a third of one from today
+TIME_DECAY = 0.006
+# weight of the zero-sum penalty on attacks and defences
+SUM_PENALTY = 100.0
+RHO_BOUNDS = (-0.3, 0.3)
+# kept out of the snapshot directory, whose *.json files are evicted and cleared by the api cache
+PARAMS_CACHE = CACHE_PATH / "models" / "dixon_coles.json"
+
+
+def _tau(home_goals: np.ndarray, away_goals: np.ndarray, home_xg: np.ndarray, away_xg: np.ndarray, rho: float) -> Tuple[np.ndarray, ...]:
+    """Low-score correction of every result and its derivatives by log home xG, log away xG and rho
+    """
+    tau = np.ones_like(home_xg)
+    d_home, d_away, d_rho = np.zeros_like(home_xg), np.zeros_like(home_xg), np.zeros_like(home_xg)
+    nil_nil = (home_goals == 0) & (away_goals == 0)
+    nil_one = (home_goals == 0) & (away_goals == 1)
+    one_nil = (home_goals == 1) & (away_goals == 0)
+    one_one = (home_goals == 1) & (away_goals == 1)
+    product = home_xg * away_xg
+    tau[nil_nil] = 1 - product[nil_nil] * rho
+    d_home[nil_nil] = d_away[nil_nil] = -product[nil_nil] * rho
+    d_rho[nil_nil] = -product[nil_nil]
+    tau[nil_one] = 1 + home_xg[nil_one] * rho
+    d_home[nil_one] = home_xg[nil_one] * rho
+    d_rho[nil_one] = home_xg[nil_one]
+    tau[one_nil] = 1 + away_xg[one_nil] * rho
+    d_away[one_nil] = away_xg[one_nil] * rho
+    d_rho[one_nil] = away_xg[one_nil]
+    tau[one_one] = 1 - rho
+    d_rho[one_one] = -1
+    return tau, d_home, d_away, d_rho
+
+
+def negative_log_likelihood(params: np.ndarray, home_idx: np.ndarray, away_idx: np.ndarray, home_goals: np.ndarray,
+                            away_goals: np.ndarray, weights: np.ndarray, n_teams: int) -> Tuple[float, np.ndarray]:
+    """Weighted negative log-likelihood of the results and its analytic gradient
+
+    :param params: attacks (n_teams), defences (n_teams), home advantage, intercept and rho
+    :return: Value and gradient
+    """
+    attack, defence = params[:n_teams], params[n_teams:2 * n_teams]
+    home_advantage, intercept, rho = params[2 * n_teams:]
+    log_home_xg = intercept + home_advantage + attack[home_idx] + defence[away_idx]
+    log_away_xg = intercept + attack[away_idx] + defence[home_idx]
+    home_xg, away_xg = np.exp(log_home_xg), np.exp(log_away_xg)
+    tau, d_home, d_away, d_rho = _tau(home_goals, away_goals, home_xg, away_xg, rho)
+    tau = np.maximum(tau, 1e-10)
+
+    log_likelihood = np.log(tau) + home_goals * log_home_xg - home_xg + away_goals * log_away_xg - away_xg
+    penalty = SUM_PENALTY * (attack.sum() ** 2 + defence.sum() ** 2)
+    value = -np.sum(weights * log_likelihood) + penalty
+
+    # derivatives of the log-likelihood of every result by log home xG and log away xG
+    g_home = weights * (home_goals - home_xg + d_home / tau)
+    g_away = weights * (away_goals - away_xg + d_away / tau)
+    grad = np.empty_like(params)
+    grad[:n_teams] = -(np.bincount(home_idx, g_home, n_teams) + np.bincount(away_idx, g_away, n_teams)) + 2 * SUM_PENALTY * attack.sum()
+    grad[n_teams:2 * n_teams] = -(np.bincount(away_idx, g_home, n_teams) + np.bincount(home_idx, g_away, n_teams)) + 2 * SUM_PENALTY * defence.sum()
+    grad[2 * n_teams] = -g_home.sum()
+    grad[2 * n_teams + 1] = -(g_home.sum() + g_away.sum())
+    grad[2 * n_teams + 2] = -np.sum(weights * d_rho / tau)
+    return value, grad
+
+
+def finished_results(fixtures: pd.DataFrame) -> pd.DataFrame:
+    results = fixtures[fixtures['finished'].astype(bool)].dropna(subset=['team_h_score', 'team_a_score'])
+    return results.sort_values('id') if 'id' in results.columns else results
+
+
+def results_fingerprint(results: pd.DataFrame) -> str:
+    """Hash of the teams and scores of the results, a refit is needed whenever it changes
+    """
+    values = results[['team_h', 'team_a', 'team_h_score', 'team_a_score']].astype(str).agg(','.join, axis=1)
+    return hashlib.sha1('\n'.join(values).encode()).hexdigest()
+
+
+class DixonColesModel:
+    """Fitted team strengths with the interface of predictions.TeamStrengthModel
+
+    Pass it as ``model`` to GameweekPredictions, HorizonPredictions or PointsSimulator.
+
+    :param teams: Team names, TEAM_NAMES by default
+    :type teams: Iterable[str]
+    :param xi: Time decay per day
+    :type xi: float
+    """
+    def __init__(self, teams: Optional[Iterable[str]] = None, xi: float = TIME_DECAY):
+        self.teams = list(TEAM_NAMES if teams is None else teams)
+        self.team_index = {team: i for i, team in enumerate(self.teams)}
+        self.xi = xi
+        n_teams = len(self.teams)
+        self.params = np.concatenate([np.zeros(2 * n_teams), [0.25, 0.1, 0.0]])
+        self.fingerprint = None
+        self.fit_info = {}
+
+    @property
+    def attack(self) -> np.ndarray:
+        return self.params[:len(self.teams)]
+
+    @property
+    def defence(self) -> np.ndarray:
+        return self.params[len(self.teams):2 * len(self.teams)]
+
+    @property
+    def home_advantage(self) -> float:
+        return float(self.params[2 * len(self.teams)])
+
+    @property
+    def intercept(self) -> float:
+        return float(self.params[2 * len(self.teams) + 1])
+
+    @property
+    def rho(self) -> float:
+        return float(self.params[2 * len(self.teams) + 2])
+
+    @property
+    def version(self) -> str:
+        """Hash of the fitted parameters, it changes with every fit which moves them
+        """
+        return parameters_hash(self.teams, self.params)
+
+    def team_codes(self, team_names: Iterable[str]) -> np.ndarray:
+        return team_codes(team_names, self.teams)
+
+    def fit(self, fixtures: pd.DataFrame, reference_time: Optional[pd.Timestamp] = None, warm_start: bool = True) -> 'DixonColesModel':
+        """Fits the parameters to the finished fixtures, starting from the current parameters when warm_start is set
+
+        :param fixtures: Fixtures as returned by api.get_fixtures
+        :type fixtures: pd.DataFrame
+        :param reference_time: Time the ages of the results are measured from, the last kickoff by default
+        :type reference_time: pd.Timestamp
+        :return: The fitted model
+        """
+        results = finished_results(fixtures)
+        if results.empty:
+            raise ValueError("No finished fixtures to fit the model to")
+        kickoff = pd.to_datetime(results['kickoff_time'], utc=True)
+        reference_time = kickoff.max() if reference_time is None else pd.Timestamp(reference_time)
+        age_days = ((reference_time - kickoff).dt.total_seconds() / 86400).clip(lower=0).to_numpy()
+        weights = np.exp(-self.xi * age_days)
+        n_teams = len(self.teams)
+        args = (self.team_codes(results['team_h']), self.team_codes(results['team_a']),
+                results['team_h_score'].to_numpy(dtype=float), results['team_a_score'].to_numpy(dtype=float), weights, n_teams)
+        x0 = self.params if warm_start else DixonColesModel(self.teams, self.xi).params
+        bounds = [(None, None)] * (2 * n_teams + 2) + [RHO_BOUNDS]
+        start = time.perf_counter()
+        solution = minimize(negative_log_likelihood, x0, args=args, jac=True, method='L-BFGS-B', bounds=bounds)
+        if not solution.success:
+            logging.info(f"Dixon-Coles fit did not converge: {solution.message}")
+        self.params = solution.x
+        self.fingerprint = results_fingerprint(results)
+        self.fit_info = {'n_results': len(results), 'iterations': int(solution.nit), 'seconds': time.perf_counter() - start,
+                         'negative_log_likelihood': float(solution.fun), 'warm_start': warm_start}
+        return self
+
+    def predict_xg(self, home_idx: np.ndarray, away_idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        home_idx, away_idx = np.asarray(home_idx), np.asarray(away_idx)
+        home_xg = np.exp(self.intercept + self.home_advantage + self.attack[home_idx] + self.defence[away_idx])
+        away_xg = np.exp(self.intercept + self.attack[away_idx] + self.defence[home_idx])
+        return home_xg, away_xg
+
+    def score_probs(self, home_xg: np.ndarray, away_xg: np.ndarray, tol: float = POISSON_TOLERANCE) -> np.ndarray:
+        """(n_matches, depth, depth) correct score probabilities with the low-score correction
+        """
+        depth = max(poisson_depth(np.concatenate([home_xg, away_xg]), tol), 2)
+        scores = poisson_pmf_matrix(home_xg, depth)[:, :, None] * poisson_pmf_matrix(away_xg, depth)[:, None, :]
+        scores[:, 0, 0] *= 1 - home_xg * away_xg * self.rho
+        scores[:, 0, 1] *= 1 + home_xg * self.rho
+        scores[:, 1, 0] *= 1 + away_xg * self.rho
+        scores[:, 1, 1] *= 1 - self.rho
+        return scores
+
+    def predict(self, home_idx: np.ndarray, away_idx: np.ndarray, return_scores: bool = False) -> StrengthPrediction:
+        """Predicts all given fixtures at once, see TeamStrengthModel.predict
+        """
+        home_xg, away_xg = self.predict_xg(home_idx, away_idx)
+        scores = self.score_probs(np.atleast_1d(home_xg), np.atleast_1d(away_xg))
+        outcome_probs = np.stack([np.tril(scores, -1).sum(axis=(1, 2)),
+                                  np.trace(scores, axis1=1, axis2=2),
+                                  np.triu(scores, 1).sum(axis=(1, 2))], axis=1)
+        # home cleansheet is given by the away side scoring nothing and vice versa
+        home_cs_prob, away_cs_prob = scores[:, :, 0].sum(axis=1), scores[:, 0, :].sum(axis=1)
+        return StrengthPrediction(home_xg, away_xg, outcome_probs, home_cs_prob, away_cs_prob, scores if return_scores else None)
+
+    def save(self, path: Path = PARAMS_CACHE) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'teams': self.teams, 'xi': self.xi, 'params': self.params.tolist(), 'fingerprint': self.fingerprint,
+                       'fit_info': self.fit_info}, f)
+
+    @classmethod
+    def load(cls, path: Path = PARAMS_CACHE) -> 'DixonColesModel':
+        with open(path) as f:
+            stored = json.load(f)
+        model = cls(stored['teams'], stored['xi'])
+        model.params = np.array(stored['params'])
+        model.fingerprint = stored['fingerprint']
+        model.fit_info = stored['fit_info']
+        return model
+
+
+def get_fitted_model(fixtures: Optional[pd.DataFrame] = None, xi: float = TIME_DECAY, path: Path = PARAMS_CACHE) -> DixonColesModel:
+    """Model fitted to the finished fixtures, reusing the parameters cached on disk
+
+    Without new results the cached parameters are returned as they are, otherwise the fit is
+    warm-started from them and the cache is updated.
+    """
+    fixtures = get_fixtures() if fixtures is None else fixtures
+    model = None
+    if path.exists():
+        try:
+            model = DixonColesModel.load(path)
+        except (ValueError, KeyError) as error:
+            logging.info(f"Ignoring the cached Dixon-Coles parameters: {error}")
+    if model is None or model.xi != xi or model.teams != TEAM_NAMES:
+        model = DixonColesModel(xi=xi)
+    elif model.fingerprint == results_fingerprint(finished_results(fixtures)):
+        return model
+    model.fit(fixtures)
+    model.save(path)
+    return model
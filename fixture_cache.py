@@ -0,0 +1,164 @@
+"""
+Memoized fixture predictions keyed by fixture id, home and away team and the version of the team strength model
+
+The version is a hash of the model parameters, so editing config/teams_goals.yaml or refitting the
+Dixon-Coles strengths gives new keys and only the fixtures predicted by the new parameters are
+recomputed. The teams are part of the key since fixture ids restart every season and synthetic or
+backtest fixtures reuse them. Recent predictions are kept in memory with least recently used eviction,
+all predictions of a version are kept on disk in CACHE_PATH/fixtures/<version>.json for the next runs.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+from fantasy_football.api import CACHE_PATH
+
+FIXTURE_CACHE_PATH = CACHE_PATH / "fixtures"
+# fixtures kept in memory, a season has 380
+MEMORY_SIZE = 4096
+# versions kept on disk, the files of older ones are removed
+DISK_VERSIONS = 8
+# cached values of a fixture, in this order
+FIELDS = ('home_xg', 'away_xg', 'home_win', 'draw', 'away_win', 'home_cs_prob', 'away_cs_prob')
+
+
+def parameters_hash(*values) -> str:
+    """Short hash of model parameters - arrays, numbers and lists of team names
+    """
+    digest = hashlib.sha1()
+    for value in values:
+        if isinstance(value, np.ndarray):
+            digest.update(np.ascontiguousarray(value, dtype=np.float64).tobytes())
+        else:
+            digest.update(repr(value).encode('utf8'))
+        digest.update(b'|')
+    return digest.hexdigest()[:16]
+
+
+class FixturePredictionCache:
+    """xG, outcome and clean sheet probabilities of fixtures by (fixture id, home team, away team, model version)
+
+    :param max_size: Fixtures kept in memory
+    :type max_size: int
+    :param path: Directory of the on-disk tier, no disk tier when None
+    :type path: Path
+    """
+    def __init__(self, max_size: int = MEMORY_SIZE, path: Optional[Path] = FIXTURE_CACHE_PATH):
+        self.max_size = max_size
+        self.path = path
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._memory = OrderedDict()
+        self._disk = {}
+        self._lock = threading.Lock()
+
+    def _version_path(self, version: str) -> Path:
+        return self.path / f"{version}.json"
+
+    def _disk_tier(self, version: str) -> dict:
+        if version not in self._disk:
+            stored = {}
+            if self.path is not None and self._version_path(version).exists():
+                try:
+                    with open(self._version_path(version)) as f:
+                        stored = {tuple(int(code) for code in fixture.split(',')): tuple(values) for fixture, values in json.load(f).items()}
+                    if any(len(fixture) != 3 for fixture in stored):
+                        raise ValueError("keys are not fixture id, home and away team codes")
+                except (OSError, ValueError) as error:
+                    logging.info(f"Ignoring the cached fixture predictions of {version}: {error}")
+            self._disk[version] = stored
+        return self._disk[version]
+
+    def _write_disk_tier(self, version: str) -> None:
+        if self.path is None:
+            return
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path / f".{version}.json.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({','.join(map(str, fixture)): values for fixture, values in self._disk[version].items()}, f)
+            os.replace(tmp_path, self._version_path(version))
+            versions = sorted(self.path.glob("*.json"), key=lambda path: path.stat().st_mtime)
+            for stale in versions[:-DISK_VERSIONS]:
+                stale.unlink()
+                self._disk.pop(stale.stem, None)
+        except OSError as error:
+            logging.info(error)
+
+    def _remember(self, key: tuple, values: tuple) -> None:
+        self._memory[key] = values
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def predict(self, model, fixture_ids: Iterable[int], home_idx: np.ndarray,
+                away_idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Predictions of the given fixtures, only the ones not cached for the model's version are predicted
+
+        :param model: Team strength model with a version and predict
+        :param fixture_ids: Ids of the fixtures
+        :type fixture_ids: Iterable[int]
+        :param home_idx: Team codes of the home sides
+        :type home_idx: np.ndarray
+        :param away_idx: Team codes of the away sides
+        :type away_idx: np.ndarray
+        :return: home xG, away xG, (n_fixtures, 3) outcome probabilities, home and away clean sheet probabilities
+        """
+        home_idx, away_idx = np.asarray(home_idx), np.asarray(away_idx)
+        fixtures = [(int(fixture_id), int(home), int(away)) for fixture_id, home, away in zip(fixture_ids, home_idx, away_idx)]
+        version = model.version
+        rows = np.empty((len(fixtures), len(FIELDS)))
+        with self._lock:
+            disk = self._disk_tier(version)
+            missing = []
+            for i, fixture in enumerate(fixtures):
+                key = (*fixture, version)
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    rows[i] = self._memory[key]
+                    self.stats['memory_hits'] += 1
+                elif fixture in disk:
+                    rows[i] = disk[fixture]
+                    self._remember(key, disk[fixture])
+                    self.stats['disk_hits'] += 1
+                else:
+                    missing.append(i)
+            self.stats['misses'] += len(missing)
+        if missing:
+            prediction = model.predict(home_idx[missing], away_idx[missing])
+            rows[missing] = np.column_stack([prediction.home_xg, prediction.away_xg, prediction.outcome_probs,
+                                             prediction.home_cs_prob, prediction.away_cs_prob])
+            with self._lock:
+                disk = self._disk_tier(version)
+                for i in missing:
+                    values = tuple(rows[i].tolist())
+                    disk[fixtures[i]] = values
+                    self._remember((*fixtures[i], version), values)
+                self._write_disk_tier(version)
+        return rows[:, 0], rows[:, 1], rows[:, 2:5], rows[:, 5], rows[:, 6]
+
+    def hit_rate(self) -> float:
+        lookups = sum(self.stats.values())
+        return (self.stats['memory_hits'] + self.stats['disk_hits']) / lookups if lookups else 0.0
+
+    def get_stats(self) -> dict:
+        return {**self.stats, 'hit_rate': self.hit_rate(), 'memory_size': len(self._memory)}
+
+    def clear(self, disk: bool = False) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._disk.clear()
+            if disk and self.path is not None and self.path.exists():
+                for path in self.path.glob("*.json"):
+                    path.unlink()
+
+
+_FIXTURE_CACHE = FixturePredictionCache()
+
+
+def get_fixture_cache() -> FixturePredictionCache:
+    return _FIXTURE_CACHE
@@ -0,0 +1,222 @@
+"""
+Timing spans and counters of the daily run, switched off by default
+
+With instrumentation disabled a span is a shared no-op context manager and a counter update is a
+single flag check, so the hot paths can stay instrumented. Enable it with FPL_INSTRUMENT=1 or
+enable(), then export the recorded spans and counters as JSON lines with export_json.
+
+    with span('optimization.solve', target='ep_next') as current:
+        ...
+        current.set(status=status)
+    count('db.rows_fetched', len(rows))
+
+profile() captures a single run with cProfile, or with pyinstrument when it is installed.
+"""
+from __future__ import annotations
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import functools
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+from fantasy_football.lazy import lazy_import, optional_lazy_import
+
+pd = lazy_import('pandas')
+pyinstrument = optional_lazy_import('pyinstrument')
+
+_ENABLED = os.environ.get('FPL_INSTRUMENT', '0') == '1'
+_EVENTS: List[dict] = []
+_COUNTERS: Dict[str, float] = {}
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+# JSON lines file export_json appends to
+LOG_PATH = Path(os.environ.get('FPL_INSTRUMENT_LOG', Path(os.path.abspath(__file__)).parent / "instrumentation.jsonl"))
+PROFILE_MODES = ('cprofile', 'pyinstrument')
+# functions listed in the cProfile summary
+PROFILE_TOP = 30
+
+
+def enable() -> None:
+    global _ENABLED
+    _ENABLED = True
+
+
+def disable() -> None:
+    global _ENABLED
+    _ENABLED = False
+
+
+def is_enabled() -> bool:
+    return _ENABLED
+
+
+def pyinstrument_available() -> bool:
+    return pyinstrument is not None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """Wall time of a block with its attributes, nested spans record the name of their parent
+    """
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self.start = None
+        self.started_at = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = getattr(_LOCAL, 'stack', None)
+        if stack is None:
+            stack = _LOCAL.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _LOCAL.stack.pop()
+        event = {'span': self.name, 'parent': self.parent, 'start': self.started_at, 'duration_s': duration,
+                 'thread': threading.current_thread().name, 'error': None if exc is None else repr(exc), **self.attributes}
+        with _LOCK:
+            _EVENTS.append(event)
+        return False
+
+
+def span(name: str, **attributes):
+    """Context manager timing a block, a no-op while instrumentation is disabled
+
+    :param name: Name of the span, dotted by layer, e.g. 'api.fetch'
+    :type name: str
+    :param attributes: Values recorded with the span, more can be added with set()
+    """
+    if not _ENABLED:
+        return _NULL_SPAN
+    return Span(name, attributes)
+
+
+def timed(name: Optional[str] = None) -> Callable:
+    """Decorator recording a span around every call, named after the function by default
+    """
+    def decorator(func: Callable) -> Callable:
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            with Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: float = 1) -> None:
+    """Adds to a counter, e.g. rows fetched or bytes downloaded
+    """
+    if not _ENABLED:
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def get_events() -> List[dict]:
+    with _LOCK:
+        return list(_EVENTS)
+
+
+def get_counters() -> Dict[str, float]:
+    with _LOCK:
+        return dict(_COUNTERS)
+
+
+def reset() -> None:
+    with _LOCK:
+        _EVENTS.clear()
+        _COUNTERS.clear()
+
+
+def summary() -> pd.DataFrame:
+    """Calls, total, mean and max seconds of every span name, the slowest first
+    """
+    events = pd.DataFrame(get_events(), columns=['span', 'duration_s'])
+    summary = events.groupby('span')['duration_s'].agg(calls='count', total_s='sum', mean_s='mean', max_s='max')
+    return summary.sort_values('total_s', ascending=False)
+
+
+def export_json(path: Path = LOG_PATH) -> Path:
+    """Appends the recorded spans and a counters record to a JSON lines file
+
+    Spans and counters are kept per process, the ones of process pool workers are not included.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        for event in get_events():
+            f.write(json.dumps(event, default=str) + '\n')
+        f.write(json.dumps({'counters': get_counters(), 'time': time.time()}) + '\n')
+    logging.info(f"Instrumentation exported to {path}")
+    return path
+
+
+@contextmanager
+def profile(path: Optional[Path] = None, mode: str = 'cprofile'):
+    """Profiles the block with cProfile or pyinstrument
+
+    Yields a dictionary whose 'report' holds the text report once the block exits. With a path the
+    cProfile stats (for snakeviz or pstats) or the pyinstrument HTML are also written there.
+
+    :param path: File the profile is saved to
+    :type path: Path
+    :param mode: 'cprofile' or 'pyinstrument'
+    :type mode: str
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode}, expected one of {PROFILE_MODES}")
+    if mode == 'pyinstrument' and pyinstrument is None:
+        raise RuntimeError("Profiling with pyinstrument requires it, install it with 'pip install pyinstrument'")
+    result = {'mode': mode, 'report': None}
+    profiler = cProfile.Profile() if mode == 'cprofile' else pyinstrument.Profiler()
+    if mode == 'cprofile':
+        profiler.enable()
+    else:
+        profiler.start()
+    try:
+        yield result
+    finally:
+        if mode == 'cprofile':
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            result['report'] = stream.getvalue()
+            if path is not None:
+                profiler.dump_stats(str(path))
+        else:
+            profiler.stop()
+            result['report'] = profiler.output_text()
+            if path is not None:
+                Path(path).write_text(profiler.output_html())
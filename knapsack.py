@@ -0,0 +1,221 @@
+"""
+Exact single-week team selection without the MILP solver
+
+Without team limits the problem splits into one cardinality-constrained knapsack per position,
+solved by dynamic programming over the budget, and joined by max-plus convolutions over the
+budget split. Team limits are enforced by best-first branch and bound on top of that relaxation:
+a team over its limit branches into children which each exclude one of its selected players.
+"""
+import heapq
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+from datetime import date
+from typing import List, Optional, Tuple
+from fantasy_football.optimization import MAX_BUDGET, TEAM_SIZE, TEAM_CONSTRAINTS, POSITION_CONSTRAINTS, \
+    OptimizationSession, collect_team, load_players, prune_candidates
+from fantasy_football.schema import as_float64
+from fantasy_football.instrumentation import count, timed
+
+# evaluated branch and bound nodes after which the MILP solver takes over
+MAX_NODES = 500
+# keyword arguments of run_optimization handled by the fast path, anything else goes to the MILP solver
+SUPPORTED_KWARGS = {'_budget', '_team_limit_dict', '_pos_limit_dict', '_must_avoid_ids'}
+
+
+class FallbackToMILP(Exception):
+    pass
+
+
+def _position_counts(positions: List[str], _pos_limit_dict: dict) -> List[Tuple[int, ...]]:
+    ranges = []
+    for position in positions:
+        limit = _pos_limit_dict[position]
+        low, high = (limit[0], limit[1]) if isinstance(limit, (tuple, list)) else (limit, limit)
+        ranges.append(range(low, high + 1))
+    return [counts for counts in itertools.product(*ranges) if sum(counts) == TEAM_SIZE]
+
+
+def _position_table(cost: np.ndarray, reward: np.ndarray, max_count: int, capacity: int) -> Tuple[np.ndarray, np.ndarray]:
+    """table[k, c] - best reward of exactly k players costing at most c, with the decisions for backtracking
+    """
+    table = np.full((max_count + 1, capacity + 1), -np.inf)
+    table[0] = 0
+    takes = np.zeros((len(cost), max_count + 1, capacity + 1), dtype=bool)
+    for i, (player_cost, player_reward) in enumerate(zip(cost, reward)):
+        if player_cost > capacity:
+            continue
+        candidate = np.full_like(table, -np.inf)
+        candidate[1:, player_cost:] = table[:-1, :capacity + 1 - player_cost] + player_reward
+        takes[i] = candidate > table
+        table = np.where(takes[i], candidate, table)
+    return table, takes
+
+
+def _backtrack(takes: np.ndarray, cost: np.ndarray, count: int, capacity: int) -> List[int]:
+    chosen = []
+    for i in range(len(cost) - 1, -1, -1):
+        if count == 0:
+            break
+        if takes[i, count, capacity]:
+            chosen.append(i)
+            count -= 1
+            capacity -= cost[i]
+    return chosen
+
+
+def _max_plus(first: np.ndarray, second: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """combined[c] = max over a of first[a] + second[c - a], with the maximising a
+
+    Both arrays are non-decreasing in the budget, so only the budgets where ``first`` steps up are tried.
+    """
+    capacity = len(first) - 1
+    steps = np.flatnonzero(np.isfinite(first) & (first > np.concatenate([[-np.inf], first[:-1]])))
+    shift = np.arange(capacity + 1)[None, :] - steps[:, None]
+    sums = first[steps][:, None] + second[shift.clip(min=0)]
+    sums[shift < 0] = -np.inf
+    if len(steps) == 0:
+        return np.full(capacity + 1, -np.inf), np.zeros(capacity + 1, dtype=np.intp)
+    best = np.argmax(sums, axis=0)
+    return sums[best, np.arange(capacity + 1)], steps[best]
+
+
+class _Relaxation:
+    """Best team ignoring team limits, for a set of excluded players
+
+    Position tables and max-plus convolutions of the positions untouched by the exclusions are
+    shared between branch and bound nodes.
+    """
+    def __init__(self, cost: np.ndarray, reward: np.ndarray, position_code: np.ndarray, positions: List[str],
+                 counts: List[Tuple[int, ...]], capacity: int):
+        self.cost, self.reward, self.position_code = cost, reward, position_code
+        self.positions, self.counts, self.capacity = positions, counts, capacity
+        self.max_counts = [max(count[p] for count in counts) for p in range(len(positions))]
+        self.tables = {}
+        self.prefixes = {}
+
+    def _table(self, p: int, excluded: frozenset):
+        idx = np.array([i for i in np.flatnonzero(self.position_code == p) if i not in excluded], dtype=np.intp)
+        key = (p, frozenset(idx))
+        if key not in self.tables:
+            self.tables[key] = (idx,) + _position_table(self.cost[idx], self.reward[idx], self.max_counts[p], self.capacity)
+        return key, self.tables[key]
+
+    def solve(self, excluded: frozenset) -> Tuple[float, List[int]]:
+        # positions with fewer exclusions go first, so the convolutions of their prefix come from the cache
+        n_excluded = np.bincount(self.position_code[list(excluded)], minlength=len(self.positions))
+        order = list(np.argsort(n_excluded, kind='stable'))
+        table_keys, tables = zip(*[self._table(p, excluded) for p in order])
+        best_value, best_team = -np.inf, []
+        for position_counts in self.counts:
+            counts = tuple(position_counts[p] for p in order)
+            combined, splits = tables[0][1][counts[0]], []
+            for j in range(1, len(counts)):
+                key = (counts[:j + 1], table_keys[:j + 1])
+                if key not in self.prefixes:
+                    self.prefixes[key] = _max_plus(combined, tables[j][1][counts[j]])
+                combined, split = self.prefixes[key]
+                splits.append(split)
+            if combined[-1] <= best_value:
+                continue
+            best_value = combined[-1]
+            team, capacity = [], self.capacity
+            for j in range(len(counts) - 1, 0, -1):
+                earlier_capacity = splits[j - 1][capacity]
+                idx, _, takes = tables[j]
+                team += list(idx[_backtrack(takes, self.cost[idx], counts[j], capacity - earlier_capacity)])
+                capacity = earlier_capacity
+            idx, _, takes = tables[0]
+            team += list(idx[_backtrack(takes, self.cost[idx], counts[0], capacity)])
+            best_team = team
+        return best_value, best_team
+
+
+@timed('knapsack.select_team')
+def select_team(_df: pd.DataFrame, _target_feature: str, _budget: int = MAX_BUDGET, _team_limit_dict: dict = TEAM_CONSTRAINTS,
+                _pos_limit_dict: dict = POSITION_CONSTRAINTS, _must_avoid_ids: Optional[List[int]] = None,
+                max_nodes: int = MAX_NODES) -> Tuple[List[int], float, int]:
+    """Exact optimum of the plain single-week selection solved by run_optimization
+
+    :return: Selected player ids, objective value and number of evaluated nodes
+    :raises FallbackToMILP: When the input is outside the fast path or the node limit is reached
+    """
+    candidates = prune_candidates(_df, _target_feature, _team_limit_dict, _pos_limit_dict, avoid_ids=_must_avoid_ids or [])
+    if candidates.empty:
+        raise FallbackToMILP("no selectable players")
+    missing_teams = set(candidates['team']) - set(_team_limit_dict)
+    if missing_teams:
+        raise FallbackToMILP(f"no team limit for {missing_teams}")
+    reward = as_float64(candidates[_target_feature])
+    cost = candidates['now_cost'].to_numpy(dtype=float)
+    if np.isnan(reward).any() or np.isnan(cost).any() or (cost != np.round(cost)).any() or _budget != int(_budget):
+        raise FallbackToMILP("rewards must be known and costs integer")
+    position_code, positions = pd.factorize(candidates['position'])
+    team_code, teams = pd.factorize(candidates['team'])
+    team_limits = np.array([_team_limit_dict[team] for team in teams])
+    counts = _position_counts(list(positions), _pos_limit_dict)
+    # every team has exactly TEAM_SIZE players, so the cheapest price can be taken off each of them
+    min_cost = int(cost.min())
+    cost = cost.astype(np.int64) - min_cost
+    capacity = int(_budget) - TEAM_SIZE * min_cost
+    if capacity < 0 or not counts:
+        raise FallbackToMILP("no feasible team")
+    relaxation = _Relaxation(cost, reward, position_code, list(positions), counts, capacity)
+
+    tie_breaker = itertools.count()
+    queue = [(-np.inf, next(tie_breaker), frozenset(), None)]
+    seen = {frozenset()}
+    n_nodes = 0
+    while queue:
+        key, _, excluded, solution = heapq.heappop(queue)
+        if solution is None:
+            if n_nodes >= max_nodes:
+                raise FallbackToMILP(f"node limit of {max_nodes} reached")
+            n_nodes += 1
+            value, team = relaxation.solve(excluded)
+            if np.isfinite(value):
+                heapq.heappush(queue, (-value, next(tie_breaker), excluded, team))
+            continue
+        selected_teams = np.bincount(team_code[solution], minlength=len(teams))
+        over_limit = np.flatnonzero(selected_teams > team_limits)
+        if len(over_limit) == 0:
+            team_ids = candidates['player_id'].to_numpy()[solution].tolist()
+            count('knapsack.nodes', n_nodes)
+            return team_ids, float(reward[solution].sum()), n_nodes
+        # any feasible team leaves out at least one selected player of the team over its limit
+        for i in [i for i in solution if team_code[i] == over_limit[0]]:
+            child = excluded | {i}
+            if child not in seen:
+                seen.add(child)
+                # children are evaluated when popped, until then the parent's value bounds them
+                heapq.heappush(queue, (key, next(tie_breaker), child, None))
+    raise FallbackToMILP("no feasible team")
+
+
+def run_optimization_fast(_target_feature: str, data_source: str = 'api', optimization_date: date = date.today(),
+                          verbose: bool = True, players: Optional[pd.DataFrame] = None, **kwargs) -> Tuple[pd.DataFrame, float, float]:
+    """Drop-in replacement of run_optimization which uses select_team whenever it can
+
+    Falls back to the MILP solver, with a warning giving the reason, for arguments outside
+    SUPPORTED_KWARGS, non-integer costs or when the node limit is reached.
+    """
+    all_players = load_players(data_source, optimization_date) if players is None else players
+    unsupported = set(kwargs) - SUPPORTED_KWARGS
+    try:
+        if unsupported:
+            raise FallbackToMILP(f"unsupported arguments {sorted(unsupported)}")
+        player_ids, objective_value, n_nodes = select_team(all_players, _target_feature, **kwargs)
+    except FallbackToMILP as reason:
+        logging.warning(f"Falling back to the MILP solver: {reason}")
+        session = OptimizationSession(_target_feature, players=all_players, prune=True, **kwargs)
+        final_team, objective_value, team_cost = session.solve()
+        solver = "MILP"
+    else:
+        final_team, team_cost = collect_team(all_players, player_ids)
+        solver = f"branch and bound, {n_nodes} nodes"
+    if verbose:
+        print(f"Solver: {solver}")
+        print(f"Objective: {objective_value}")
+        print(f"Cost: {team_cost}")
+    return final_team, objective_value, team_cost
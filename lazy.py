@@ -0,0 +1,52 @@
+"""
+Deferred imports of the heavy dependencies, so the command line entry points only pay for what they use
+
+    pd = lazy_import('pandas')
+
+binds a stand-in which imports pandas the first time one of its attributes is used. Modules using it
+postpone the evaluation of their annotations, so ``-> pd.DataFrame`` does not trigger the import.
+"""
+import importlib
+import importlib.util
+from typing import Optional
+
+
+class LazyModule:
+    """Module imported on the first attribute access
+    """
+    def __init__(self, name: str):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        module = object.__getattribute__(self, '_module')
+        if module is None:
+            module = importlib.import_module(object.__getattribute__(self, '_name'))
+            object.__setattr__(self, '_module', module)
+        return module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute: str, value) -> None:
+        setattr(self._load(), attribute, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        return f"<lazy module '{object.__getattribute__(self, '_name')}'>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+def optional_lazy_import(name: str) -> Optional[LazyModule]:
+    """Lazy module when its package is installed, None otherwise, without importing the package
+    """
+    try:
+        found = importlib.util.find_spec(name.split('.')[0]) is not None
+    except ImportError:
+        found = False
+    return LazyModule(name) if found else None
@@ -1,63 +1,233 @@
 import os
-from smtplib import SMTP
+import time
+import queue
+import socket
+import atexit
+import logging
+import threading
+from functools import lru_cache
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
 from otodom.utils import get_credentials
 from email.message import EmailMessage
-import logging
+from typing import List, Optional
+
+# messages sent over the session in one go before the queue is looked at again
+BATCH_SIZE = 20
+# seconds of inactivity after which the session is checked with NOOP before sending
+IDLE_CHECK = 60
+# seconds of inactivity after which the worker closes the session, it is reopened by the next message
+IDLE_QUIT = 300
+SEND_RETRIES = 1
 
 
-def _log_to_server(_creds):
+@lru_cache(maxsize=1)
+def _get_mail_credentials() -> dict:
+    return get_credentials()['gmail']
+
+
+def _log_to_server(_creds, host: Optional[str] = None, port: int = 0, starttls: bool = True):
     try:
-        server = SMTP(_creds['mail_server'])
+        server = SMTP(host or _creds['mail_server'], port)
         server.ehlo()
-        server.starttls()
-        server.login(_creds['username'], _creds['password'])
+        if starttls:
+            server.starttls()
+            server.ehlo()
+        if _creds.get('username') and _creds.get('password'):
+            server.login(_creds['username'], _creds['password'])
     except Exception as error:
         logging.info(error)
         raise RuntimeError("Falied to log in into the server - check 'send_info' function for server issues")
     return server
 
 
+def _build_message(_creds: dict, subject: str, content: str, html: bool = False) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = _creds['username']
+    message["To"] = _creds['username']
+    message["Subject"] = f"FPL-{os.environ.get('COMPUTERNAME', socket.gethostname())}: {subject}"
+    if html:
+        message.add_alternative(content, subtype='html')
+    else:
+        message.set_content(content)
+    return message
+
+
+class MailDispatcher:
+    """Sends queued messages from a background thread over one authenticated SMTP session
+
+    The session is opened by the first message, kept between messages and reopened when the server drops it.
+    Messages queued while the worker is busy are sent back to back over the same session.
+
+    :param host: SMTP server, the mail_server of the credentials when None
+    :type host: str
+    :param port: SMTP port, taken from the host or the smtplib default when 0
+    :type port: int
+    :param starttls: Upgrades the session to TLS, disable for local stand-ins such as aiosmtpd
+    :type starttls: bool
+    :param credentials: Dictionary with mail_server, username and password, the cached 'gmail' credentials when None
+    :type credentials: dict
+    """
+    def __init__(self, host: Optional[str] = None, port: int = 0, starttls: bool = True, credentials: Optional[dict] = None,
+                 batch_size: int = BATCH_SIZE):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self._credentials = credentials
+        self.batch_size = batch_size
+        self.stats = {'sent': 0, 'failed': 0, 'batches': 0, 'connections': 0}
+        self.errors: List[str] = []
+        self._flushed_failures = 0
+        self._queue = queue.Queue()
+        self._server = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+        self._worker = None
+
+    @property
+    def credentials(self) -> dict:
+        return _get_mail_credentials() if self._credentials is None else self._credentials
+
+    def send(self, subject: str, content: str, html: bool = False) -> None:
+        """Queues a message to the own mailbox and returns at once
+        """
+        self.send_message(_build_message(self.credentials, subject, content, html))
+
+    def send_message(self, message: EmailMessage) -> None:
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="mail-dispatcher", daemon=True)
+                self._worker.start()
+        self._queue.put(message)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every queued message is sent or given up on
+
+        :param timeout: Seconds to wait for, no limit when None
+        :type timeout: float
+        :return: Whether the queue was emptied in time without any message failing since the previous flush,
+            the failures are listed in errors
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        failed, self._flushed_failures = self.stats['failed'] - self._flushed_failures, self.stats['failed']
+        return failed == 0
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Flushes the queue, stops the worker and quits the session
+        """
+        self.flush(timeout)
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join(timeout)
+        self._disconnect()
+
+    def _connect(self):
+        if self._server is not None and time.monotonic() - self._last_used > IDLE_CHECK:
+            try:
+                self._server.noop()
+            except (SMTPException, OSError):
+                self._server = None
+        if self._server is None:
+            self._server = _log_to_server(self.credentials, self.host, self.port, self.starttls)
+            self.stats['connections'] += 1
+        return self._server
+
+    def _disconnect(self) -> None:
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (SMTPException, OSError):
+                pass
+            self._server = None
+
+    def _deliver(self, message: EmailMessage) -> None:
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                self._connect().send_message(message)
+                self._last_used = time.monotonic()
+                self.stats['sent'] += 1
+                return
+            except (SMTPServerDisconnected, ConnectionError) as error:
+                # dropped session, reconnected on the next attempt
+                logging.info(f"Mail session dropped: {error}")
+                self._server = None
+                last_error = error
+            except (SMTPException, RuntimeError, OSError) as error:
+                self._server = None
+                last_error = error
+                break
+        self.stats['failed'] += 1
+        self.errors.append(f"{message['Subject']}: {last_error}")
+        logging.info(f"Email '{message['Subject']}' couldn't be sent: {last_error}")
+
+    def _run(self) -> None:
+        while True:
+            try:
+                message = self._queue.get(timeout=IDLE_QUIT if self._server is not None else None)
+            except queue.Empty:
+                self._disconnect()
+                continue
+            batch = [message]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            messages = [message for message in batch if message is not None]
+            if messages:
+                self.stats['batches'] += 1
+            for message in messages:
+                self._deliver(message)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+
+_DISPATCHER = None
+
+
+def get_dispatcher() -> MailDispatcher:
+    """Dispatcher shared by send_info and send_html, its queue is flushed when the interpreter exits
+    """
+    global _DISPATCHER
+    if _DISPATCHER is None:
+        _DISPATCHER = MailDispatcher()
+        atexit.register(_DISPATCHER.close)
+    return _DISPATCHER
+
+
 def send_info(subject: str, message_content: str) -> None:
-    """Sending an info email to my mailbox 
+    """Sending an info email to my mailbox, queued and sent in the background
 
     :param subject: Subject of the email
     :type subject: str
-    :param message_content: Content of the email - might include HTML
+    :param message_content: Content of the email
     :type message_content: str
     """
-    _creds = get_credentials()['gmail']
-    server = _log_to_server(_creds)
-    message = EmailMessage()
-    message["From"] = _creds['username']
-    message["To"] = _creds['username']
-    message["Subject"] = f"FPL-{os.environ['COMPUTERNAME']}: {subject}"
-    message.set_content(message_content)
-    try:
-        server.send_message(message)
-    except Exception as error:
-        logging.info(error)
-        raise RuntimeError("Server login successful, but info email couldn't be sent - check 'send_info' function for server issues")
-    server.quit()
-    
+    get_dispatcher().send(subject, message_content)
+
 
 def send_html(subject: str, html_content: str) -> None:
-    """Sending an info email to my mailbox 
+    """Sending an HTML email to my mailbox, queued and sent in the background
 
     :param subject: Subject of the email
     :type subject: str
-    :param message_content: Content of the email - might include HTML
-    :type message_content: str
+    :param html_content: HTML content of the email
+    :type html_content: str
     """
-    _creds = get_credentials()['gmail']
-    server = _log_to_server(_creds)
-    message = EmailMessage()
-    message["From"] = _creds['username']
-    message["To"] = _creds['username']
-    message["Subject"] = f"FPL-{os.environ['COMPUTERNAME']}: {subject}"
-    message.add_alternative(html_content, subtype='html')
-    try:
-        server.send_message(message)
-    except Exception as error:
-        logging.info(error)
-        raise RuntimeError("Server login successful, but info email couldn't be sent - check 'send_info' function for server issues")
-    server.quit()
\ No newline at end of file
+    get_dispatcher().send(subject, html_content, html=True)
+
+
+def flush(timeout: Optional[float] = None) -> bool:
+    """Waits for the queued emails, to be called at the end of a run
+
+    :return: False when an email failed or the timeout passed, see get_dispatcher().errors
+    """
+    return get_dispatcher().flush(timeout) if _DISPATCHER is not None else True
@@ -1,10 +1,20 @@
+import os
+import re
+import time
+import logging
+import tempfile
 import pandas as pd
 import numpy as np
 from datetime import date
-from typing import List
-from pulp import LpMaximize, LpProblem, LpStatus, lpSum, LpVariable
-from fantasy_football.api import get_all_players
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple, Union
+from pulp import LpMaximize, LpProblem, LpStatus, lpSum, LpVariable, LpAffineExpression, LpConstraint, \
+    LpConstraintEQ, LpConstraintGE, LpConstraintLE, PULP_CBC_CMD, LpStatusOptimal, LpSolutionIntegerFeasible
+from fantasy_football.api import get_all_players, conform_players
 from fantasy_football.data.db_connect import get_query
+from fantasy_football.store import read_snapshot
+from fantasy_football.schema import as_float64
+from fantasy_football.instrumentation import count, is_enabled, span, timed
 
 MAX_BUDGET = 825
 MAX_TEAM_MEMBERS = 3
@@ -35,7 +45,10 @@ TEAM_CONSTRAINTS = {"Arsenal": 3,
                     "Wolves": 3}
 
 
+# status of a feasible solution returned when the solver stopped on its time limit
+TIME_LIMIT_STATUS = "TimeLimit"
 POSITION_MAP = {'GKP': 0, 'DEF': 1, 'MID': 2, 'FWD': 3}
+COLS_TO_DISPLAY = ['player_id', 'first_name', 'second_name', 'position', 'team', 'ep_next', 'now_cost', 'total_points', 'selected_by_percent']
 
 
 def create_player_variables(_df: pd.DataFrame) -> dict:
@@ -94,7 +107,7 @@ def create_existing_team_constraint(_players_dict: dict, _team_members_ids: List
     return must_haves_contraint
 
 
-def create_model(_df: pd.DataFrame, _target_feature: str, **kwargs):
+def create_model_legacy(_df: pd.DataFrame, _target_feature: str, **kwargs):
     players_dict = create_player_variables(_df)
     # objective
     objective_function = create_objective_function(_df, players_dict, _target_feature)
@@ -136,30 +149,394 @@ def create_model(_df: pd.DataFrame, _target_feature: str, **kwargs):
     return model
 
 
-def run_optimization(_target_feature: str, data_source: str = 'api', optimization_date: date = date.today(), **kwargs) -> pd.DataFrame:
+def get_model_arrays(_df: pd.DataFrame, _target_feature: str) -> dict:
+    """Columns of the players frame needed by the model, as NumPy arrays with categorical team and position codes
+    """
+    team_code, teams = pd.factorize(_df['team'])
+    position_code, positions = pd.factorize(_df['position'])
+    return {'player_id': _df['player_id'].to_numpy(),
+            'reward': as_float64(_df[_target_feature]),
+            'cost': _df['now_cost'].to_numpy(dtype=float),
+            'team_code': team_code,
+            'teams': list(teams),
+            'position_code': position_code,
+            'positions': list(positions)}
+
+
+def max_full_teams(_team_limit_dict: dict, n_players: int) -> int:
+    """Most teams which can reach their limit with n_players players
+    """
+    n_full, used = 0, 0
+    for limit in sorted(limit for limit in _team_limit_dict.values() if limit > 0):
+        if used + limit > n_players:
+            break
+        n_full, used = n_full + 1, used + limit
+    return n_full
+
+
+def find_dominated_players(position_code: np.ndarray, team_code: np.ndarray, cost: np.ndarray, values: np.ndarray,
+                           slots: np.ndarray, extra_teams: int = 0, chunk_size: int = 512) -> np.ndarray:
+    """Marks players who can be swapped for a cheaper-or-equal, better-or-equal player of the same position
+
+    Player j dominates player i when j costs no more and j's value is at least i's in every column of
+    ``values`` (identical players are ordered by index). Player i is dominated when its dominators come
+    from at least slots[position] + extra_teams different teams: one of them is then outside any
+    selection using the position's slots and in a team which is not full, as long as extra_teams bounds
+    the number of full teams.
+
+    :param position_code: Position code of every player
+    :param team_code: Team code of every player
+    :param cost: Cost of every player
+    :param values: Objective of every player, shape (n_players,) or (n_players, n_gameweeks)
+    :param slots: Maximum number of selected players by position code
+    :param extra_teams: Number of teams which may be full, see max_full_teams
+    :return: Boolean mask of dominated players
+    """
+    values = np.asarray(values, dtype=float).reshape(len(cost), -1)
+    cost = np.asarray(cost, dtype=float)
+    team_one_hot = np.eye(int(np.max(team_code)) + 1, dtype=np.int32)[team_code]
+    dominated = np.zeros(len(cost), dtype=bool)
+    for code in np.unique(position_code):
+        idx = np.flatnonzero(position_code == code)
+        for start in range(0, len(idx), chunk_size):
+            rows = idx[start:start + chunk_size]
+            # [i, j] - does player idx[j] dominate player rows[i]
+            weakly_better = np.all(values[idx][None, :, :] >= values[rows][:, None, :], axis=2) & (cost[idx][None, :] <= cost[rows][:, None])
+            strictly_better = np.any(values[idx][None, :, :] > values[rows][:, None, :], axis=2) | (cost[idx][None, :] < cost[rows][:, None])
+            dominates = weakly_better & (strictly_better | (idx[None, :] < rows[:, None]))
+            n_dominating_teams = np.count_nonzero(dominates.astype(np.int32) @ team_one_hot[idx], axis=1)
+            dominated[rows] = n_dominating_teams >= slots[code] + extra_teams
+    return dominated
+
+
+def position_slots(_pos_limit_dict: dict = POSITION_CONSTRAINTS) -> dict:
+    """Maximum number of selected players by position
+    """
+    return {position: limit[1] if isinstance(limit, (tuple, list)) else limit for position, limit in _pos_limit_dict.items()}
+
+
+def prune_candidates(_df: pd.DataFrame, _target_feature: str, _team_limit_dict: dict = TEAM_CONSTRAINTS,
+                     _pos_limit_dict: dict = POSITION_CONSTRAINTS, keep_ids: Iterable[int] = (),
+                     avoid_ids: Iterable[int] = ()) -> pd.DataFrame:
+    """Drops players who can never be needed in an optimal single-week team
+
+    Removes the players to avoid, players of teams with no places left and players dominated within
+    their position (see find_dominated_players). The objective of the optimal team is unchanged.
+    Kept players are returned even when they are also to be avoided, e.g. an injured current team
+    member, so the caller still has to bound the avoided ones to 0.
+
+    :param keep_ids: Players never dropped, e.g. must-haves and current team members
+    :param avoid_ids: Players which can't be selected, they never count as dominating another player
+    :return: The remaining players
+    """
+    keep = _df['player_id'].isin(list(keep_ids)).to_numpy()
+    selectable = ~_df['player_id'].isin(list(avoid_ids)).to_numpy() & (_df['team'].map(_team_limit_dict).to_numpy() != 0)
+    candidates = _df[selectable]
+    team_code, _ = pd.factorize(candidates['team'])
+    position_code, positions = pd.factorize(candidates['position'])
+    slots = position_slots(_pos_limit_dict)
+    dominated = find_dominated_players(position_code, team_code, candidates['now_cost'].to_numpy(dtype=float),
+                                       candidates[_target_feature].to_numpy(dtype=float),
+                                       np.array([slots[position] for position in positions]),
+                                       max_full_teams(_team_limit_dict, TEAM_SIZE - 1))
+    remaining = keep.copy()
+    remaining[np.flatnonzero(selectable)[~dominated]] = True
+    return _df[remaining]
+
+
+def _group_indices(codes: np.ndarray, n_groups: int) -> List[np.ndarray]:
+    order = np.argsort(codes, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(codes, minlength=n_groups))[:-1])
+
+
+def _sum_constraint(variables: np.ndarray, idx: np.ndarray, sense: int, rhs: float, name: str) -> LpConstraint:
+    return LpConstraint(LpAffineExpression([(variables[i], 1) for i in idx]), sense=sense, rhs=rhs, name=name)
+
+
+def create_model_from_arrays(arrays: dict, _budget: int = MAX_BUDGET, _team_limit_dict: dict = TEAM_CONSTRAINTS,
+                             _pos_limit_dict: dict = POSITION_CONSTRAINTS, _must_haves_ids: Optional[List[int]] = None,
+                             _must_avoid_ids: Optional[List[int]] = None, _team_members_ids: Optional[List[int]] = None,
+                             _allowed_changes: int = 1, **kwargs) -> Tuple[LpProblem, np.ndarray, dict]:
+    """Builds the team selection model from the output of get_model_arrays
+
+    Every constraint is a sparse row assembled from index arrays of the players it covers,
+    with the same names as the constraints built by the create_*_constraint helpers.
+
+    :return: The model, the array of player variables aligned with arrays['player_id'] and the constraints by name
+    """
+    player_ids = arrays['player_id']
+    variables = np.array([LpVariable(name=f"p{_id}", lowBound=0, upBound=1, cat="Integer") for _id in player_ids], dtype=object)
+    position = {_id: i for i, _id in enumerate(player_ids)}
+
+    constraints = [LpConstraint(LpAffineExpression(zip(variables, np.ones(len(variables)))), sense=LpConstraintEQ, rhs=TEAM_SIZE, name="team_size_constraint"),
+                   LpConstraint(LpAffineExpression(zip(variables, arrays['cost'])), sense=LpConstraintLE, rhs=_budget, name="budget_constraint")]
+    for team, idx in zip(arrays['teams'], _group_indices(arrays['team_code'], len(arrays['teams']))):
+        constraints.append(_sum_constraint(variables, idx, LpConstraintLE, _team_limit_dict[team], f"{team}_constraint"))
+    for _position, idx in zip(arrays['positions'], _group_indices(arrays['position_code'], len(arrays['positions']))):
+        limit = _pos_limit_dict[_position]
+        if isinstance(limit, (tuple, list)):
+            constraints.append(_sum_constraint(variables, idx, LpConstraintGE, limit[0], f"min_{_position}_constraint"))
+            constraints.append(_sum_constraint(variables, idx, LpConstraintLE, limit[1], f"max_{_position}_constraint"))
+        else:
+            constraints.append(_sum_constraint(variables, idx, LpConstraintEQ, limit, f"{_position}_constraint"))
+
+    # the creating player-specific constraints
+    if _must_haves_ids is not None:
+        idx = [position[_id] for _id in _must_haves_ids]
+        constraints.append(_sum_constraint(variables, idx, LpConstraintEQ, len(idx), "must_haves_constraint"))
+    if _must_avoid_ids is not None:
+        idx = [position[_id] for _id in _must_avoid_ids]
+        constraints.append(_sum_constraint(variables, idx, LpConstraintEQ, 0, "must_avoid_constraint"))
+    if _team_members_ids is not None:
+        idx = [position[_id] for _id in _team_members_ids]
+        constraints.append(_sum_constraint(variables, idx, LpConstraintGE, TEAM_SIZE - _allowed_changes, "existing_team_constraint"))
+
+    # creating model
+    model = LpProblem(name="Optimal_FPL_team", sense=LpMaximize)
+    model.setObjective(LpAffineExpression(zip(variables, arrays['reward'])))
+    for constraint in constraints:
+        model.addConstraint(constraint)
+    count('optimization.variables', len(variables))
+    count('optimization.constraints', len(constraints))
+    return model, variables, {constraint.name: constraint for constraint in constraints}
+
+
+@timed('optimization.create_model')
+def create_model(_df: pd.DataFrame, _target_feature: str, **kwargs):
+    model, _, _ = create_model_from_arrays(get_model_arrays(_df, _target_feature), **kwargs)
+    return model
+
+
+def load_players(data_source: str = 'api', optimization_date: date = date.today()) -> pd.DataFrame:
     if data_source == 'api':
         all_players = get_all_players()
-    elif data_source == 'database': 
-        all_players = get_query(f"SELECT * FROM players WHERE date = '{optimization_date}'")
-    cols_to_display = ['player_id', 'first_name', 'second_name', 'position', 'team', 'ep_next', 'now_cost', 'total_points', 'selected_by_percent']
-
-    model = create_model(all_players, _target_feature, **kwargs)
-    model.solve()
-    objective_value = model.objective.value()
-    print(f"Status: {model.status}, {LpStatus[model.status]}")
-    print(f"Objective: {objective_value}")
-    
-    player_ids = []
-    for var in model.variables():
-        if var.value() != 0.0:
-            player_ids.append(int(var.name[1:]))
-    
-    final_team = all_players.loc[player_ids][cols_to_display]
+    elif data_source == 'database':
+        all_players = conform_players(get_query("SELECT * FROM players WHERE date = %(date)s", {'date': optimization_date}))
+        all_players.set_index(all_players['player_id'].to_numpy(), inplace=True)
+    elif data_source == 'store':
+        all_players = conform_players(read_snapshot(optimization_date, "players"))
+    else:
+        raise ValueError(f"Unknown data source: {data_source}")
+    return all_players
+
+
+def collect_team(all_players: pd.DataFrame, player_ids: Iterable[int]) -> Tuple[pd.DataFrame, float]:
+    final_team = all_players.loc[list(player_ids)][COLS_TO_DISPLAY]
     final_team.sort_values(by='position', key=lambda x: x.map(POSITION_MAP), inplace=True)
     team_cost = np.sum(final_team['now_cost'])
-    print(f"Cost: {team_cost}")
+    return final_team, team_cost
+
+
+class OptimizationSession:
+    """Team selection model which is built once and re-solved after in-place changes
+
+    Budget and allowed changes only move the right-hand side of their constraints, must-haves and
+    must-avoids fix variable bounds and the objective is swapped without touching the constraints.
+    Every solve after the first one is warm-started from the previous solution.
+
+    With prune=True dominated players are left out of the model (see prune_candidates), which ties
+    the session to its objective and to the must-haves and must-avoids it was created with.
+    """
+    def __init__(self, _target_feature: str = 'ep_next', data_source: str = 'api', optimization_date: date = date.today(),
+                 players: Optional[pd.DataFrame] = None, _must_haves_ids: Optional[List[int]] = None,
+                 _must_avoid_ids: Optional[List[int]] = None, prune: bool = False, **kwargs):
+        self.players = load_players(data_source, optimization_date) if players is None else players
+        self.pruned = prune
+        if prune:
+            keep_ids = list(_must_haves_ids or []) + list(kwargs.get('_team_members_ids') or [])
+            self.players = prune_candidates(self.players, _target_feature, kwargs.get('_team_limit_dict', TEAM_CONSTRAINTS),
+                                            kwargs.get('_pos_limit_dict', POSITION_CONSTRAINTS), keep_ids, _must_avoid_ids or [])
+            # only avoided players which had to be kept, e.g. current team members, are left in the pool
+            remaining_ids = set(self.players['player_id'])
+            _must_avoid_ids = [_id for _id in _must_avoid_ids or [] if _id in remaining_ids]
+        with span('optimization.create_model', players=len(self.players)):
+            self.arrays = get_model_arrays(self.players, _target_feature)
+            self.model, self.variables, self.constraints = create_model_from_arrays(self.arrays, **kwargs)
+        self.variable_index = {_id: i for i, _id in enumerate(self.arrays['player_id'])}
+        self.target_feature = _target_feature
+        self.must_haves_ids, self.must_avoid_ids = list(_must_haves_ids or []), list(_must_avoid_ids or [])
+        self._set_bounds(self.must_haves_ids, 1, 1)
+        self._set_bounds(self.must_avoid_ids, 0, 0)
+        self.has_incumbent = False
+        self.status = None
+
+    def _set_rhs(self, name: str, rhs: float) -> None:
+        if name not in self.constraints:
+            raise ValueError(f"The model has no {name}")
+        # pulp keeps constraints as 'expression + constant <sense> 0'
+        self.constraints[name].constant = -rhs
+        self.constraints[name].modified = True
+
+    def set_budget(self, _budget: int) -> None:
+        self._set_rhs("budget_constraint", _budget)
+
+    def set_allowed_changes(self, _allowed_changes: int) -> None:
+        self._set_rhs("existing_team_constraint", TEAM_SIZE - _allowed_changes)
+
+    def _set_bounds(self, player_ids: Iterable[int], low_bound: int, up_bound: int) -> None:
+        for _id in player_ids:
+            self.variables[self.variable_index[_id]].bounds(low_bound, up_bound)
+
+    def _check_not_pruned(self, change: str) -> None:
+        if self.pruned:
+            raise ValueError(f"Changing {change} requires a session created with prune=False")
+
+    def set_must_haves(self, _must_haves_ids: List[int]) -> None:
+        if set(_must_haves_ids) - set(self.must_haves_ids):
+            self._check_not_pruned("must-haves")
+        self._set_bounds(self.must_haves_ids, 0, 1)
+        self._set_bounds(_must_haves_ids, 1, 1)
+        self.must_haves_ids = list(_must_haves_ids)
+
+    def set_must_avoid(self, _must_avoid_ids: List[int]) -> None:
+        if _must_avoid_ids:
+            self._check_not_pruned("must-avoids")
+        self._set_bounds(self.must_avoid_ids, 0, 1)
+        self._set_bounds(_must_avoid_ids, 0, 0)
+        self.must_avoid_ids = list(_must_avoid_ids)
+
+    def set_objective(self, _target_feature: Union[str, np.ndarray]) -> None:
+        """Swaps the objective for another column of the players frame, or for an array aligned with it
+        """
+        self._check_not_pruned("the objective")
+        if isinstance(_target_feature, str):
+            self.target_feature = _target_feature
+            reward = as_float64(self.players[_target_feature])
+        else:
+            self.target_feature = None
+            reward = np.asarray(_target_feature, dtype=float)
+        self.arrays['reward'] = reward
+        self.model.setObjective(LpAffineExpression(zip(self.variables, reward)))
+
+    def solve(self, time_limit: Optional[float] = None) -> Tuple[pd.DataFrame, float, float]:
+        with span('optimization.solve', target=self.target_feature, variables=len(self.variables),
+                  constraints=len(self.constraints)) as current:
+            # the solver log is only kept for its iteration and node counts, when instrumentation is enabled
+            log_path = os.path.join(tempfile.mkdtemp(), "cbc.log") if is_enabled() else None
+            solver = PULP_CBC_CMD(msg=False, warmStart=self.has_incumbent, timeLimit=time_limit, logPath=log_path)
+            self.status = self.model.solve(solver)
+            self.has_incumbent = True
+            current.set(status=LpStatus[self.status], solution_time_s=self.model.solutionTime, **_solver_counts(log_path))
+        objective_value = self.model.objective.value()
+        selected = np.array([var.value() or 0 for var in self.variables]) > 0.5
+        final_team, team_cost = collect_team(self.players, self.arrays['player_id'][selected])
+        return final_team, objective_value, team_cost
+
+    def sweep_allowed_changes(self, allowed_changes: Iterable[int]) -> List[Tuple[pd.DataFrame, float, float]]:
+        results = []
+        for _allowed_changes in allowed_changes:
+            self.set_allowed_changes(_allowed_changes)
+            results.append(self.solve())
+        return results
+
+    def sweep_budgets(self, budgets: Iterable[int]) -> List[Tuple[pd.DataFrame, float, float]]:
+        results = []
+        for _budget in budgets:
+            self.set_budget(_budget)
+            results.append(self.solve())
+        return results
+
+
+def _solver_counts(log_path: Optional[str]) -> dict:
+    """Iterations and branch and bound nodes reported at the end of a CBC log
+    """
+    if log_path is None or not os.path.exists(log_path):
+        return {}
+    with open(log_path) as f:
+        log = f.read()
+    os.remove(log_path)
+    os.rmdir(os.path.dirname(log_path))
+    counts = {}
+    for key, label in [('iterations', 'Total iterations'), ('nodes', 'Enumerated nodes')]:
+        match = re.search(rf"{label}:\s+(\d+)", log)
+        if match:
+            counts[key] = int(match.group(1))
+            count(f"optimization.solver_{key}", counts[key])
+    return counts
+
+
+def solve_status(model: LpProblem) -> str:
+    """Status of a solved model, TIME_LIMIT_STATUS when CBC stopped on its time limit with a feasible solution
+
+    PuLP reports such a solution as Optimal, only its sol_status tells it apart from a proven optimum.
+    """
+    if model.status == LpStatusOptimal and model.sol_status == LpSolutionIntegerFeasible:
+        return TIME_LIMIT_STATUS
+    return LpStatus[model.status]
+
+
+def run_optimization(_target_feature: str, data_source: str = 'api', optimization_date: date = date.today(), verbose: bool = True, prune: bool = True, **kwargs) -> pd.DataFrame:
+    session = OptimizationSession(_target_feature, data_source, optimization_date, prune=prune, **kwargs)
+    final_team, objective_value, team_cost = session.solve()
+    if verbose:
+        print(f"Status: {session.status}, {LpStatus[session.status]}")
+        print(f"Objective: {objective_value}")
+        print(f"Cost: {team_cost}")
     return final_team, objective_value, team_cost
-    
+
+
+# players snapshot shared by the scenarios solved in one worker process
+_SCENARIO_PLAYERS = None
+
+
+def _init_scenario_worker(players: pd.DataFrame) -> None:
+    global _SCENARIO_PLAYERS
+    _SCENARIO_PLAYERS = players
+
+
+def _solve_scenario(scenario: dict, time_limit: Optional[float] = None) -> dict:
+    scenario = dict(scenario)
+    name = scenario.pop('name', None)
+    target = scenario.pop('_target_feature', 'ep_next')
+    time_limit = scenario.pop('time_limit', time_limit)
+    start = time.perf_counter()
+    try:
+        session = OptimizationSession(target, players=_SCENARIO_PLAYERS, **scenario)
+        final_team, objective_value, team_cost = session.solve(time_limit=time_limit)
+        status, player_ids = solve_status(session.model), final_team['player_id'].tolist()
+        if status not in (LpStatus[LpStatusOptimal], TIME_LIMIT_STATUS):
+            # the values of an infeasible or unsolved model are not a team
+            objective_value, team_cost, player_ids = None, None, []
+    except Exception as error:
+        logging.info(error)
+        status, objective_value, team_cost, player_ids = f"Error: {error!r}", None, None, []
+    return {'scenario': name, 'target': target, 'status': status, 'objective': objective_value, 'cost': team_cost,
+            'solve_time': time.perf_counter() - start, 'player_ids': player_ids}
+
+
+def run_scenarios(scenarios: Iterable[dict], workers: int = 1, time_limit: Optional[float] = None,
+                  players: Optional[pd.DataFrame] = None, data_source: str = 'api', optimization_date: date = date.today()) -> pd.DataFrame:
+    """Solves many what-if optimizations in parallel over one players snapshot
+
+    Each scenario is a dictionary of run_optimization keyword arguments (_target_feature, _budget,
+    _team_limit_dict, _must_avoid_ids, ...) with an optional 'name' and 'time_limit' in seconds,
+    which overrides the shared one and is passed to the solver. The snapshot is sent once to every worker.
+    A scenario stopped by its time limit with a feasible team gets the TIME_LIMIT_STATUS status, the team
+    may not be optimal. Infeasible and unsolved scenarios get no objective, cost or player ids.
+
+    The time limit only bounds CBC's search, building the model and starting the solver are not
+    included, and there is no wall-clock limit on a scenario.
+
+    :param scenarios: Scenarios to solve
+    :type scenarios: Iterable[dict]
+    :param workers: Number of worker processes, scenarios are solved in this process for 1
+    :type workers: int
+    :param time_limit: Solver time limit in seconds for every scenario, see above
+    :type time_limit: float
+    :param players: Players snapshot, loaded from data_source when not given
+    :type players: pd.DataFrame
+    :return: One row per scenario with status, objective, cost, solve time and chosen player ids
+    """
+    scenarios = [dict(scenario, name=scenario.get('name', i)) for i, scenario in enumerate(scenarios)]
+    players = load_players(data_source, optimization_date) if players is None else players
+    if workers <= 1:
+        _init_scenario_worker(players)
+        results = [_solve_scenario(scenario, time_limit) for scenario in scenarios]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_scenario_worker, initargs=(players,)) as executor:
+            results = list(executor.map(_solve_scenario, scenarios, [time_limit] * len(scenarios)))
+    return pd.DataFrame(results, columns=['scenario', 'target', 'status', 'objective', 'cost', 'solve_time', 'player_ids'])
+
 
 if __name__ == '__main__':
     target = 'ep_next'
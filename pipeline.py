@@ -0,0 +1,158 @@
+"""
+Runs stages with declared dependencies concurrently, each with its own timeout and fallback result
+
+Stages whose dependencies are done are submitted at once, I/O bound ones (api, database, smtp) to a
+thread pool and CPU bound ones (model building) to a process pool. A stage which raises or runs past
+its timeout is given its fallback result, so the stages depending on it and the pipeline carry on with
+partial results. The start, end and status of every stage are kept in a timing table.
+"""
+import time
+import logging
+import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+THREAD_WORKERS = 4
+PROCESS_WORKERS = 2
+EXECUTORS = ('thread', 'process')
+# stage statuses
+DONE, FAILED, TIMED_OUT = 'done', 'failed', 'timed out'
+
+
+class Stage:
+    """One step of a pipeline
+
+    Functions of process stages, their arguments and results have to be picklable.
+
+    :param name: Unique name of the stage, also the keyword its result is passed to dependent stages with
+    :type name: str
+    :param func: Function computing the result
+    :type func: Callable
+    :param depends_on: Names of the stages which have to finish first
+    :type depends_on: Iterable[str]
+    :param inputs: Names of the stages whose results are passed to func as keyword arguments, they are dependencies too
+    :type inputs: Iterable[str]
+    :param executor: 'thread' or 'process'
+    :type executor: str
+    :param timeout: Seconds the stage may run for, no limit when None
+    :type timeout: float
+    :param fallback: Result used when the stage fails or times out
+    :param kwargs: Further keyword arguments of func
+    """
+    def __init__(self, name: str, func: Callable, depends_on: Iterable[str] = (), inputs: Iterable[str] = (),
+                 executor: str = 'thread', timeout: Optional[float] = None, fallback: Any = None, **kwargs):
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor {executor}, expected one of {EXECUTORS}")
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.depends_on = list(dict.fromkeys([*depends_on, *self.inputs]))
+        self.executor = executor
+        self.timeout = timeout
+        self.fallback = fallback
+        self.kwargs = kwargs
+
+
+class Pipeline:
+    """Stages run as soon as their dependencies are done
+
+    Python can not stop a running thread or a busy worker process, so a timed out stage is abandoned
+    rather than killed, its result is dropped when it eventually finishes.
+
+    :param stages: Stages of the pipeline, in any order
+    :type stages: Iterable[Stage]
+    :param thread_workers: Size of the thread pool
+    :type thread_workers: int
+    :param process_workers: Size of the process pool, only started when a process stage exists
+    :type process_workers: int
+    """
+    def __init__(self, stages: Iterable[Stage] = (), thread_workers: int = THREAD_WORKERS, process_workers: int = PROCESS_WORKERS):
+        self.stages: Dict[str, Stage] = {}
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.results: Dict[str, Any] = {}
+        self.timings = pd.DataFrame()
+        self.elapsed = None
+        for stage in stages:
+            self.add(stage)
+
+    def add(self, stage: Stage) -> 'Pipeline':
+        if stage.name in self.stages:
+            raise ValueError(f"Stage {stage.name} is declared twice")
+        self.stages[stage.name] = stage
+        return self
+
+    def order(self) -> List[str]:
+        """Stage names in an order which respects the dependencies
+        """
+        order, visiting = [], set()
+
+        def visit(name: str, path: tuple):
+            if name not in self.stages:
+                raise ValueError(f"Stage {path[-1]} depends on unknown stage {name}")
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle: {' -> '.join(path + (name,))}")
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency, path + (name,))
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, ())
+        return order
+
+    def run(self) -> Dict[str, Any]:
+        """Runs all stages and returns their results, fallbacks in place of failed or timed out ones
+
+        The timing table of the run is kept in self.timings and its wall time in self.elapsed.
+        """
+        pending = self.order()
+        executors = {'thread': ThreadPoolExecutor(max_workers=self.thread_workers)}
+        if any(self.stages[name].executor == 'process' for name in pending):
+            executors['process'] = ProcessPoolExecutor(max_workers=self.process_workers)
+        self.results, records = {}, {}
+        running: Dict[Future, str] = {}
+        start = time.perf_counter()
+        try:
+            while pending or running:
+                for name in [name for name in pending if all(dep in self.results for dep in self.stages[name].depends_on)]:
+                    stage = self.stages[name]
+                    inputs = {dep: self.results[dep] for dep in stage.inputs}
+                    future = executors[stage.executor].submit(stage.func, **inputs, **stage.kwargs)
+                    running[future] = name
+                    records[name] = {'stage': name, 'executor': stage.executor, 'depends_on': ', '.join(stage.depends_on),
+                                     'start_s': time.perf_counter() - start}
+                    pending.remove(name)
+                now = time.perf_counter() - start
+                deadlines = [records[name]['start_s'] + self.stages[name].timeout for name in running.values()
+                             if self.stages[name].timeout is not None]
+                done, _ = wait(list(running), timeout=max(min(deadlines) - now, 0) if deadlines else None,
+                               return_when=FIRST_COMPLETED)
+                now = time.perf_counter() - start
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self._finish(name, records[name], now, DONE, future.result())
+                    except Exception as error:
+                        logging.info(f"Stage {name} failed: {error!r}")
+                        self._finish(name, records[name], now, FAILED, self.stages[name].fallback, error)
+                for future, name in list(running.items()):
+                    timeout = self.stages[name].timeout
+                    if timeout is not None and now - records[name]['start_s'] >= timeout:
+                        logging.info(f"Stage {name} timed out after {timeout}s, using its fallback")
+                        future.cancel()
+                        running.pop(future)
+                        self._finish(name, records[name], now, TIMED_OUT, self.stages[name].fallback)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+        self.timings = pd.DataFrame([records[name] for name in self.order()]).set_index('stage')
+        self.elapsed = time.perf_counter() - start
+        return self.results
+
+    def _finish(self, name: str, record: dict, now: float, status: str, result: Any, error: Optional[Exception] = None) -> None:
+        self.results[name] = result
+        record.update({'end_s': now, 'duration_s': now - record['start_s'], 'status': status,
+                       'error': '' if error is None else repr(error)})
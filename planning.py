@@ -0,0 +1,206 @@
+"""
+Multi-gameweek squad and transfer planning over a (players x gameweeks) expected points matrix
+"""
+import logging
+import numpy as np
+import pandas as pd
+from typing import Iterable, List, Optional, Tuple
+from pulp import LpMaximize, LpProblem, LpVariable, LpAffineExpression, LpConstraint, LpConstraintEQ, LpConstraintGE, \
+    LpConstraintLE, PULP_CBC_CMD
+from fantasy_football.optimization import TEAM_SIZE, TEAM_CONSTRAINTS, POSITION_CONSTRAINTS, POSITION_MAP, \
+    find_dominated_players, max_full_teams, solve_status, _group_indices
+
+SQUAD_SIZE = 15
+SQUAD_POSITIONS = {'GKP': 2,
+                   'DEF': 5,
+                   'MID': 5,
+                   'FWD': 3}
+# the game's 100.0 budget in now_cost units
+SQUAD_BUDGET = 1000
+MAX_FREE_TRANSFERS = 2
+TRANSFER_PENALTY = 4
+# share of the expected points of bench players counted in the objective, covers for autosubs
+BENCH_WEIGHT = 0.1
+# seconds, 10 of 16 plans over 6 gameweeks of the synthetic 600-player pool were proven optimal within it, the
+# other 6 stopped with TIME_LIMIT_STATUS at most 0.7% below the optimum, which took 14-76 s to prove
+SOLVER_TIME_LIMIT = 10
+
+
+def prune_squad_candidates(expected_points: pd.DataFrame, players: pd.DataFrame, keep_ids: Iterable[int] = (),
+                           _team_limit_dict: dict = TEAM_CONSTRAINTS) -> pd.DataFrame:
+    """Drops players who are dominated over the whole horizon by enough players of their position
+
+    A player is dominated when enough cheaper-or-equal players of the position expect at least as many
+    points summed over the horizon, see find_dominated_players. This is a heuristic: the argument is only
+    exact for a single gameweek, across transfers a pruned player can be worth holding for the gameweeks
+    in which his dominators are not in the squad.
+
+    :param expected_points: (players x gameweeks) expected points indexed by player_id
+    :param players: Players frame indexed by player_id, with team, position and now_cost columns
+    :param keep_ids: Players never dropped, e.g. the current squad
+    :return: Expected points of the remaining players
+    """
+    players = players.loc[expected_points.index]
+    team_code, _ = pd.factorize(players['team'])
+    position_code, positions = pd.factorize(players['position'])
+    slots = np.array([SQUAD_POSITIONS[position] for position in positions])
+    dominated = find_dominated_players(position_code, team_code, players['now_cost'].to_numpy(dtype=float),
+                                       expected_points.to_numpy(dtype=float).sum(axis=1), slots,
+                                       max_full_teams(_team_limit_dict, SQUAD_SIZE - 1))
+    dominated &= ~expected_points.index.isin(list(keep_ids))
+    logging.info(f"Pruned {dominated.sum()} of {len(dominated)} dominated players")
+    return expected_points[~dominated]
+
+
+def _variables(prefix: str, player_ids: np.ndarray, gameweeks: Iterable[int], cat: str = "Binary") -> np.ndarray:
+    return np.array([[LpVariable(f"{prefix}_{_id}_{gw}", lowBound=0, upBound=1, cat=cat) for gw in gameweeks] for _id in player_ids], dtype=object)
+
+
+def _sum(variables: Iterable, coefficients: Optional[Iterable[float]] = None) -> LpAffineExpression:
+    variables = list(variables)
+    if coefficients is None:
+        coefficients = np.ones(len(variables))
+    return LpAffineExpression(zip(variables, coefficients))
+
+
+def count_hits(n_transfers: Iterable[int], free_transfers: int = 1, first_is_free: bool = False) -> List[int]:
+    """Transfers paid with TRANSFER_PENALTY in every gameweek, unused free transfers roll over up to MAX_FREE_TRANSFERS
+
+    :param n_transfers: Number of transfers in every gameweek
+    :param free_transfers: Free transfers available in the first gameweek
+    :param first_is_free: The first gameweek picks the whole squad for free, the second one has a single free transfer
+    """
+    hits = []
+    for w, n in enumerate(n_transfers):
+        if w == 0 and first_is_free:
+            hits.append(0)
+            free_transfers = 1
+            continue
+        hits.append(max(0, n - free_transfers))
+        free_transfers = min(MAX_FREE_TRANSFERS, 1 + max(0, free_transfers - n))
+    return hits
+
+
+def plan_transfers(expected_points: pd.DataFrame, players: pd.DataFrame, current_squad: Optional[List[int]] = None,
+                   bank: Optional[float] = None, free_transfers: int = 1, _team_limit_dict: dict = TEAM_CONSTRAINTS,
+                   _pos_limit_dict: dict = POSITION_CONSTRAINTS, bench_weight: float = BENCH_WEIGHT, prune: bool = True,
+                   time_limit: Optional[float] = SOLVER_TIME_LIMIT) -> Tuple[pd.DataFrame, float, str]:
+    """Plans a 15-man squad, starting 11, captain and transfers for every gameweek of the horizon
+
+    Each gameweek the squad keeps SQUAD_POSITIONS and the team limits, the starting 11 follows the
+    position limits of run_optimization and the captain scores twice. Every transfer beyond the free
+    ones costs TRANSFER_PENALTY points, and unused free transfers roll over up to MAX_FREE_TRANSFERS.
+    Players are sold for their now_cost.
+
+    Captain, transfers and hits are continuous, they take integral values once the squad and the
+    starting 11 are integral.
+
+    :param expected_points: (players x gameweeks) expected points indexed by player_id, e.g. from HorizonPredictions
+    :param players: Players frame indexed by player_id, with team, position and now_cost columns
+    :param current_squad: Ids of the current 15 players, the squad is picked freely in the first gameweek when not given
+    :param bank: Money in the bank, SQUAD_BUDGET when there is no current squad and 0 otherwise
+    :param free_transfers: Free transfers available in the first gameweek
+    :param prune: Removes dominated players before solving, a heuristic, see prune_squad_candidates
+    :param time_limit: Solver time limit in seconds
+    :return: The plan with one row per gameweek, objective value and solver status, TIME_LIMIT_STATUS when the
+        time limit stopped the solver before it proved the plan optimal
+    """
+    current_squad = list(current_squad) if current_squad is not None else None
+    if bank is None:
+        bank = SQUAD_BUDGET if current_squad is None else 0
+    if prune:
+        expected_points = prune_squad_candidates(expected_points, players, current_squad or (), _team_limit_dict)
+    players = players.loc[expected_points.index]
+    player_ids = expected_points.index.to_numpy()
+    gameweeks = list(expected_points.columns)
+    xp = expected_points.to_numpy(dtype=float)
+    cost = players['now_cost'].to_numpy(dtype=float)
+    team_code, teams = pd.factorize(players['team'])
+    position_code, positions = pd.factorize(players['position'])
+    team_groups = _group_indices(team_code, len(teams))
+    position_groups = _group_indices(position_code, len(positions))
+    in_squad = np.isin(player_ids, current_squad) if current_squad is not None else np.zeros(len(player_ids), dtype=bool)
+    budget = bank + cost[in_squad].sum()
+
+    squad = _variables("squad", player_ids, gameweeks)
+    lineup = _variables("lineup", player_ids, gameweeks)
+    captain = _variables("captain", player_ids, gameweeks, "Continuous")
+    transfer_in = _variables("in", player_ids, gameweeks, "Continuous")
+    hits = [LpVariable(f"hits_{gw}", lowBound=0) for gw in gameweeks]
+    rolled = [LpVariable(f"rolled_{gw}", lowBound=0, upBound=MAX_FREE_TRANSFERS - 1, cat="Integer") for gw in gameweeks]
+
+    model = LpProblem(name="FPL_transfer_plan", sense=LpMaximize)
+    objective = LpAffineExpression()
+    constraints = []
+    for w, gw in enumerate(gameweeks):
+        objective += _sum(squad[:, w], bench_weight * xp[:, w]) + _sum(lineup[:, w], (1 - bench_weight) * xp[:, w]) \
+            + _sum(captain[:, w], xp[:, w]) - TRANSFER_PENALTY * hits[w]
+
+        # squad composition
+        constraints.append(LpConstraint(_sum(squad[:, w]), LpConstraintEQ, f"squad_size_{gw}", SQUAD_SIZE))
+        constraints.append(LpConstraint(_sum(squad[:, w], cost), LpConstraintLE, f"budget_{gw}", budget))
+        for team, idx in zip(teams, team_groups):
+            constraints.append(LpConstraint(_sum(squad[idx, w]), LpConstraintLE, f"{team}_{gw}", _team_limit_dict[team]))
+        for _position, idx in zip(positions, position_groups):
+            constraints.append(LpConstraint(_sum(squad[idx, w]), LpConstraintEQ, f"squad_{_position}_{gw}", SQUAD_POSITIONS[_position]))
+            limit = _pos_limit_dict[_position]
+            if isinstance(limit, (tuple, list)):
+                constraints.append(LpConstraint(_sum(lineup[idx, w]), LpConstraintGE, f"min_{_position}_{gw}", limit[0]))
+                constraints.append(LpConstraint(_sum(lineup[idx, w]), LpConstraintLE, f"max_{_position}_{gw}", limit[1]))
+            else:
+                constraints.append(LpConstraint(_sum(lineup[idx, w]), LpConstraintEQ, f"{_position}_{gw}", limit))
+
+        # starting 11 and captain
+        constraints.append(LpConstraint(_sum(lineup[:, w]), LpConstraintEQ, f"lineup_size_{gw}", TEAM_SIZE))
+        constraints.append(LpConstraint(_sum(captain[:, w]), LpConstraintEQ, f"captain_{gw}", 1))
+        for i, _id in enumerate(player_ids):
+            constraints.append(LpConstraint(lineup[i, w] - squad[i, w], LpConstraintLE, f"lineup_in_squad_{_id}_{gw}", 0))
+            constraints.append(LpConstraint(captain[i, w] - lineup[i, w], LpConstraintLE, f"captain_in_lineup_{_id}_{gw}", 0))
+
+        # transfers
+        if w == 0 and current_squad is None:
+            continue
+        for i, _id in enumerate(player_ids):
+            previous = squad[i, w - 1] if w > 0 else int(in_squad[i])
+            constraints.append(LpConstraint(transfer_in[i, w] - squad[i, w] + previous, LpConstraintGE, f"bought_{_id}_{gw}", 0))
+        if w == 0:
+            free = LpAffineExpression(constant=free_transfers)
+        elif w == 1 and current_squad is None:
+            free = LpAffineExpression(constant=1)
+        else:
+            # one new free transfer each gameweek, plus the ones rolled from the previous gameweek
+            free = rolled[w - 1] + 1
+        # transfers beyond the free and the rolled ones are hits, paying a hit to roll a transfer never gains
+        # points so the hits of the plan are counted by count_hits
+        kept = rolled[w] if w + 1 < len(gameweeks) else 0
+        constraints.append(LpConstraint(hits[w] - _sum(transfer_in[:, w]) + free - kept, LpConstraintGE, f"hits_{gw}", 0))
+
+    model.setObjective(objective)
+    for constraint in constraints:
+        model.addConstraint(constraint)
+    model.solve(PULP_CBC_CMD(msg=False, timeLimit=time_limit))
+
+    def chosen(variables: np.ndarray) -> np.ndarray:
+        return np.array([(var.value() or 0) > 0.5 for var in variables])
+
+    selected = np.column_stack([chosen(squad[:, w]) for w in range(len(gameweeks))])
+    previous = np.column_stack([in_squad, selected[:, :-1]])
+    bought, sold = selected & ~previous, previous & ~selected
+    if current_squad is None:
+        bought[:, 0] = False
+    hits_taken = count_hits(bought.sum(axis=0), free_transfers, first_is_free=current_squad is None)
+    plan = []
+    for w, gw in enumerate(gameweeks):
+        in_lineup = chosen(lineup[:, w])
+        # the model captains the starter with the most expected points
+        best = player_ids[in_lineup][np.argmax(xp[in_lineup, w])] if in_lineup.any() else None
+        plan.append({'gameweek': gw,
+                     'transfers_in': player_ids[bought[:, w]].tolist(),
+                     'transfers_out': player_ids[sold[:, w]].tolist(),
+                     'hits': hits_taken[w],
+                     'captain': best,
+                     'lineup': sorted(player_ids[in_lineup].tolist(), key=lambda _id: POSITION_MAP[players.loc[_id, 'position']]),
+                     'bench': player_ids[selected[:, w] & ~in_lineup].tolist(),
+                     'expected_points': xp[in_lineup, w].sum() + xp[in_lineup, w].max(initial=0) - TRANSFER_PENALTY * hits_taken[w],
+                     'squad_cost': cost[selected[:, w]].sum()})
+    return pd.DataFrame(plan), model.objective.value(), solve_status(model)
@@ -1,16 +1,132 @@
+from __future__ import annotations
 import os
 import yaml
-import pandas as pd
 import numpy as np
 from pathlib import Path
-from typing import Iterable, Tuple
-from scipy.stats import poisson
-from fantasy_football.statistical_utils import get_goal_data, bivariate_poisson_sum, calculate_odds
-from fantasy_football.api import get_all_players, get_fixtures
+from functools import lru_cache
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+from fantasy_football.lazy import lazy_import
+from fantasy_football.statistical_utils import get_goal_data, bivariate_poisson_sum, bivariate_poisson_batch, calculate_odds
+from fantasy_football.api import get_all_players, get_fixtures, TEAM_NAMES, POSITIONS
+from fantasy_football.fixture_cache import FixturePredictionCache, get_fixture_cache, parameters_hash
+from fantasy_football.instrumentation import timed
+
+pd = lazy_import('pandas')
+stats = lazy_import('scipy.stats')
 
 
 HALF_SEASON = 19
 KAPPA = 1
+FULL_APPEARANCE_MINUTES = 2500
+# points for an expected goal, an expected assist, a clean sheet probability and an appearance
+POSITION_WEIGHTS = {'GKP': (0, 0, 4, 2),
+                    'DEF': (6, 3, 4, 2),
+                    'MID': (5, 3, 1, 2),
+                    'FWD': (4, 3, 0, 2)}
+# the same weights as a lookup table indexed by position code - the position in api.POSITIONS
+POSITION_SCORING = np.array([POSITION_WEIGHTS[position] for position in POSITIONS], dtype=float)
+
+
+class StrengthPrediction(NamedTuple):
+    home_xg: np.ndarray
+    away_xg: np.ndarray
+    outcome_probs: np.ndarray
+    home_cs_prob: np.ndarray
+    away_cs_prob: np.ndarray
+    score_probs: Optional[np.ndarray] = None
+
+
+def team_codes(team_names: Iterable[str], teams: List[str]) -> np.ndarray:
+    """Position of every team name in ``teams``
+    """
+    codes = pd.Categorical(list(team_names), categories=teams).codes.astype(np.intp)
+    if (codes < 0).any():
+        raise KeyError(f"Unknown teams: {set(team_names) - set(teams)}")
+    return codes
+
+
+class TeamStrengthModel:
+    """Team strengths derived from the goal table in config/teams_goals.yaml
+
+    The table is parsed once into arrays indexed by team code - the position of the team in TEAM_NAMES -
+    so any number of fixtures is predicted in a single batched computation.
+    """
+    def __init__(self, goal_dict: Optional[dict] = None, kappa: float = KAPPA, teams: Optional[Iterable[str]] = None):
+        goal_dict = get_goal_data() if goal_dict is None else goal_dict
+        self.kappa = kappa
+        self.teams = list(TEAM_NAMES if teams is None else teams)
+        self.team_index = {team: i for i, team in enumerate(self.teams)}
+
+        home_scored, home_lost = self._goal_arrays(goal_dict['home'])
+        away_scored, away_lost = self._goal_arrays(goal_dict['away'])
+        self.avg_scored_home = np.mean(list(goal_dict['home']['scored'].values()))
+        self.avg_lost_home = np.mean(list(goal_dict['home']['lost'].values()))
+        self.avg_scored_away = np.mean(list(goal_dict['away']['scored'].values()))
+        self.avg_lost_away = np.mean(list(goal_dict['away']['lost'].values()))
+
+        self.home_offensive_str = (home_scored / self.avg_scored_home) ** kappa
+        self.home_defensive_str = (home_lost / self.avg_lost_home) ** kappa
+        self.away_offensive_str = (away_scored / self.avg_scored_away) ** kappa
+        self.away_defensive_str = (away_lost / self.avg_lost_away) ** kappa
+
+    def _goal_arrays(self, venue_goals: dict) -> Tuple[np.ndarray, np.ndarray]:
+        scored = np.array([venue_goals['scored'].get(team, np.nan) for team in self.teams], dtype=float)
+        lost = np.array([venue_goals['lost'].get(team, np.nan) for team in self.teams], dtype=float)
+        return scored, lost
+
+    def team_codes(self, team_names: Iterable[str]) -> np.ndarray:
+        return team_codes(team_names, self.teams)
+
+    @property
+    def version(self) -> str:
+        """Hash of the strengths, it changes with the goal table
+        """
+        return parameters_hash(self.teams, self.kappa, self.avg_scored_home, self.avg_lost_home, self.avg_scored_away,
+                               self.avg_lost_away, self.home_offensive_str, self.home_defensive_str,
+                               self.away_offensive_str, self.away_defensive_str)
+
+    def predict_xg(self, home_idx: np.ndarray, away_idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        home_idx, away_idx = np.asarray(home_idx), np.asarray(away_idx)
+        home_xg = self.avg_scored_home * self.home_offensive_str[home_idx] * self.away_defensive_str[away_idx] / HALF_SEASON
+        away_xg = self.avg_scored_away * self.away_offensive_str[away_idx] * self.home_defensive_str[home_idx] / HALF_SEASON
+        return home_xg, away_xg
+
+    def predict(self, home_idx: np.ndarray, away_idx: np.ndarray, return_scores: bool = False) -> StrengthPrediction:
+        """Predicts all given fixtures at once
+
+        :param home_idx: Team codes of the home sides
+        :type home_idx: np.ndarray
+        :param away_idx: Team codes of the away sides
+        :type away_idx: np.ndarray
+        :param return_scores: Also returns the correct score tensor
+        :type return_scores: bool
+        :return: xG, (n_fixtures, 3) home/draw/away probabilities and clean sheet probabilities
+        """
+        home_xg, away_xg = self.predict_xg(home_idx, away_idx)
+        outcome_probs = bivariate_poisson_batch(home_xg, away_xg, return_scores=return_scores)
+        score_probs = None
+        if return_scores:
+            outcome_probs, score_probs = outcome_probs
+        # home cleansheet is given by away_xg and vice versa !!!!
+        return StrengthPrediction(home_xg, away_xg, outcome_probs, np.exp(-away_xg), np.exp(-home_xg), score_probs)
+
+
+def predict_fixtures(model: TeamStrengthModel, fixtures: pd.DataFrame,
+                     cache: Optional[FixturePredictionCache] = None) -> StrengthPrediction:
+    """Predicts the fixtures with the model, reusing the predictions cached for the fixture ids and the model version
+
+    Fixtures without an id column are always predicted.
+    """
+    cache = get_fixture_cache() if cache is None else cache
+    home_idx, away_idx = model.team_codes(fixtures['team_h']), model.team_codes(fixtures['team_a'])
+    if 'id' not in fixtures.columns:
+        return model.predict(home_idx, away_idx)
+    return StrengthPrediction(*cache.predict(model, fixtures['id'], home_idx, away_idx))
+
+
+@lru_cache(maxsize=None)
+def get_team_strength_model(kappa: float = KAPPA) -> TeamStrengthModel:
+    return TeamStrengthModel(kappa=kappa)
 
 
 class MatchPrediction:
@@ -18,22 +134,15 @@ class MatchPrediction:
         self.home_team = home_team
         self.away_team = away_team
 
-        goal_dict = get_goal_data()
-        df_home_goals = pd.DataFrame(goal_dict['home'])
-        df_away_goals = pd.DataFrame(goal_dict['away'])
-
-        avg_scored_home = df_home_goals['scored'].mean()
-        avg_lost_home = df_home_goals['lost'].mean()
-        avg_scored_away = df_away_goals['scored'].mean()
-        avg_lost_away = df_away_goals['lost'].mean()
+        model = get_team_strength_model(kappa)
+        home_idx, away_idx = model.team_index[home_team], model.team_index[away_team]
+        self.home_offensive_str = model.home_offensive_str[home_idx]
+        self.home_defensive_str = model.home_defensive_str[home_idx]
+        self.away_offensive_str = model.away_offensive_str[away_idx]
+        self.away_defensive_str = model.away_defensive_str[away_idx]
 
-        self.home_offensive_str = (df_home_goals.loc[home_team]['scored'] / avg_scored_home) ** kappa
-        self.home_defensive_str = (df_home_goals.loc[home_team]['lost'] / avg_lost_home) ** kappa
-        self.away_offensive_str = (df_away_goals.loc[away_team]['scored'] / avg_scored_away) ** kappa
-        self.away_defensive_str = (df_away_goals.loc[away_team]['lost'] / avg_lost_away) ** kappa
-
-        self.home_xg = avg_scored_home * self.home_offensive_str * self.away_defensive_str / HALF_SEASON
-        self.away_xg = avg_scored_away * self.away_offensive_str * self.home_defensive_str / HALF_SEASON
+        home_xg, away_xg = model.predict_xg(home_idx, away_idx)
+        self.home_xg, self.away_xg = float(home_xg), float(away_xg)
 
         self.outcome_probs = None
         self.clean_sheet_probs = None
@@ -50,7 +159,7 @@ class MatchPrediction:
     def get_clean_sheet_probs(self):
         if self.clean_sheet_probs is None:
             # home cleansheet is given by away_xg and vice versa !!!!
-            self.clean_sheet_probs = poisson.pmf(0, self.away_xg), poisson.pmf(0, self.home_xg)
+            self.clean_sheet_probs = stats.poisson.pmf(0, self.away_xg), stats.poisson.pmf(0, self.home_xg)
         return self.clean_sheet_probs
 
     def get_implied_odds(self):
@@ -63,30 +172,133 @@ class MatchPrediction:
 
 def calculate_expected_points(player_info: pd.Series) -> float:
     position, prob_playing, ex_goals, ex_assists, cleansheet_prob = player_info
-    if position == 'GKP':
-        ex_score = 4 * cleansheet_prob + 2 
-    elif position == 'DEF':
-        ex_score = 6 * ex_goals + 3 * ex_assists + 4 * cleansheet_prob + 2
-    elif position == 'MID':
-        ex_score = 5 * ex_goals + 3 * ex_assists + 1 * cleansheet_prob + 2
-    elif position == 'FWD':
-        ex_score = 4 * ex_goals + 3 * ex_assists + 2
+    goal_weight, assist_weight, cleansheet_weight, appearance_weight = POSITION_WEIGHTS[position]
+    ex_score = goal_weight * ex_goals + assist_weight * ex_assists + cleansheet_weight * cleansheet_prob + appearance_weight
     return ex_score * prob_playing
 
 
+def position_codes(positions: Iterable[str]) -> np.ndarray:
+    codes = pd.Categorical(list(positions), categories=POSITIONS).codes.astype(np.intp)
+    if (codes < 0).any():
+        raise KeyError(f"Unknown positions: {set(positions) - set(POSITIONS)}")
+    return codes
+
+
+def team_fixture_totals(team_code: np.ndarray, xg: np.ndarray, cs_prob: np.ndarray, n_teams: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sums one row per team and fixture into per-team arrays, so blank and double gameweeks need no special cases
+
+    :return: Summed xG, summed clean sheet probabilities and number of fixtures, each of shape (n_teams,)
+    """
+    team_code = np.asarray(team_code)
+    team_xg = np.bincount(team_code, weights=xg, minlength=n_teams)
+    team_cs_prob = np.bincount(team_code, weights=cs_prob, minlength=n_teams)
+    team_n_fixtures = np.bincount(team_code, minlength=n_teams).astype(float)
+    return team_xg, team_cs_prob, team_n_fixtures
+
+
+def expected_points_array(position_code: np.ndarray, prob_playing: np.ndarray, expected_goals: np.ndarray,
+                          expected_assists: np.ndarray, cs_prob: np.ndarray, n_fixtures=1) -> np.ndarray:
+    """Array version of calculate_expected_points, with the appearance points counted once per fixture
+    """
+    weights = POSITION_SCORING[position_code]
+    ex_score = (weights[..., 0] * expected_goals + weights[..., 1] * expected_assists
+                + weights[..., 2] * cs_prob + weights[..., 3] * n_fixtures)
+    return ex_score * prob_playing
+
+
+def player_rates(team_code: np.ndarray, goals_scored: np.ndarray, assists: np.ndarray, minutes: np.ndarray,
+                 chance_of_playing: np.ndarray, n_teams: int) -> dict:
+    """Fixture-independent inputs of the expected points - players' shares of team goals and probability of playing
+    """
+    team_code = np.asarray(team_code)
+    goals_scored = np.asarray(goals_scored, dtype=float)
+    team_total_goals = np.bincount(team_code, weights=goals_scored, minlength=n_teams).clip(min=1)[team_code]
+    team_total_assists = np.bincount(team_code, weights=assists, minlength=n_teams).clip(min=1)[team_code]
+
+    # calculating players' impact on goals, assists
+    goal_share_adj = goals_scored ** 2 / team_total_goals ** 2
+    assist_share_adj = goals_scored ** 2 / team_total_assists ** 2
+
+    # Estimating probability of appearance
+    chance_of_playing = np.where(np.isnan(chance_of_playing), 100, chance_of_playing)
+    prob_playing = np.minimum(np.asarray(minutes) / FULL_APPEARANCE_MINUTES, 1) * chance_of_playing / 100
+    return {'team_total_goals': team_total_goals,
+            'team_total_assists': team_total_assists,
+            'goal_share_flat': goals_scored / team_total_goals,
+            'goal_share_adj': goal_share_adj,
+            'assist_share_flat': goals_scored / team_total_assists,
+            'assist_share_adj': assist_share_adj,
+            'chance_of_playing_next_round': chance_of_playing,
+            'prob_playing': prob_playing}
+
+
+def score_players(team_code: np.ndarray, position_code: np.ndarray, goals_scored: np.ndarray, assists: np.ndarray,
+                  minutes: np.ndarray, chance_of_playing: np.ndarray, team_xg: np.ndarray, team_cs_prob: np.ndarray,
+                  team_n_fixtures: np.ndarray) -> dict:
+    """Expected points of all players from plain arrays, without pandas
+
+    :param team_code: Team code of every player
+    :param position_code: Position code of every player
+    :param goals_scored: Goals scored this season
+    :param assists: Assists this season
+    :param minutes: Minutes played this season
+    :param chance_of_playing: Chance of playing next round in percent, NaN when not flagged
+    :param team_xg: Expected goals of every team in the gameweek, see team_fixture_totals
+    :param team_cs_prob: Clean sheet probabilities of every team in the gameweek
+    :param team_n_fixtures: Number of fixtures of every team in the gameweek
+    :return: Dictionary of per-player arrays, including 'expected_points'
+    """
+    team_code = np.asarray(team_code)
+    rates = player_rates(team_code, goals_scored, assists, minutes, chance_of_playing, len(team_xg))
+    player_team_xg = np.asarray(team_xg)[team_code]
+    player_team_cs_prob = np.asarray(team_cs_prob)[team_code]
+    expected_goals = player_team_xg * rates['goal_share_adj']
+    expected_assists = player_team_xg / 2 * rates['assist_share_adj']
+    expected_points = expected_points_array(position_code, rates['prob_playing'], expected_goals, expected_assists,
+                                            player_team_cs_prob, np.asarray(team_n_fixtures)[team_code])
+    return {'team_xg': player_team_xg,
+            'team_cs_prob': player_team_cs_prob,
+            **rates,
+            'expected_goals': expected_goals,
+            'expected_assists': expected_assists,
+            'expected_points': expected_points}
+
+
+def expected_points_matrix(team_code: np.ndarray, position_code: np.ndarray, goal_share_adj: np.ndarray,
+                           assist_share_adj: np.ndarray, prob_playing: np.ndarray, team_xg: np.ndarray,
+                           team_cs_prob: np.ndarray, team_n_fixtures: np.ndarray) -> np.ndarray:
+    """Expected points of all players in many gameweeks at once
+
+    :param team_xg: Summed xG of every team, shape (n_gameweeks, n_teams)
+    :param team_cs_prob: Summed clean sheet probabilities, shape (n_gameweeks, n_teams)
+    :param team_n_fixtures: Number of fixtures, shape (n_gameweeks, n_teams)
+    :return: (n_players, n_gameweeks) float32 matrix
+    """
+    player_team_xg = np.asarray(team_xg)[:, team_code]
+    expected_points = expected_points_array(position_code, prob_playing, player_team_xg * goal_share_adj,
+                                            player_team_xg / 2 * assist_share_adj, np.asarray(team_cs_prob)[:, team_code],
+                                            np.asarray(team_n_fixtures)[:, team_code])
+    return np.ascontiguousarray(expected_points.T, dtype=np.float32)
+
+
 class GameweekPredictions:
-    def __init__(self, gameweek: int) -> None:
+    def __init__(self, gameweek: int, model: Optional[TeamStrengthModel] = None, fixtures: Optional[pd.DataFrame] = None,
+                 players: Optional[pd.DataFrame] = None) -> None:
         self.gameweek = gameweek
-        self.fixtures = get_fixtures().query(f"event == {self.gameweek}")
-        self.players = get_all_players()
+        self.model = get_team_strength_model() if model is None else model
+        fixtures = get_fixtures() if fixtures is None else fixtures
+        self.fixtures = fixtures.query(f"event == {self.gameweek}").copy()
+        self.players = get_all_players() if players is None else players
         self.xg_dict = None
         self.cs_dict = None
         self.total_goals_dict = None
         self.total_assists_dict = None
 
+    @timed('predictions.predict_xg_and_cs')
     def predict_xg_and_cs(self):
-        self.fixtures['home_xg'], self.fixtures['away_xg'] = zip(*self.fixtures[['team_h', 'team_a']].apply(lambda x: MatchPrediction(x[0], x[1]).get_xg(), axis=1))
-        self.fixtures['home_cs_prob'], self.fixtures['away_cs_prob'] = zip(*self.fixtures[['team_h', 'team_a']].apply(lambda x: MatchPrediction(x[0], x[1]).get_clean_sheet_probs(), axis=1))
+        prediction = predict_fixtures(self.model, self.fixtures)
+        self.fixtures['home_xg'], self.fixtures['away_xg'] = prediction.home_xg, prediction.away_xg
+        self.fixtures['home_cs_prob'], self.fixtures['away_cs_prob'] = prediction.home_cs_prob, prediction.away_cs_prob
 
     def get_xg_dict(self) -> dict:
         if self.xg_dict is None:
@@ -100,34 +312,84 @@ class GameweekPredictions:
 
     def get_goals_dict(self) -> dict:
         if self.total_goals_dict is None:
-            self.total_goals_dict = self.players.groupby('team').sum()['goals_scored'].clip(lower=1).to_dict()
+            self.total_goals_dict = self.players.groupby('team')['goals_scored'].sum().clip(lower=1).to_dict()
         return self.total_goals_dict
 
     def get_assists_dict(self) -> dict:
         if self.total_assists_dict is None:
-            self.total_assists_dict = self.players.groupby('team').sum()['assists'].clip(lower=1).to_dict()
+            self.total_assists_dict = self.players.groupby('team')['assists'].sum().clip(lower=1).to_dict()
         return self.total_assists_dict
 
+    def get_team_fixture_totals(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        team_code = np.concatenate([self.model.team_codes(self.fixtures['team_h']), self.model.team_codes(self.fixtures['team_a'])])
+        xg = np.concatenate([self.fixtures['home_xg'], self.fixtures['away_xg']])
+        cs_prob = np.concatenate([self.fixtures['home_cs_prob'], self.fixtures['away_cs_prob']])
+        return team_fixture_totals(team_code, xg, cs_prob, len(self.model.teams))
+
+    @timed('predictions.map_expected_points')
     def map_expected_points(self):
-        # mapping teams' expected goals and cleansheet probilities, and aggregated data
-        self.players['team_xg'] =  self.players['team'].apply(lambda x: self.get_xg_dict()[x])
-        self.players['team_cs_prob'] =  self.players['team'].apply(lambda x: self.get_cs_prob_dict()[x])
-        self.players['team_total_goals'] =  self.players['team'].apply(lambda x: self.get_goals_dict()[x])
-        self.players['team_total_assists'] =  self.players['team'].apply(lambda x: self.get_assists_dict()[x])
-
-        # calculating players' impact on goals, assists
-        self.players['goal_share_flat'] = self.players['goals_scored'] / self.players['team_total_goals']
-        self.players['goal_share_adj'] = self.players['goals_scored'] ** 2 / self.players['team_total_goals'] ** 2
-        self.players['assist_share_flat'] = self.players['goals_scored'] / self.players['team_total_assists']
-        self.players['assist_share_adj'] = self.players['goals_scored'] ** 2 / self.players['team_total_assists'] ** 2
-        self.players['expected_goals'], self.players['expected_assists'] = self.players['team_xg'] * self.players['goal_share_adj'], self.players['team_xg'] / 2 * self.players['assist_share_adj']
-
-        # Estimating probability of appearance
-        self.players['chance_of_playing_next_round'] = self.players['chance_of_playing_next_round'].fillna(100)
-        self.players['prob_playing'] = (self.players['minutes'] / 2500).clip(upper=1) * self.players['chance_of_playing_next_round'] / 100
-
-        # calculating expected points based on given metrics
-        self.players['expected_points'] = self.players[['position', 'prob_playing', 'expected_goals', 'expected_assists', 'team_cs_prob']].apply(calculate_expected_points, axis=1)
+        team_xg, team_cs_prob, team_n_fixtures = self.get_team_fixture_totals()
+        scores = score_players(self.model.team_codes(self.players['team']),
+                               position_codes(self.players['position']),
+                               self.players['goals_scored'].to_numpy(dtype=float),
+                               self.players['assists'].to_numpy(dtype=float),
+                               self.players['minutes'].to_numpy(dtype=float),
+                               self.players['chance_of_playing_next_round'].to_numpy(dtype=float),
+                               team_xg, team_cs_prob, team_n_fixtures)
+        self.players = self.players.assign(**scores)
+
+
+class HorizonPredictions:
+    """Expected points of every player over gameweeks first_gameweek .. first_gameweek + horizon - 1
+
+    Fixtures and players are fetched once and all fixtures in the horizon are predicted in one batch.
+    Teams may play 0, 1 or 2 times in a gameweek. Chance of playing next round is applied to every gameweek.
+    """
+    def __init__(self, first_gameweek: int, horizon: int = 6, model: Optional[TeamStrengthModel] = None,
+                 fixtures: Optional[pd.DataFrame] = None, players: Optional[pd.DataFrame] = None) -> None:
+        self.gameweeks = np.arange(first_gameweek, first_gameweek + horizon)
+        self.model = get_team_strength_model() if model is None else model
+        fixtures = get_fixtures() if fixtures is None else fixtures
+        self.fixtures = fixtures[fixtures['event'].isin(self.gameweeks)].copy()
+        self.players = get_all_players() if players is None else players
+        self.expected_points = None
+
+    def get_team_fixture_totals(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Per gameweek and team sums of xG, clean sheet probabilities and fixture counts, each (horizon, n_teams)
+        """
+        n_teams, horizon = len(self.model.teams), len(self.gameweeks)
+        home_idx, away_idx = self.model.team_codes(self.fixtures['team_h']), self.model.team_codes(self.fixtures['team_a'])
+        prediction = predict_fixtures(self.model, self.fixtures)
+        self.fixtures['home_xg'], self.fixtures['away_xg'] = prediction.home_xg, prediction.away_xg
+        self.fixtures['home_cs_prob'], self.fixtures['away_cs_prob'] = prediction.home_cs_prob, prediction.away_cs_prob
+
+        week_idx = self.fixtures['event'].to_numpy(dtype=np.intp) - self.gameweeks[0]
+        # flattened (gameweek, team) cell of every team-fixture row
+        cells = np.concatenate([week_idx * n_teams + home_idx, week_idx * n_teams + away_idx])
+        xg = np.concatenate([prediction.home_xg, prediction.away_xg])
+        cs_prob = np.concatenate([prediction.home_cs_prob, prediction.away_cs_prob])
+        totals = team_fixture_totals(cells, xg, cs_prob, horizon * n_teams)
+        return tuple(total.reshape(horizon, n_teams) for total in totals)
+
+    @timed('predictions.horizon_predict')
+    def predict(self) -> pd.DataFrame:
+        """Scores every player in every gameweek of the horizon
+
+        :return: (players x gameweeks) float32 frame indexed by player_id
+        """
+        team_xg, team_cs_prob, team_n_fixtures = self.get_team_fixture_totals()
+        team_code = self.model.team_codes(self.players['team'])
+        rates = player_rates(team_code,
+                             self.players['goals_scored'].to_numpy(dtype=float),
+                             self.players['assists'].to_numpy(dtype=float),
+                             self.players['minutes'].to_numpy(dtype=float),
+                             self.players['chance_of_playing_next_round'].to_numpy(dtype=float),
+                             len(self.model.teams))
+        matrix = expected_points_matrix(team_code, position_codes(self.players['position']), rates['goal_share_adj'],
+                                        rates['assist_share_adj'], rates['prob_playing'], team_xg, team_cs_prob, team_n_fixtures)
+        self.expected_points = pd.DataFrame(matrix, index=self.players['player_id'].to_numpy(), columns=self.gameweeks)
+        self.expected_points.index.name = 'player_id'
+        return self.expected_points
 
 
 if __name__ == '__main__':
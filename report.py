@@ -1,21 +1,25 @@
 import sys
 from typing import Tuple
-from mailer import send_html
+from fantasy_football.mailer import send_html, flush as flush_mail, get_dispatcher
 import pandas as pd
-from datetime import date, timedelta
-from fantasy_football.data.db_connect import get_query, insert_dataframe
-from fantasy_football.optimization import run_optimization
+from datetime import date
+from fantasy_football.data.db_connect import get_prepared, upsert_dataframe, refresh_daily_delta, refresh_daily_delta_if_stale
+from fantasy_football.optimization import run_optimization, OptimizationSession
 from fantasy_football.api import get_all_players, get_teams
+from fantasy_football.pipeline import Pipeline, Stage
+from fantasy_football.instrumentation import export_json, is_enabled
+from fantasy_football import store
 
 
 CURRENT_TEAM = [17, 119, 134, 135, 229, 233, 237, 254, 256, 257, 362] 
 CURRENT_BUDGET = 825
+# seconds every report stage may take before its section is left out
+INGEST_TIMEOUT = 300
+QUERY_TIMEOUT = 60
+OPTIMIZATION_TIMEOUT = 300
 
 def get_newly_injured_players(from_date: date) -> pd.DataFrame:
-    query = f"SELECT first_name, second_name, position, team ep_next, goals_scored, minutes, now_cost, ict_index, threat, ict_index_rank, chance_of_playing_next_round, chance_of_playing_this_round \
-                FROM players WHERE date = '{from_date}' AND chance_of_playing_next_round != 'NaN' AND player_id NOT IN ( \
-                SELECT player_id FROM players WHERE date = '{from_date - timedelta(days=1)}' AND chance_of_playing_next_round != 'NaN')"
-    df_new_injuries = get_query(query)
+    df_new_injuries = get_prepared('newly_injured', {'date': from_date})
     return df_new_injuries
 
 
@@ -25,24 +29,19 @@ def get_the_best_team(data_source: str = 'api') -> Tuple[pd.DataFrame, float, fl
 
 
 def get_the_best_transfer(data_source: str = 'api') -> pd.DataFrame:
-    current_team, current_value, current_cost = run_optimization(_target_feature='ep_next', data_source=data_source, _budget=CURRENT_BUDGET, _team_members_ids=CURRENT_TEAM, _allowed_changes=0)
-    better_team, better_value, better_cost = run_optimization(_target_feature='ep_next', data_source=data_source, _budget=CURRENT_BUDGET, _team_members_ids=CURRENT_TEAM, _allowed_changes=1) 
+    # one model is built and re-solved with a relaxed existing team constraint
+    session = OptimizationSession(_target_feature='ep_next', data_source=data_source, _budget=CURRENT_BUDGET, _team_members_ids=CURRENT_TEAM, _allowed_changes=0)
+    (current_team, current_value, current_cost), (better_team, better_value, better_cost) = session.sweep_allowed_changes([0, 1])
     return current_team, current_value, current_cost, better_team, better_value, better_cost 
 
 
 def get_price_changes(from_date: date) -> pd.DataFrame:
-    query = f"SELECT today.first_name, today.second_name, today.team, today.position, yesterday.now_cost as cost_yesterday, today.now_cost as cost_today, today.now_cost - yesterday.now_cost as change \
-            FROM (SELECT * FROM players WHERE date = '{from_date}') today FULL JOIN (SELECT * FROM players WHERE date = '{from_date - timedelta(days=1)}') yesterday ON today.player_id = yesterday.player_id \
-            ORDER BY change DESC;"
-    df_price_changes = get_query(query)
+    df_price_changes = get_prepared('price_changes', {'date': from_date})
     return df_price_changes
 
 
 def get_ep_changes(from_date: date) -> pd.DataFrame:
-    query = f"SELECT today.first_name, today.second_name, today.team, today.position, yesterday.ep_next as ep_yesterday, today.ep_next as ep_today, today.ep_next - yesterday.ep_next as change \
-            FROM (SELECT * FROM players WHERE date = '{from_date}') today FULL JOIN (SELECT * FROM players WHERE date = '{from_date - timedelta(days=1)}') yesterday ON today.player_id = yesterday.player_id \
-            ORDER BY change DESC;"
-    df_ep_changes = get_query(query)
+    df_ep_changes = get_prepared('ep_changes', {'date': from_date})
     return df_ep_changes
 
 
@@ -53,54 +52,112 @@ def get_the_best_ep(from_date: date) -> pd.DataFrame:
 def update_database():
     player_df = get_all_players()
     teams_df = get_teams()
-    # inserting both dataframes to the db
-    insert_dataframe(player_df, "players") 
-    insert_dataframe(teams_df, "teams")
-
-if __name__ == '__main__':
+    # upserting both dataframes, so a rerun on the same day replaces today's rows
+    upsert_dataframe(player_df, "players")
+    upsert_dataframe(teams_df, "teams")
+    # the report sections read today's deltas instead of joining the snapshots
+    refresh_daily_delta(date.today())
+    # local columnar copy for historical analysis, when pyarrow is installed
+    if store.is_available():
+        store.write_snapshot(player_df, "players")
+        store.write_snapshot(teams_df, "teams")
+
+
+def report_pipeline(report_date: date, ingest: bool = True) -> Pipeline:
+    """Stages of the daily report, the diff queries wait for the ingest and the daily deltas, the optimizations
+    run alongside them
+
+    The deltas of report_date are refreshed whenever a player of that day has none, also without the ingest.
+    """
+    stages = [Stage('daily_delta', refresh_daily_delta_if_stale, timeout=QUERY_TIMEOUT, fallback=False, for_date=report_date),
+              Stage('injuries', get_newly_injured_players, depends_on=['daily_delta'], timeout=QUERY_TIMEOUT, from_date=report_date),
+              Stage('price_changes', get_price_changes, depends_on=['daily_delta'], timeout=QUERY_TIMEOUT, from_date=report_date),
+              Stage('ep_changes', get_ep_changes, depends_on=['daily_delta'], timeout=QUERY_TIMEOUT, from_date=report_date),
+              Stage('best_team', get_the_best_team, executor='process', timeout=OPTIMIZATION_TIMEOUT),
+              Stage('best_transfer', get_the_best_transfer, executor='process', timeout=OPTIMIZATION_TIMEOUT)]
+    if ingest:
+        stages.append(Stage('ingest', update_database, timeout=INGEST_TIMEOUT, fallback=False))
+        stages[0].depends_on.append('ingest')
+    return Pipeline(stages)
+
+
+def _top_and_bottom(input_df: pd.DataFrame, n: int = 10) -> pd.DataFrame:
+    return pd.concat([input_df.head(n), input_df.tail(n)], axis=0)
+
+
+def _missing(section: str) -> str:
+    return f'<p>{section} not available, see the stage timings below.</p>'
+
+
+def build_report(results: dict, timings: pd.DataFrame) -> str:
+    """HTML of the report, sections whose stages failed or timed out are replaced by a note
+    """
     message_body = []
     message_body.append('<h1>FPL daily report</h1>')
+    if 'ingest' in results:
+        message_body.append('<p>Database updated successfully.</p>' if results['ingest'] is not False else
+                            '<p>Database update failed, the changes below may be out of date.</p>')
 
-    # updating today's date
-    if sys.platform == 'linux':
-        update_database()
-        message_body.append('<p>Database updated successfully.</p>')
-
-    # grabbing data on injuries, cost and ep chages
-    df_injuries = get_newly_injured_players(date.today())
-    df_price_changes = get_price_changes(date.today())
-    df_price_changes = pd.concat([df_price_changes.head(10), df_price_changes.tail(10)], axis=0)
-    df_ep_changes = get_ep_changes(date.today())
-    df_ep_changes = pd.concat([df_ep_changes.head(10), df_ep_changes.tail(10)], axis=0)
+    # data on injuries, cost and ep changes
     message_body.append('<h2>New injuries since yesterday</h2>')
-    message_body.append(df_injuries.to_html())
+    message_body.append(results['injuries'].to_html() if results['injuries'] is not None else _missing('Injuries'))
     message_body.append('<h2>Price changes since yesterday:</h2>')
-    message_body.append(df_price_changes.to_html())
+    message_body.append(_top_and_bottom(results['price_changes']).to_html() if results['price_changes'] is not None else _missing('Price changes'))
     message_body.append('<h2>Expected score changes since yesterday:</h2>')
-    message_body.append(df_ep_changes.to_html())
+    message_body.append(_top_and_bottom(results['ep_changes']).to_html() if results['ep_changes'] is not None else _missing('Expected score changes'))
 
-    # fetching the best possible team for the upcoming round
-    best_team, best_value, best_cost = get_the_best_team()
+    # the best possible team for the upcoming round
     message_body.append('<h2>Best possible team within budget constraint:</h2>')
-    message_body.append(f'<p>Expected score: {str(best_value)} and cost: {str(best_cost)} of the optimal team</p>')
-    message_body.append(best_team.to_html())
+    if results['best_team'] is not None:
+        best_team, best_value, best_cost = results['best_team']
+        message_body.append(f'<p>Expected score: {str(best_value)} and cost: {str(best_cost)} of the optimal team</p>')
+        message_body.append(best_team.to_html())
+    else:
+        message_body.append(_missing('Best team'))
 
     # transfer suggestions
-    current_team, current_value, current_cost, better_team, better_value, better_cost = get_the_best_transfer() 
     message_body.append('<h2>Optimal transfer suggestion:</h2>')
-    message_body.append(f'<p>Expected score now:{str(current_value)} and after: {str(better_value)}</p>')
-    message_body.append(f'<p>Cost now:{str(current_cost)} and after: {str(better_cost)}</p>')
-    message_body.append(current_team.to_html())
-    message_body.append(better_team.to_html())
-    ids_out = [idd for idd in current_team['player_id'] if idd not in better_team['player_id']]
-    ids_in = [idd for idd in better_team['player_id'] if idd not in current_team['player_id']]
-    players_out = current_team.query(f"player_id in {ids_out}")
-    players_out['substitution'] = 'out'
-    players_in = better_team.query(f"player_id in {ids_in}")
-    players_in['substitution'] = 'in'
-    df_subs = pd.concat([players_out, players_in], axis=0)
-    message_body.append(df_subs.to_html())
-
-    # wrapping up
-    final_message = '\n'.join(message_body)
-    send_html(subject=f'FPL report {date.today()}', html_content=final_message)
\ No newline at end of file
+    if results['best_transfer'] is not None:
+        current_team, current_value, current_cost, better_team, better_value, better_cost = results['best_transfer']
+        message_body.append(f'<p>Expected score now:{str(current_value)} and after: {str(better_value)}</p>')
+        message_body.append(f'<p>Cost now:{str(current_cost)} and after: {str(better_cost)}</p>')
+        message_body.append(current_team.to_html())
+        message_body.append(better_team.to_html())
+        ids_out = [idd for idd in current_team['player_id'] if idd not in better_team['player_id'].values]
+        ids_in = [idd for idd in better_team['player_id'] if idd not in current_team['player_id'].values]
+        players_out = current_team.query(f"player_id in {ids_out}").assign(substitution='out')
+        players_in = better_team.query(f"player_id in {ids_in}").assign(substitution='in')
+        df_subs = pd.concat([players_out, players_in], axis=0)
+        message_body.append(df_subs.to_html())
+    else:
+        message_body.append(_missing('Transfer suggestion'))
+
+    message_body.append('<h2>Stage timings:</h2>')
+    message_body.append(timings.to_html(float_format='{:.2f}'.format))
+    return '\n'.join(message_body)
+
+
+def run_report(ingest: bool = sys.platform == 'linux', send: bool = True) -> str:
+    """Runs the report pipeline and mails the report
+
+    :param ingest: Updates the database first, by default only on the linux box
+    :type ingest: bool
+    :param send: Mails the report, otherwise it is only returned
+    :type send: bool
+    :return: HTML of the report
+    :raises RuntimeError: When the report couldn't be mailed
+    """
+    pipeline = report_pipeline(date.today(), ingest=ingest)
+    results = pipeline.run()
+    final_message = build_report(results, pipeline.timings)
+    if send:
+        send_html(subject=f'FPL report {date.today()}', html_content=final_message)
+        if not flush_mail():
+            raise RuntimeError(f"The report couldn't be mailed: {'; '.join(get_dispatcher().errors[-1:])}")
+    return final_message
+
+
+if __name__ == '__main__':
+    run_report()
+    if is_enabled():
+        export_json()
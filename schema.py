@@ -0,0 +1,177 @@
+"""
+Declared column types of the players and teams frames built from the bootstrap-static payload
+
+The same declarations are used when parsing the api payloads, when writing to the database and the
+snapshot store, and when reading them back. The unused text fields in UNUSED_COLUMNS, e.g. photo or
+news_added, are never materialized, other undeclared fields are kept as parsed after the declared ones.
+"""
+from __future__ import annotations
+import logging
+import numpy as np
+from typing import Dict, Iterable, List, Optional
+from fantasy_football.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+INT16_COLUMNS = ['now_cost', 'cost_change_event', 'cost_change_event_fall', 'cost_change_start', 'cost_change_start_fall',
+                 'dreamteam_count', 'event_points', 'total_points', 'minutes', 'goals_scored', 'assists', 'clean_sheets',
+                 'goals_conceded', 'own_goals', 'penalties_saved', 'penalties_missed', 'yellow_cards', 'red_cards', 'saves',
+                 'bonus', 'bps', 'starts', 'team_code', 'influence_rank', 'influence_rank_type', 'creativity_rank',
+                 'creativity_rank_type', 'threat_rank', 'threat_rank_type', 'ict_index_rank', 'ict_index_rank_type',
+                 'now_cost_rank', 'now_cost_rank_type', 'form_rank', 'form_rank_type', 'points_per_game_rank',
+                 'points_per_game_rank_type', 'selected_rank', 'selected_rank_type']
+FLOAT32_COLUMNS = ['chance_of_playing_next_round', 'chance_of_playing_this_round', 'ep_next', 'ep_this', 'form',
+                   'points_per_game', 'selected_by_percent', 'value_form', 'value_season', 'influence', 'creativity',
+                   'threat', 'ict_index', 'expected_goals', 'expected_assists', 'expected_goal_involvements',
+                   'expected_goals_conceded', 'expected_goals_per_90', 'saves_per_90', 'expected_assists_per_90',
+                   'expected_goal_involvements_per_90', 'expected_goals_conceded_per_90', 'goals_conceded_per_90',
+                   'starts_per_90', 'clean_sheets_per_90', 'squad_number', 'corners_and_indirect_freekicks_order',
+                   'direct_freekicks_order', 'penalties_order']
+
+# a float32 keeps every decimal of up to 6 significant digits, 9 digits always give it back exactly
+FLOAT32_DIGITS = 6
+FLOAT32_MAX_DIGITS = 9
+# payload text fields which are never read, they are left out when building and conforming frames
+UNUSED_COLUMNS = ('photo', 'news_added', 'birth_date', 'team_join_date', 'opta_code', 'corners_and_indirect_freekicks_text',
+                  'direct_freekicks_text', 'penalties_text')
+
+# column: dtype, in the order of the frame returned by api.get_all_players
+PLAYER_SCHEMA = {'date': 'object',
+                 'first_name': 'object',
+                 'second_name': 'object',
+                 'web_name': 'object',
+                 'team': 'category',
+                 'position': 'category',
+                 'status': 'category',
+                 'news': 'object',
+                 'in_dreamteam': 'bool',
+                 'code': 'int32',
+                 'transfers_in': 'int32',
+                 'transfers_out': 'int32',
+                 'transfers_in_event': 'int32',
+                 'transfers_out_event': 'int32',
+                 **{col: 'int16' for col in INT16_COLUMNS},
+                 **{col: 'float32' for col in FLOAT32_COLUMNS},
+                 'player_id': 'int32'}
+# payload field: frame column
+PLAYER_RENAMES = {'id': 'player_id',
+                  'element_type': 'position'}
+
+TEAM_SCHEMA = {'date': 'object',
+               'id': 'int16',
+               'code': 'int16',
+               'name': 'object',
+               'short_name': 'object',
+               'played': 'int16',
+               'win': 'int16',
+               'draw': 'int16',
+               'loss': 'int16',
+               'points': 'int16',
+               'position': 'int16',
+               'form': 'float32',
+               'strength': 'int16',
+               'strength_overall_home': 'int16',
+               'strength_overall_away': 'int16',
+               'strength_attack_home': 'int16',
+               'strength_attack_away': 'int16',
+               'strength_defence_home': 'int16',
+               'strength_defence_away': 'int16',
+               'unavailable': 'bool',
+               'pulse_id': 'int16'}
+
+HISTORY_SCHEMA = {'season_name': 'object',
+                  'element_code': 'int32',
+                  'start_cost': 'int16',
+                  'end_cost': 'int16',
+                  **{col: 'int16' for col in ['total_points', 'minutes', 'goals_scored', 'assists', 'clean_sheets',
+                                              'goals_conceded', 'own_goals', 'penalties_saved', 'penalties_missed',
+                                              'yellow_cards', 'red_cards', 'saves', 'bonus', 'bps', 'starts']},
+                  **{col: 'float32' for col in ['influence', 'creativity', 'threat', 'ict_index', 'expected_goals',
+                                                'expected_assists', 'expected_goal_involvements', 'expected_goals_conceded']}}
+
+
+def source_columns(records: List[dict], schema: Dict[str, str], renames: Optional[Dict[str, str]] = None) -> List[str]:
+    """Payload fields which end up in the frame, the ones in UNUSED_COLUMNS are skipped when building it
+    """
+    renames = renames or {}
+    return [field for field in (records[0] if records else [])
+            if renames.get(field, field) in schema or renames.get(field, field) not in UNUSED_COLUMNS]
+
+
+def conform(frame: pd.DataFrame, schema: Dict[str, str], categories: Optional[Dict[str, Iterable[str]]] = None) -> pd.DataFrame:
+    """Casts the declared columns of a frame, leaves out UNUSED_COLUMNS and keeps other undeclared columns as they are
+
+    Numeric columns which do not parse are coerced to NaN, integer columns with missing values are kept as float32
+    and integer columns whose values do not fit the declared type are kept as int64.
+
+    :param frame: Frame to cast
+    :type frame: pd.DataFrame
+    :param schema: Declared column types, e.g. PLAYER_SCHEMA
+    :type schema: Dict[str, str]
+    :param categories: Fixed categories of categorical columns, unseen values are appended to them
+    :type categories: Dict[str, Iterable[str]]
+    :return: Frame with the declared columns in the declared order, followed by the undeclared ones
+    """
+    categories = categories or {}
+    columns = {}
+    for col, dtype in schema.items():
+        if col not in frame.columns:
+            continue
+        values = frame[col]
+        if dtype == 'category':
+            known = list(categories.get(col, []))
+            unseen = sorted(set(values.dropna()) - set(known), key=str)
+            columns[col] = pd.Categorical(values, categories=known + unseen if known else None)
+        elif dtype == 'object':
+            columns[col] = values
+        elif dtype == 'bool':
+            columns[col] = values.eq(True)
+        else:
+            numeric = values if pd.api.types.is_numeric_dtype(values) else pd.to_numeric(values, errors='coerce')
+            if np.issubdtype(np.dtype(dtype), np.integer) and numeric.isna().any():
+                logging.info(f"Column {col} has missing values, it is kept as float32")
+                dtype = 'float32'
+            elif np.issubdtype(np.dtype(dtype), np.integer) and len(numeric) and \
+                    (numeric.min() < np.iinfo(dtype).min or numeric.max() > np.iinfo(dtype).max):
+                logging.info(f"Column {col} does not fit {dtype}, it is kept as int64")
+                dtype = 'int64'
+            columns[col] = numeric.astype(dtype)
+    undeclared = [col for col in frame.columns if col not in schema and col not in UNUSED_COLUMNS]
+    if undeclared:
+        logging.info(f"Undeclared columns kept as parsed: {undeclared}")
+        columns.update({col: frame[col] for col in undeclared})
+    return pd.DataFrame(columns, index=frame.index)
+
+
+def _round_significant(values: np.ndarray, magnitude: np.ndarray, digits: int) -> np.ndarray:
+    # integer scaling by a power of ten, so the division lands on the nearest double of the decimal
+    decimals = digits - 1 - magnitude
+    scale = 10.0 ** np.abs(decimals)
+    return np.where(decimals >= 0, np.round(values * scale) / scale, np.round(values / scale) * scale)
+
+
+def as_float64(values: pd.Series) -> np.ndarray:
+    """Float64 values of a column, float32 columns are widened to the decimals they were parsed from
+
+    Keeps sums such as objective values at 97.5 rather than 97.49999809265137. Every value is rounded to
+    the fewest significant digits, from FLOAT32_DIGITS up, which still give back the same float32.
+    """
+    wide = values.to_numpy(dtype=np.float64)
+    if values.dtype != np.float32:
+        return wide
+    narrow = wide.astype(np.float32)
+    pending = np.flatnonzero(np.isfinite(wide) & (wide != 0))
+    with np.errstate(divide='ignore'):
+        magnitude = np.floor(np.log10(np.abs(wide[pending])))
+    for digits in range(FLOAT32_DIGITS, FLOAT32_MAX_DIGITS + 1):
+        candidate = _round_significant(wide[pending], magnitude, digits)
+        exact = candidate.astype(np.float32) == narrow[pending]
+        wide[pending[exact]] = candidate[exact]
+        pending, magnitude = pending[~exact], magnitude[~exact]
+    return wide
+
+
+def memory_usage(frame: pd.DataFrame) -> int:
+    """Bytes taken by the frame, including the python objects of text columns
+    """
+    return int(frame.memory_usage(deep=True).sum())
@@ -0,0 +1,483 @@
+"""
+Local HTTP/JSON service keeping the players snapshot, the team strength model and built optimization
+models warm in memory, run with ``python -m fantasy_football.cli serve``
+
+    GET  /health                                   state version and when it was loaded
+    GET  /stats                                    requests, response cache and refresh counters
+    GET  /match?home=Arsenal&away=Spurs            xG, outcome and clean sheet probabilities, implied odds
+    GET  /expected-points?gameweek=20&top=20       expected points of a gameweek, next one by default
+    POST /optimize                                 best team, or best transfers with 'team' and 'allowed_changes'
+    POST /refresh                                  reloads the state at once
+
+Requests are answered by a pool of worker threads. The state is reloaded on a schedule and swapped
+in whole, so a request is answered from one consistent snapshot. Responses are cached by endpoint,
+parameters and state version, repeated queries are answered from the cache.
+"""
+import json
+import time
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from datetime import datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+from typing import List, Optional, Tuple
+from pulp import LpStatus
+from fantasy_football.api import get_bootstrap_static, get_snapshot, get_all_players, get_fixtures, FIXTURES_ENDPOINT
+from fantasy_football.predictions import GameweekPredictions, TeamStrengthModel
+from fantasy_football.dixon_coles import get_fitted_model
+from fantasy_football.optimization import OptimizationSession, COLS_TO_DISPLAY, MAX_BUDGET
+from fantasy_football.statistical_utils import calculate_odds
+from fantasy_football.instrumentation import count, span
+
+HOST = "127.0.0.1"
+PORT = 8765
+WORKERS = 8
+# seconds between state reloads
+REFRESH_INTERVAL = 15 * 60
+RESPONSE_CACHE_SIZE = 512
+# optimization models kept per state, one per current team
+MAX_SESSIONS = 8
+MAX_BODY_BYTES = 64 * 1024
+MODELS = ('goals', 'dixon_coles')
+
+
+class ServiceError(Exception):
+    """Error answered to the client with its status, e.g. an unknown team or a malformed body
+    """
+    def __init__(self, message: str, status: HTTPStatus = HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def _records(_df: pd.DataFrame) -> List[dict]:
+    return [{key: (None if pd.isna(value) else value) for key, value in record.items()} for record in _df.to_dict('records')]
+
+
+class _WarmSession:
+    """Optimization model with its lock, solved by one request at a time
+    """
+    def __init__(self, session: OptimizationSession):
+        self.session = session
+        self.objective = ('column', session.target_feature)
+        self.lock = threading.Lock()
+
+
+class ServiceState:
+    """Players, fixtures and team strength model of one refresh, with the models and predictions built from them
+
+    :param model: 'goals' for the goal table strengths or 'dixon_coles' for the fitted model
+    :type model: str
+    :param version: Number of the refresh, part of the response cache keys
+    :type version: int
+    """
+    def __init__(self, model: str = 'goals', version: int = 0):
+        if model not in MODELS:
+            raise ValueError(f"Unknown model {model}, expected one of {MODELS}")
+        with span('service.load_state', model=model):
+            get_bootstrap_static(force_refresh=True)
+            get_snapshot(FIXTURES_ENDPOINT, force_refresh=True)
+            self.players = get_all_players()
+            self.fixtures = get_fixtures()
+            self.model = TeamStrengthModel() if model == 'goals' else get_fitted_model(self.fixtures)
+        self.model_name = model
+        self.version = version
+        self.loaded_at = datetime.now()
+        upcoming = self.fixtures.loc[~self.fixtures['finished'].astype(bool), 'event'].dropna()
+        self.next_gameweek = int(upcoming.min()) if len(upcoming) else None
+        self._predictions = {}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def session_count(self) -> int:
+        return len(self._sessions)
+
+    def warm_up(self) -> None:
+        """Predicts the next gameweek and solves the plain team model once, so the first requests find them built
+        """
+        if self.next_gameweek is not None:
+            self.expected_points(self.next_gameweek)
+        warm = self.get_session()
+        with warm.lock:
+            warm.session.solve()
+
+    def team_code(self, team: str) -> int:
+        if team not in self.model.team_index:
+            raise ServiceError(f"Unknown team {team}")
+        return self.model.team_index[team]
+
+    def expected_points(self, gameweek: int) -> pd.DataFrame:
+        """Players scored for a gameweek, aligned with self.players, computed once per state
+        """
+        with self._lock:
+            if gameweek in self._predictions:
+                return self._predictions[gameweek]
+        if gameweek not in set(self.fixtures['event'].dropna().astype(int)):
+            raise ServiceError(f"No fixtures in gameweek {gameweek}", HTTPStatus.NOT_FOUND)
+        predictions = GameweekPredictions(gameweek, self.model, self.fixtures, self.players)
+        predictions.predict_xg_and_cs()
+        predictions.map_expected_points()
+        with self._lock:
+            return self._predictions.setdefault(gameweek, predictions.players)
+
+    def get_session(self, team: Optional[Tuple[int, ...]] = None, allowed_changes: int = 1) -> _WarmSession:
+        """Optimization model without pruning, so budget, must-haves, must-avoids and the objective can be changed in place
+
+        Transfer models are built per current team, the least recently used ones are dropped.
+        """
+        with self._lock:
+            if team in self._sessions:
+                self._sessions.move_to_end(team)
+                return self._sessions[team]
+        kwargs = {} if team is None else {'_team_members_ids': list(team), '_allowed_changes': allowed_changes}
+        warm = _WarmSession(OptimizationSession(players=self.players, prune=False, **kwargs))
+        count('service.sessions_built')
+        with self._lock:
+            warm = self._sessions.setdefault(team, warm)
+            self._sessions.move_to_end(team)
+            while len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        return warm
+
+
+def _int_list(body: dict, key: str) -> List[int]:
+    values = body.get(key) or []
+    if not isinstance(values, list) or not all(isinstance(value, int) for value in values):
+        raise ServiceError(f"'{key}' must be a list of player ids")
+    return values
+
+
+def _int_param(params: dict, key: str, default: Optional[int] = None) -> Optional[int]:
+    if params.get(key) in (None, ''):
+        return default
+    try:
+        return int(params[key])
+    except (TypeError, ValueError):
+        raise ServiceError(f"'{key}' must be an integer")
+
+
+def _float_param(params: dict, key: str, default: Optional[float] = None) -> Optional[float]:
+    if params.get(key) in (None, ''):
+        return default
+    try:
+        return float(params[key])
+    except (TypeError, ValueError):
+        raise ServiceError(f"'{key}' must be a number")
+
+
+def match(state: ServiceState, params: dict) -> dict:
+    home, away = params.get('home'), params.get('away')
+    if not home or not away:
+        raise ServiceError("'home' and 'away' teams are required")
+    prediction = state.model.predict([state.team_code(home)], [state.team_code(away)])
+    outcome_probs = prediction.outcome_probs[0]
+    return {'home': home, 'away': away,
+            'home_xg': prediction.home_xg[0], 'away_xg': prediction.away_xg[0],
+            'outcome_probs': {'home': outcome_probs[0], 'draw': outcome_probs[1], 'away': outcome_probs[2]},
+            'clean_sheet_probs': {'home': prediction.home_cs_prob[0], 'away': prediction.away_cs_prob[0]},
+            'implied_odds': calculate_odds(outcome_probs)}
+
+
+def expected_points(state: ServiceState, params: dict) -> dict:
+    gameweek = _int_param(params, 'gameweek', state.next_gameweek)
+    if gameweek is None:
+        raise ServiceError("The season has no fixtures left, 'gameweek' is required")
+    players = state.expected_points(gameweek)
+    if params.get('position'):
+        players = players[players['position'] == params['position']]
+    if params.get('team'):
+        state.team_code(params['team'])
+        players = players[players['team'] == params['team']]
+    players = players.sort_values('expected_points', ascending=False).head(_int_param(params, 'top', 20))
+    columns = ['player_id', 'first_name', 'second_name', 'position', 'team', 'now_cost', 'prob_playing',
+               'expected_goals', 'expected_assists', 'expected_points']
+    return {'gameweek': gameweek, 'players': _records(players[columns])}
+
+
+def optimize(state: ServiceState, body: dict) -> dict:
+    """Best team for the body's constraints
+
+    Body keys, all optional: target (players column, ep_next by default) or gameweek (the predicted expected
+    points of that gameweek), budget, must_haves, must_avoid, team (ids of the current team), allowed_changes
+    and time_limit in seconds.
+    """
+    must_haves, must_avoid, team = _int_list(body, 'must_haves'), _int_list(body, 'must_avoid'), _int_list(body, 'team')
+    if set(must_haves) & set(must_avoid):
+        raise ServiceError("A player can't be both a must-have and a must-avoid")
+    unknown = set(must_haves + must_avoid + team) - set(state.players['player_id'])
+    if unknown:
+        raise ServiceError(f"Unknown player ids {sorted(unknown)}")
+    budget = _int_param(body, 'budget', MAX_BUDGET)
+    allowed_changes = _int_param(body, 'allowed_changes', 1)
+    time_limit = _float_param(body, 'time_limit')
+    gameweek = _int_param(body, 'gameweek')
+    if gameweek is not None:
+        objective = ('gameweek', gameweek)
+        reward = state.expected_points(gameweek)['expected_points'].to_numpy(dtype=float)
+    else:
+        objective = ('column', body.get('target', 'ep_next'))
+        if objective[1] not in state.players.columns or not pd.api.types.is_numeric_dtype(state.players[objective[1]]):
+            raise ServiceError(f"'target' must be a numeric players column, got {objective[1]}")
+        reward = objective[1]
+
+    warm = state.get_session(tuple(sorted(team)) if team else None, allowed_changes)
+    with warm.lock:
+        session = warm.session
+        if warm.objective != objective:
+            session.set_objective(reward)
+            warm.objective = objective
+        session.set_budget(budget)
+        if team:
+            session.set_allowed_changes(allowed_changes)
+        # both lists are cleared first, so a player moved from one to the other keeps the new bounds
+        session.set_must_haves([])
+        session.set_must_avoid([])
+        session.set_must_haves(must_haves)
+        session.set_must_avoid(must_avoid)
+        start = time.perf_counter()
+        final_team, objective_value, team_cost = session.solve(time_limit)
+        solve_s = time.perf_counter() - start
+        status = session.status
+    result = {'status': LpStatus[status],
+              'objective': objective_value, 'cost': team_cost, 'solve_s': solve_s}
+    if status != 1:
+        return {**result, 'team': []}
+    if team:
+        result['transfers_in'] = sorted(set(final_team['player_id']) - set(team))
+        result['transfers_out'] = sorted(set(team) - set(final_team['player_id']))
+    return {**result, 'team': _records(final_team[COLS_TO_DISPLAY])}
+
+
+class FantasyService:
+    """Warm state, response cache and scheduled refresh behind the HTTP handlers
+
+    :param model: 'goals' or 'dixon_coles', see ServiceState
+    :type model: str
+    :param refresh_interval: Seconds between state reloads, no scheduled reloads when 0
+    :type refresh_interval: float
+    :param cache_size: Responses kept in the cache
+    :type cache_size: int
+    """
+    GET_ROUTES = {'/match': match, '/expected-points': expected_points}
+    POST_ROUTES = {'/optimize': optimize}
+
+    def __init__(self, model: str = 'goals', refresh_interval: float = REFRESH_INTERVAL,
+                 cache_size: int = RESPONSE_CACHE_SIZE):
+        self.model = model
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+        self.stats = {'requests': 0, 'errors': 0, 'cache_hits': 0, 'cache_misses': 0, 'refreshes': 0,
+                      'refresh_errors': 0, 'last_refresh_error': None}
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._scheduler = None
+        self.state = None
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+        count(f"service.{name}")
+
+    def refresh(self) -> ServiceState:
+        """Loads and warms a new state and swaps it in, the current state keeps answering meanwhile
+        """
+        with self._refresh_lock:
+            version = 0 if self.state is None else self.state.version + 1
+            try:
+                state = ServiceState(self.model, version)
+                state.warm_up()
+            except Exception as error:
+                self._count('refresh_errors')
+                self.stats['last_refresh_error'] = repr(error)
+                logging.info(f"Service state refresh failed: {error}")
+                if self.state is None:
+                    raise
+                return self.state
+            with self._lock:
+                self.state = state
+                self._responses.clear()
+            self._count('refreshes')
+            logging.info(f"Service state {version} loaded, {len(state.players)} players")
+            return state
+
+    def _schedule(self) -> None:
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def start(self) -> None:
+        if self.state is None:
+            self.refresh()
+        if self.refresh_interval and self._scheduler is None:
+            self._scheduler = threading.Thread(target=self._schedule, name="service-refresh", daemon=True)
+            self._scheduler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def health(self) -> dict:
+        state = self.state
+        return {'status': 'ok', 'version': state.version, 'loaded_at': state.loaded_at.isoformat(timespec='seconds'),
+                'model': state.model_name, 'model_version': state.model.version, 'players': len(state.players),
+                'next_gameweek': state.next_gameweek}
+
+    def get_stats(self) -> dict:
+        lookups = self.stats['cache_hits'] + self.stats['cache_misses']
+        return {**self.stats, 'cache_hit_rate': self.stats['cache_hits'] / lookups if lookups else 0.0,
+                'cached_responses': len(self._responses), 'sessions': self.state.session_count}
+
+    def handle(self, method: str, path: str, params: dict) -> Tuple[HTTPStatus, bytes]:
+        """Answers a request with its status and JSON body, repeated queries are served from the cache
+        """
+        self._count('requests')
+        try:
+            if method == 'GET' and path == '/health':
+                return HTTPStatus.OK, json.dumps(self.health()).encode()
+            if method == 'GET' and path == '/stats':
+                return HTTPStatus.OK, json.dumps(self.get_stats(), default=_json_default).encode()
+            if method == 'POST' and path == '/refresh':
+                self.refresh()
+                return HTTPStatus.OK, json.dumps(self.health()).encode()
+            routes = self.GET_ROUTES if method == 'GET' else self.POST_ROUTES
+            if path not in routes:
+                raise ServiceError(f"No {method} endpoint {path}", HTTPStatus.NOT_FOUND)
+            state = self.state
+            key = (path, json.dumps(params, sort_keys=True), state.version)
+            with self._lock:
+                cached = self._responses.get(key)
+                if cached is not None:
+                    self._responses.move_to_end(key)
+            if cached is not None:
+                self._count('cache_hits')
+                return HTTPStatus.OK, cached
+            self._count('cache_misses')
+            with span(f"service.{path.strip('/')}", version=state.version):
+                body = json.dumps(routes[path](state, params), default=_json_default).encode()
+            with self._lock:
+                if state.version == self.state.version:
+                    self._responses[key] = body
+                    while len(self._responses) > self.cache_size:
+                        self._responses.popitem(last=False)
+            return HTTPStatus.OK, body
+        except ServiceError as error:
+            self._count('errors')
+            return error.status, json.dumps({'error': str(error)}).encode()
+        except Exception as error:
+            self._count('errors')
+            logging.exception(f"Service request {method} {path} failed")
+            return HTTPStatus.INTERNAL_SERVER_ERROR, json.dumps({'error': repr(error)}).encode()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server_version = "FantasyFootball/1.0"
+
+    def _answer(self, method: str) -> None:
+        url = urlsplit(self.path)
+        if method == 'GET':
+            params = dict(parse_qsl(url.query))
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_BODY_BYTES:
+                return self._send(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, json.dumps({'error': "Body too large"}).encode())
+            try:
+                params = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                return self._send(HTTPStatus.BAD_REQUEST, json.dumps({'error': "Body is not valid JSON"}).encode())
+            if not isinstance(params, dict):
+                return self._send(HTTPStatus.BAD_REQUEST, json.dumps({'error': "Body must be a JSON object"}).encode())
+        self._send(*self.server.service.handle(method, url.path.rstrip('/') or '/', params))
+
+    def _send(self, status: HTTPStatus, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self._answer('GET')
+
+    def do_POST(self) -> None:
+        self._answer('POST')
+
+    def log_message(self, format: str, *args) -> None:
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server handing every connection to a fixed pool of worker threads
+    """
+    # connections waiting to be accepted, the default of 5 turns bursts into refused connections and retries
+    request_queue_size = 128
+
+    def __init__(self, address: Tuple[str, int], service: FantasyService, workers: int = WORKERS):
+        super().__init__(address, _RequestHandler)
+        self.service = service
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="service-worker")
+
+    def process_request(self, request, client_address) -> None:
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def create_server(host: str = HOST, port: int = PORT, workers: int = WORKERS, model: str = 'goals',
+                  refresh_interval: float = REFRESH_INTERVAL) -> PooledHTTPServer:
+    """Loads the state and binds the server, serve_forever() then answers the requests
+
+    :param host: Interface to listen on, local only by default
+    :type host: str
+    :param port: Port to listen on, any free port when 0
+    :type port: int
+    :param workers: Threads answering the requests
+    :type workers: int
+    :param model: 'goals' or 'dixon_coles'
+    :type model: str
+    :param refresh_interval: Seconds between state reloads, no scheduled reloads when 0
+    :type refresh_interval: float
+    """
+    service = FantasyService(model, refresh_interval)
+    service.start()
+    return PooledHTTPServer((host, port), service, workers)
+
+
+def serve(host: str = HOST, port: int = PORT, workers: int = WORKERS, model: str = 'goals',
+          refresh_interval: float = REFRESH_INTERVAL) -> None:
+    server = create_server(host, port, workers, model, refresh_interval)
+    logging.info(f"Serving on http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.service.stop()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    serve()
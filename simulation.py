@@ -0,0 +1,203 @@
+"""
+Monte Carlo simulation of players' points over a set of fixtures
+
+Scorelines of all fixtures are drawn from the correct score probabilities of the team strength model.
+Every goal is given to at most one scorer and at most one assister of the scoring team, with the
+players' goal and assist shares used by predictions.score_players, so the mean of the simulated points
+matches the expected points while the samples also carry their spread and the correlation between
+team-mates.
+"""
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional, Tuple
+from fantasy_football.api import get_all_players, get_fixtures
+from fantasy_football.predictions import TeamStrengthModel, get_team_strength_model, player_rates, position_codes, POSITION_SCORING
+
+# simulations drawn at once, bounds the memory of the intermediate (chunk x team fixtures) arrays
+CHUNK_SIZE = 10000
+QUANTILES = (0.1, 0.5, 0.9)
+# points of a haul, haul_prob is the probability of reaching them
+HAUL_POINTS = 10
+# share of goals which are assisted
+ASSIST_RATE = 0.5
+
+
+class _Layout:
+    """Team fixtures ("rows", two per fixture) and the (player, row) pairs in which a player can score points
+    """
+    def __init__(self, home_idx: np.ndarray, away_idx: np.ndarray, team_code: np.ndarray, position_code: np.ndarray,
+                 goal_share: np.ndarray, assist_share: np.ndarray, prob_playing: np.ndarray, score_probs: np.ndarray):
+        n_fixtures = len(home_idx)
+        self.n_players = len(team_code)
+        self.n_rows = 2 * n_fixtures
+        row_team = np.empty(self.n_rows, dtype=np.intp)
+        row_team[0::2], row_team[1::2] = home_idx, away_idx
+        self.opponent_row = np.arange(self.n_rows) ^ 1
+
+        pair_player, pair_row = [], []
+        for row, team in enumerate(row_team):
+            members = np.flatnonzero(team_code == team)
+            pair_player.append(members)
+            pair_row.append(np.full(len(members), row))
+        self.pair_player = np.concatenate(pair_player).astype(np.intp) if pair_player else np.zeros(0, dtype=np.intp)
+        self.pair_row = np.concatenate(pair_row).astype(np.intp) if pair_row else np.zeros(0, dtype=np.intp)
+        self.n_pairs = len(self.pair_player)
+        self.goal_cdf = self._row_cdf(goal_share[self.pair_player])
+        self.assist_cdf = self._row_cdf(ASSIST_RATE * assist_share[self.pair_player])
+        self.prob_playing = prob_playing[self.pair_player].astype(np.float32)
+        self.weights = POSITION_SCORING[position_code[self.pair_player]].astype(np.float32)
+        # players may have several fixtures, each pass adds at most one fixture of every player
+        ordinal = np.zeros(self.n_pairs, dtype=np.intp)
+        seen = np.zeros(self.n_players, dtype=np.intp)
+        for pair, player in enumerate(self.pair_player):
+            ordinal[pair] = seen[player]
+            seen[player] += 1
+        self.passes = [np.flatnonzero(ordinal == k) for k in range(int(seen.max(initial=0)))]
+
+        depth = score_probs.shape[1]
+        self.depth = depth
+        flat = score_probs.reshape(n_fixtures, depth * depth)
+        flat = flat / flat.sum(axis=1, keepdims=True)
+        self.score_cdf = (np.cumsum(flat, axis=1) + np.arange(n_fixtures)[:, None]).ravel()
+
+    def _row_cdf(self, shares: np.ndarray) -> np.ndarray:
+        """Cumulative shares within every row, offset by the row, so all rows are searched at once
+
+        Rows whose shares add up to more than one are scaled down to one.
+        """
+        totals = np.bincount(self.pair_row, weights=shares, minlength=self.n_rows)
+        shares = shares / np.maximum(totals, 1)[self.pair_row]
+        cumulative = np.cumsum(shares)
+        row_start = np.searchsorted(self.pair_row, np.arange(self.n_rows))
+        before = np.concatenate([[0], cumulative])[row_start]
+        return cumulative - before[self.pair_row] + self.pair_row
+
+    def _allocate(self, goals: np.ndarray, cdf: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """Gives every goal to at most one pair of its row
+
+        :param goals: (n_rows, n_sims) goals of every team fixture
+        :return: Flat (pair, simulation) index of every goal given to a pair
+        """
+        n_sims = goals.shape[1]
+        events = np.repeat(np.arange(goals.size), goals.ravel())
+        event_row = events // n_sims
+        pair = np.searchsorted(cdf, event_row + rng.random(len(events)), side='right')
+        valid = pair < self.n_pairs
+        valid[valid] = self.pair_row[pair[valid]] == event_row[valid]
+        return pair[valid] * n_sims + events[valid] % n_sims
+
+    def simulate(self, n_sims: int, rng: np.random.Generator) -> np.ndarray:
+        # arrays are (rows or pairs, simulations), so gathers and scatters move whole contiguous rows
+        n_fixtures = self.n_rows // 2
+        scores = np.searchsorted(self.score_cdf, np.arange(n_fixtures)[:, None] + rng.random((n_fixtures, n_sims)), side='right')
+        scores = scores - np.arange(n_fixtures)[:, None] * self.depth ** 2
+        goals = np.empty((self.n_rows, n_sims), dtype=np.intp)
+        goals[0::2], goals[1::2] = np.divmod(scores, self.depth)
+
+        # appearance and clean sheet points densely, goals and assists only where they happened
+        clean_sheet = (goals == 0)[self.opponent_row]
+        plays = rng.random((self.n_pairs, n_sims), dtype=np.float32) < self.prob_playing[:, None]
+        pair_points = np.where(plays, self.weights[:, 3:4] + self.weights[:, 2:3] * clean_sheet[self.pair_row], np.float32(0))
+        flat_points, flat_plays = pair_points.reshape(-1), plays.reshape(-1)
+        for cdf, weight in [(self.goal_cdf, self.weights[:, 0]), (self.assist_cdf, self.weights[:, 1])]:
+            cells = self._allocate(goals, cdf, rng)
+            cells = cells[flat_plays[cells]]
+            np.add.at(flat_points, cells, weight[cells // n_sims])
+        points = np.zeros((self.n_players, n_sims), dtype=np.float32)
+        for idx in self.passes:
+            points[self.pair_player[idx]] += pair_points[idx]
+        return points.T
+
+
+def _simulate_chunk(layout: _Layout, n_sims: int, seed: np.random.SeedSequence) -> np.ndarray:
+    return layout.simulate(n_sims, np.random.default_rng(seed))
+
+
+class PointsSimulator:
+    """Samples players' points over the given fixtures, e.g. one gameweek or the rest of the season
+
+    :param fixtures: Fixtures with team_h and team_a names
+    :type fixtures: pd.DataFrame
+    :param players: Players frame with team, position, goals_scored, assists, minutes and chance_of_playing_next_round
+    :type players: pd.DataFrame
+    :param model: Team strength model, anything with team_codes and predict(..., return_scores=True)
+    """
+    def __init__(self, fixtures: pd.DataFrame, players: pd.DataFrame, model: Optional[TeamStrengthModel] = None):
+        self.model = get_team_strength_model() if model is None else model
+        self.fixtures = fixtures
+        self.players = players
+        home_idx, away_idx = self.model.team_codes(fixtures['team_h']), self.model.team_codes(fixtures['team_a'])
+        team_code = self.model.team_codes(players['team'])
+        rates = player_rates(team_code,
+                             players['goals_scored'].to_numpy(dtype=float),
+                             players['assists'].to_numpy(dtype=float),
+                             players['minutes'].to_numpy(dtype=float),
+                             players['chance_of_playing_next_round'].to_numpy(dtype=float),
+                             len(self.model.teams))
+        score_probs = self.model.predict(home_idx, away_idx, return_scores=True).score_probs
+        if score_probs is None or len(home_idx) == 0:
+            score_probs = np.ones((len(home_idx), 1, 1))
+        self.layout = _Layout(home_idx, away_idx, team_code, position_codes(players['position']), rates['goal_share_adj'],
+                              rates['assist_share_adj'], rates['prob_playing'], score_probs)
+
+    def simulate(self, n_sims: int = CHUNK_SIZE, seed: Optional[int] = None, chunk_size: int = CHUNK_SIZE,
+                 workers: int = 1) -> np.ndarray:
+        """Draws points samples of every player
+
+        Every chunk has its own child of the seed, so the samples depend on the seed and chunk size only,
+        not on the number of workers.
+
+        :param n_sims: Number of simulations
+        :type n_sims: int
+        :param seed: Seed of the random generator, fresh entropy when None
+        :type seed: int
+        :param chunk_size: Simulations drawn at once
+        :type chunk_size: int
+        :param workers: Number of processes, chunks are simulated in the current process when 1
+        :type workers: int
+        :return: (n_sims, n_players) float32 array, players in the order of the players frame
+        """
+        sizes = [min(chunk_size, n_sims - start) for start in range(0, n_sims, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        if workers > 1 and len(sizes) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunks = list(executor.map(_simulate_chunk, [self.layout] * len(sizes), sizes, seeds))
+        else:
+            chunks = [_simulate_chunk(self.layout, size, child) for size, child in zip(sizes, seeds)]
+        if not chunks:
+            return np.zeros((0, self.layout.n_players), dtype=np.float32)
+        return np.concatenate(chunks)
+
+    def summarize(self, samples: np.ndarray, quantiles: Iterable[float] = QUANTILES) -> pd.DataFrame:
+        return summarize_samples(samples, self.players.index, quantiles)
+
+
+def summarize_samples(samples: np.ndarray, index: pd.Index, quantiles: Iterable[float] = QUANTILES) -> pd.DataFrame:
+    """Per-player mean, spread, quantiles and haul probability of simulated points
+
+    :return: Frame with xp_mean, xp_std, xp_q<percent> and haul_prob columns
+    """
+    summary = {'xp_mean': samples.mean(axis=0), 'xp_std': samples.std(axis=0)}
+    for q, values in zip(quantiles, np.quantile(samples, list(quantiles), axis=0)):
+        summary[f"xp_q{int(round(q * 100))}"] = values
+    summary['haul_prob'] = (samples >= HAUL_POINTS).mean(axis=0)
+    return pd.DataFrame(summary, index=index)
+
+
+def simulate_gameweek(gameweek: int, n_sims: int = CHUNK_SIZE, seed: Optional[int] = None, workers: int = 1,
+                      model: Optional[TeamStrengthModel] = None, players: Optional[pd.DataFrame] = None,
+                      quantiles: Iterable[float] = QUANTILES) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Simulates a gameweek and adds the summary columns to the players frame
+
+    The columns can be used as targets of the optimizers, e.g.
+    ``run_optimization('xp_q10', players=players)`` for a cautious team.
+
+    :return: Players frame with the summary columns and the (n_sims, n_players) samples
+    """
+    fixtures = get_fixtures()
+    fixtures = fixtures[fixtures['event'] == gameweek]
+    players = get_all_players() if players is None else players
+    simulator = PointsSimulator(fixtures, players, model)
+    samples = simulator.simulate(n_sims, seed=seed, workers=workers)
+    return players.join(simulator.summarize(samples, quantiles)), samples
@@ -2,8 +2,17 @@ import os
 import yaml
 import numpy as np
 from pathlib import Path
-from typing import Iterable, Tuple
-from scipy.stats import poisson, nbinom
+from functools import lru_cache
+from typing import Iterable, Optional, Tuple, Union
+from fantasy_football.lazy import lazy_import
+
+special = lazy_import('scipy.special')
+stats = lazy_import('scipy.stats')
+
+# goals beyond this depth are never tabulated, ln(k!) is computed once for all of them
+MAX_POISSON_DEPTH = 64
+# probability mass allowed to fall outside the truncated score grid
+POISSON_TOLERANCE = 1e-10
 
 
 def get_goal_data():
@@ -33,15 +42,94 @@ def calculate_odds(prob_vector: Iterable[float], margin: float = 0.95) -> Iterab
     return margin / prob_vector
 
 
+def poisson_depth(lambdas: Iterable[float], tol: float = POISSON_TOLERANCE) -> int:
+    """Number of goal counts (0..depth-1) needed so that at most ``tol`` of the mass is cut off for every lambda
+
+    NaN lambdas, e.g. of a team missing from the goal table, are left out and give NaN probabilities.
+    """
+    lambdas = np.asarray(lambdas, dtype=float)
+    lambdas = lambdas[~np.isnan(lambdas)]
+    if lambdas.size == 0:
+        return 1
+    if np.any(lambdas < 0) or np.any(np.isinf(lambdas)):
+        raise ValueError(f"Expected goals must be finite and non-negative, got {lambdas[(lambdas < 0) | np.isinf(lambdas)][:5]}")
+    depth = int(stats.poisson.isf(tol, np.max(lambdas))) + 1
+    return int(np.clip(depth, 1, MAX_POISSON_DEPTH))
+
+
+@lru_cache(maxsize=1)
+def log_factorials() -> np.ndarray:
+    return special.gammaln(np.arange(MAX_POISSON_DEPTH) + 1)
+
+
+def _log_factorials(depth: int) -> np.ndarray:
+    # ln(k!) of 0..depth-1, from the table unless an explicit depth goes beyond it
+    if depth <= MAX_POISSON_DEPTH:
+        return log_factorials()[:depth]
+    return special.gammaln(np.arange(depth) + 1)
+
+
+def poisson_pmf_matrix(lambdas: Iterable[float], depth: int) -> np.ndarray:
+    """Poisson probabilities of 0..depth-1 goals for every lambda, shape (n_lambdas, depth)
+    """
+    lambdas = np.asarray(lambdas, dtype=float)[..., None]
+    goals = np.arange(depth)
+    return np.exp(special.xlogy(goals, lambdas) - lambdas - _log_factorials(depth))
+
+
 def calculate_poisson_prob_vec(lambda_goals: float, depth: int = 11) -> Iterable[float]:
-    return np.array([poisson.pmf(i, lambda_goals) for i in range(depth)])
+    return poisson_pmf_matrix(lambda_goals, depth)
+
+
+def bivariate_poisson_batch(lambda_home: Iterable[float], lambda_away: Iterable[float], depth: Optional[int] = None,
+                            tol: float = POISSON_TOLERANCE, return_scores: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+    """Home win, draw and away win probabilities of many independent Poisson matches at once
+
+    :param lambda_home: Expected goals of the home sides, shape (n_matches,)
+    :type lambda_home: Iterable[float]
+    :param lambda_away: Expected goals of the away sides, shape (n_matches,)
+    :type lambda_away: Iterable[float]
+    :param depth: Number of goal counts per side, chosen from ``tol`` when not given
+    :type depth: int
+    :param tol: Probability mass allowed to fall outside the score grid when depth is adaptive
+    :type tol: float
+    :param return_scores: Also returns the (n_matches, depth, depth) correct score tensor
+    :type return_scores: bool
+    :return: (n_matches, 3) outcome matrix, and the score tensor if requested
+    """
+    lambda_home = np.atleast_1d(np.asarray(lambda_home, dtype=float))
+    lambda_away = np.atleast_1d(np.asarray(lambda_away, dtype=float))
+    if depth is None:
+        depth = poisson_depth(np.concatenate([lambda_home, lambda_away]), tol)
+    home_probs = poisson_pmf_matrix(lambda_home, depth)
+    away_probs = poisson_pmf_matrix(lambda_away, depth)
+    # P(away scores fewer than i goals) - the scores tensor is never needed for the outcomes
+    away_below = np.cumsum(away_probs, axis=1) - away_probs
+    home_below = np.cumsum(home_probs, axis=1) - home_probs
+    outcomes = np.stack([np.sum(home_probs * away_below, axis=1),
+                         np.sum(home_probs * away_probs, axis=1),
+                         np.sum(away_probs * home_below, axis=1)], axis=1)
+    if return_scores:
+        return outcomes, home_probs[:, :, None] * away_probs[:, None, :]
+    return outcomes
+
+
+def over_under_probs(score_probs: np.ndarray, line: float = 2.5) -> np.ndarray:
+    """Probabilities of total goals over and under the line, shape (n_matches, 2), from a correct score tensor
+    """
+    depth = score_probs.shape[-1]
+    total_goals = np.add.outer(np.arange(depth), np.arange(depth))
+    over = np.sum(score_probs * (total_goals > line), axis=(-2, -1))
+    under = np.sum(score_probs * (total_goals < line), axis=(-2, -1))
+    return np.stack([over, under], axis=-1)
+
+
+def btts_prob(score_probs: np.ndarray) -> np.ndarray:
+    """Probability of both teams scoring, from a correct score tensor
+    """
+    return np.sum(score_probs[..., 1:, 1:], axis=(-2, -1))
 
 
 def bivariate_poisson_sum(lambda_home, lambda_away, depth=11) -> Tuple:
-    goals_home_vec = calculate_poisson_prob_vec(lambda_home, depth)
-    goals_away_vec = calculate_poisson_prob_vec(lambda_away, depth)
-    bivariate_probs = np.outer(goals_home_vec, goals_away_vec)
-    draw_prob = np.sum(np.diag(bivariate_probs))
-    away_prob = np.sum(np.triu(bivariate_probs)) - draw_prob
-    home_prob = np.sum(np.tril(bivariate_probs)) - draw_prob
+    home_prob, draw_prob, away_prob = bivariate_poisson_batch(lambda_home, lambda_away, depth)[0]
     return home_prob, draw_prob, away_prob
\ No newline at end of file
@@ -0,0 +1,143 @@
+"""
+Local snapshot store of daily players and teams frames as date-partitioned Parquet files
+
+Every table lives in STORE_PATH/<table>/date=YYYY-MM-DD/snapshot.parquet, so reads over a range of
+days only open the matching partitions, and only the requested columns of them.
+"""
+from __future__ import annotations
+import os
+import logging
+from pathlib import Path
+from datetime import date
+from functools import lru_cache
+from typing import List, Optional, Tuple, Any
+from fantasy_football.lazy import lazy_import, optional_lazy_import
+
+pd = lazy_import('pandas')
+# pyarrow is only imported when a snapshot is read or written
+pa = optional_lazy_import('pyarrow')
+ds = optional_lazy_import('pyarrow.dataset')
+pq = optional_lazy_import('pyarrow.parquet')
+
+STORE_PATH = Path(os.environ.get('FPL_STORE_PATH', Path(os.path.abspath(__file__)).parent / "store"))
+PARTITION_COLUMN = 'date'
+SNAPSHOT_FILE = "snapshot.parquet"
+# index of the frames handed back by read_snapshot
+INDEX_COLUMNS = {'players': 'player_id',
+                 'teams': 'id'}
+
+
+@lru_cache(maxsize=1)
+def is_available() -> bool:
+    """Whether pyarrow is installed and can be imported, it is imported by the first call
+    """
+    if pa is None:
+        return False
+    try:
+        # an installed pyarrow can still fail to import, e.g. when built against another numpy
+        pa.schema, ds.dataset, pq.write_table
+    except ImportError as error:
+        logging.info(f"pyarrow failed to import, the snapshot store is not available: {error}")
+        return False
+    return True
+
+
+def _require_pyarrow() -> None:
+    if not is_available():
+        raise RuntimeError("The snapshot store requires pyarrow, install it with 'pip install pyarrow'")
+
+
+def _partition_schema():
+    return pa.schema([(PARTITION_COLUMN, pa.date32())])
+
+
+def write_snapshot(input_df: pd.DataFrame, _table_name: str = "players", snapshot_date: Optional[date] = None,
+                   root: Path = STORE_PATH) -> Path:
+    """Writes the snapshot of one day, replacing an earlier snapshot of the same day
+
+    :param input_df: Snapshot, its date column gives the partition unless snapshot_date is given
+    :type input_df: pd.DataFrame
+    :param _table_name: Name of the table
+    :type _table_name: str
+    :param snapshot_date: Day of the snapshot
+    :type snapshot_date: date
+    :return: Path of the written file
+    """
+    _require_pyarrow()
+    if snapshot_date is None:
+        days = pd.unique(input_df[PARTITION_COLUMN])
+        if len(days) != 1:
+            raise ValueError(f"A snapshot holds exactly one day, got {len(days)}")
+        snapshot_date = pd.Timestamp(days[0]).date()
+    partition = Path(root) / _table_name / f"{PARTITION_COLUMN}={snapshot_date.isoformat()}"
+    partition.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(input_df.drop(columns=[PARTITION_COLUMN], errors='ignore'), preserve_index=False)
+    # written next to the final file and renamed, so readers never see a partial snapshot
+    tmp_path = partition / f".{SNAPSHOT_FILE}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, partition / SNAPSHOT_FILE)
+    logging.info(f"Stored {len(input_df)} rows of {_table_name} for {snapshot_date}")
+    return partition / SNAPSHOT_FILE
+
+
+def read_snapshots(_table_name: str = "players", columns: Optional[List[str]] = None, start_date: Optional[date] = None,
+                   end_date: Optional[date] = None, filters: Optional[List[Tuple[str, str, Any]]] = None,
+                   root: Path = STORE_PATH) -> pd.DataFrame:
+    """Reads the snapshots of a range of days, only opening their partitions and only reading the given columns
+
+    Files are memory-mapped and the Arrow buffers are handed over to pandas without copies where the types allow it.
+
+    :param _table_name: Name of the table
+    :type _table_name: str
+    :param columns: Columns to read, all when None, the date column is always included
+    :type columns: List[str]
+    :param start_date: First day, inclusive
+    :type start_date: date
+    :param end_date: Last day, inclusive
+    :type end_date: date
+    :param filters: Row filters pushed down to the Parquet reader, e.g. [('position', '==', 'MID')]
+    :type filters: List[Tuple[str, str, Any]]
+    :return: Snapshots with a date column
+    """
+    _require_pyarrow()
+    path = Path(root) / _table_name
+    if not path.exists():
+        raise ValueError(f"No snapshots of {_table_name} in {root}")
+    filters = list(filters or [])
+    if start_date is not None:
+        filters.append((PARTITION_COLUMN, '>=', start_date))
+    if end_date is not None:
+        filters.append((PARTITION_COLUMN, '<=', end_date))
+    if columns is not None:
+        columns = [PARTITION_COLUMN] + [col for col in columns if col != PARTITION_COLUMN]
+    partitioning = ds.partitioning(_partition_schema(), flavor='hive')
+    table = pq.read_table(path, columns=columns, filters=filters or None, memory_map=True, partitioning=partitioning)
+    return table.to_pandas(split_blocks=True, self_destruct=True, date_as_object=True)
+
+
+def read_snapshot(snapshot_date: date, _table_name: str = "players", columns: Optional[List[str]] = None,
+                  root: Path = STORE_PATH) -> pd.DataFrame:
+    """Snapshot of one day indexed like the frames of the api module
+
+    :param snapshot_date: Day of the snapshot
+    :type snapshot_date: date
+    :param _table_name: Name of the table
+    :type _table_name: str
+    :param columns: Columns to read, all when None
+    :type columns: List[str]
+    """
+    snapshot = read_snapshots(_table_name, columns, snapshot_date, snapshot_date, root=root)
+    if snapshot.empty:
+        raise ValueError(f"No snapshot of {_table_name} for {snapshot_date}")
+    index_column = INDEX_COLUMNS.get(_table_name)
+    if index_column in snapshot.columns:
+        snapshot.set_index(snapshot[index_column].to_numpy(), inplace=True)
+    return snapshot
+
+
+def stored_dates(_table_name: str = "players", root: Path = STORE_PATH) -> List[date]:
+    path = Path(root) / _table_name
+    if not path.exists():
+        return []
+    return sorted(date.fromisoformat(partition.name.split('=', 1)[1]) for partition in path.glob(f"{PARTITION_COLUMN}=*")
+                  if (partition / SNAPSHOT_FILE).exists())
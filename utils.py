@@ -2,8 +2,8 @@ import numpy as np
 from fantasy_football.predictions import MatchPrediction
 
 
-def match_summary(home_team, away_team) -> None:
-    match = MatchPrediction(home_team, away_team, kappa=1.3)
+def match_summary(home_team, away_team, kappa: float = 1.3) -> None:
+    match = MatchPrediction(home_team, away_team, kappa=kappa)
     home_xg, away_xg = match.get_xg()
     print(f"Home ({home_team}) xG: {home_xg}")
     print(f"Away ({away_team}) xG: {away_xg}")